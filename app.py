@@ -1,31 +1,112 @@
 # app.py
+import time
+# začiatok importu aplikácie – od neho sa meria čas do pripravenosti (startup_seconds)
+_T_IMPORT = time.perf_counter()
 import logging
-from fastapi import FastAPI, WebSocket
+import os
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Query, Response, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
-from dbhandler import PostgresRepository
+from archive import ARCHIVE_DIR, ArchiveReader, create_archiver
+from dbhandler import DB_BACKEND, create_repository
+from export import (
+    MEDIA_TYPES, ExportQuery, ExportUnavailable, MeasurementExporter, parse_columns,
+)
+from gateway import GatewayClient, RemoteProcessor
+from kpi import KPI_CACHE, KpiReader
 from worker import MessageProcessor
 from websocket import WsController
 from logger import setup_logging, get_logger
+from tiles import TILE_CACHE, TILE_DETAIL, TILE_ZOOMS, TileReader
+from live import LiveHub
+import metrics
 
 setup_logging()
 log = get_logger("app")
 
-repo = PostgresRepository()
-processor = MessageProcessor(repo)
+# INGEST_MODE=gateway -> tento proces len prijíma WS, dekóduje a ACKuje; záznamy
+# posiela writer procesu (writer.py), ktorý vlastní DB pool a MessageProcessor
+# (uvicorn --workers N, pozri docker/entrypoint.sh). Inak všetko v tomto procese.
+INGEST_MODE = os.getenv("INGEST_MODE", "inprocess").lower()
+if INGEST_MODE == "gateway":
+    repo = GatewayClient()
+    processor = RemoteProcessor(repo)
+else:
+    repo = create_repository(DB_BACKEND)
+    processor = MessageProcessor(repo)
 controller = WsController(processor)
+# živý fan-out zapísaných meraní na dashboardy (/live)
+live = LiveHub()
+repo.write_listeners.append(live.observe)
+if INGEST_MODE == "gateway":
+    # writer posiela zapísané riadky len gateway procesom s odberateľmi
+    repo.live_active = lambda: len(live) > 0
+
+    def _invalidate_caches(session_ids, tile_keys) -> None:
+        # KPI aj /tiles obsluhuje gateway: writer posiela dotknuté sessions a dlaždice
+        KPI_CACHE.invalidate(session_ids)
+        TILE_CACHE.invalidate({"zoom": z, "x": x, "y": y} for z, x, y in tile_keys)
+
+    repo.invalidate_listeners.append(_invalidate_caches)
+# zápis merania/RTT session zneplatní jej KPI v cache
+repo.write_listeners.append(KPI_CACHE.observe)
+
+# Export číta cez vlastný malý pool (nie engine ingestu); bez DB nie je dostupný.
+# Engine exportu aj ingestu vznikajú až v lifespan.
+# Archivácia skončených sessions do ARCHIVE_DIR (vypnutá bez ARCHIVE_DIR alebo bez DB);
+# v gateway režime beží len vo writer procese, export archív iba číta.
+archiver = create_archiver() if DB_BACKEND != "memory" and INGEST_MODE != "gateway" else None
+exporter = MeasurementExporter(
+    archive=ArchiveReader() if ARCHIVE_DIR else None,
+) if DB_BACKEND != "memory" else None
+metrics.bind(processor, repo, live, archiver)
+tile_reader: Optional[TileReader] = None
+kpi_reader: Optional[KpiReader] = None
+ready = False
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global tile_reader, kpi_reader, ready
+    t0 = time.perf_counter()
     log.info("Startup: DB + worker")
     await repo.start()
+    t_db = time.perf_counter()
+    try:
+        warmed = await repo.warm_up()
+    except Exception:
+        warmed = 0
+        log.exception("Connection pre-warm failed; continuing cold")
+    t_warm = time.perf_counter()
     await processor.start()
+    if exporter is not None:
+        tile_reader = TileReader(exporter.start())
+        kpi_reader = KpiReader(exporter.start(), archive=exporter.archive)
+    if archiver is not None:
+        archiver.start()
+    t_ready = time.perf_counter()
+    metrics.STARTUP.update({
+        "import": t0 - _T_IMPORT,
+        "db_start": t_db - t0,
+        "prewarm": t_warm - t_db,
+        "worker_start": t_ready - t_warm,
+        "total": t_ready - _T_IMPORT,
+    })
+    ready = True
+    log.info("Ready in %.3fs (import %.3fs, db %.3fs, pre-warm %.3fs on %d connections, "
+             "worker %.3fs)", t_ready - _T_IMPORT, t0 - _T_IMPORT, t_db - t0,
+             t_warm - t_db, warmed, t_ready - t_warm)
     try:
         yield
     finally:
         log.info("Shutdown")
+        if archiver is not None:
+            await archiver.stop()
         await processor.stop()
         await repo.stop()
+        if exporter is not None:
+            await exporter.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -36,7 +117,121 @@ async def ws_endpoint(ws: WebSocket):
     await controller.handle(ws)
 
 
+@app.websocket("/live")
+async def live_endpoint(ws: WebSocket):
+    """Odber meraní vybraných sessions / bboxu v reálnom čase (pozri LiveHub.handle)."""
+    await live.handle(ws)
+
+
+@app.get("/queues")
+async def queues():
+    """Hĺbka shard front workera (hot sessions sú viditeľné per shard)."""
+    return {"total": processor.qsize(), "bytes": processor.queue_bytes(),
+            "shards": processor.shard_stats(),
+            "flow": dict(processor.flow_stats),
+            "idcache": processor.ids.stats() if processor.ids is not None else None}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not metrics.METRICS_ENABLED:
+        return Response(status_code=404)
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/health")
 async def health():
     log.info("Health check")
+    if not ready:
+        return JSONResponse({"status": "starting"}, status_code=503)
+    reasons = []
+    # high_water 0 = bez limitu počtu položiek (spool)
+    saturated = [s["shard"] for s in processor.shard_stats(top=0)
+                 if 0 < processor.high_water <= s["depth"]
+                 or s["bytes"] >= processor.high_water_bytes]
+    if saturated:
+        reasons.append("queue saturated (shards %s)" % saturated)
+    if not await repo.ping():
+        reasons.append("database unreachable")
+    if reasons:
+        return JSONResponse({"status": "degraded", "reasons": reasons}, status_code=503)
     return {"status": "ok"}
+
+
+async def _export(q, fmt: str, columns: Optional[str]) -> StreamingResponse:
+    if exporter is None:
+        raise HTTPException(503, "export requires a database backend")
+    try:
+        cols = parse_columns(columns)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    try:
+        body = await exporter.stream(q, cols, fmt)
+    except ExportUnavailable:
+        raise HTTPException(503, "export unavailable, try again later")
+    return StreamingResponse(body, media_type=MEDIA_TYPES[fmt])
+
+
+@app.get("/sessions/{session_id}/measurements")
+async def export_session(session_id: str,
+                         format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                         columns: Optional[str] = None,
+                         from_ts: Optional[int] = None, to_ts: Optional[int] = None,
+                         network_tech: Optional[str] = None, band: Optional[str] = None,
+                         cell_id: Optional[int] = None,
+                         limit: Optional[int] = Query(None, ge=1)):
+    """Stream meraní jednej session (NDJSON/CSV), zoradené podľa Timestamp."""
+    q = ExportQuery(session_id=session_id, from_ts=from_ts, to_ts=to_ts,
+                    network_tech=network_tech, band=band, cell_id=cell_id, limit=limit)
+    return await _export(q, format, columns)
+
+
+@app.get("/measurements")
+async def export_range(from_ts: int, to_ts: int,
+                       format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                       columns: Optional[str] = None,
+                       network_tech: Optional[str] = None, band: Optional[str] = None,
+                       cell_id: Optional[int] = None,
+                       limit: Optional[int] = Query(None, ge=1)):
+    """Stream meraní v časovom okne [from_ts, to_ts) v ms, zoradené podľa času (a Id)."""
+    q = ExportQuery(from_ts=from_ts, to_ts=to_ts, network_tech=network_tech,
+                    band=band, cell_id=cell_id, limit=limit)
+    return await _export(q, format, columns)
+
+
+@app.get("/tiles/{z}/{x}/{y}")
+async def coverage_tile(z: int, x: int, y: int,
+                        detail: int = Query(TILE_DETAIL, ge=0, le=8),
+                        network_tech: Optional[str] = None, band: Optional[str] = None,
+                        cell_id: Optional[int] = None):
+    """Agregáty pokrytia (RSRP/RSRQ/SINR) v mriežke zoomu z + detail vnútri dlaždice z/x/y."""
+    if tile_reader is None:
+        raise HTTPException(503, "tiles require a database backend")
+    if z + detail not in TILE_ZOOMS:
+        raise HTTPException(404, f"zoom {z + detail} is not aggregated (TILE_ZOOMS={list(TILE_ZOOMS)})")
+    if not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise HTTPException(404, "tile out of range")
+    try:
+        return await tile_reader.get(z, x, y, detail, network_tech, band, cell_id)
+    except Exception as e:
+        log.warning("Tile read failed: %s", e)
+        raise HTTPException(503, "tiles unavailable, try again later")
+
+
+@app.get("/sessions/{session_id}/kpis")
+async def session_kpis(session_id: str):
+    """
+    KPI session: percentily RSRP/RSRQ/SINR, čas v NetworkTech/BAND, handovery,
+    intervaly výpadkov, prejdená vzdialenosť a rozdelenie RTT (pozri kpi.compute).
+    """
+    if kpi_reader is None:
+        raise HTTPException(503, "KPIs require a database backend")
+    try:
+        kpis = await kpi_reader.get(session_id)
+    except Exception as e:
+        log.warning("KPI computation failed: %s", e)
+        raise HTTPException(503, "KPIs unavailable, try again later")
+    if kpis is None:
+        raise HTTPException(404, "session has no measurements")
+    return kpis
@@ -0,0 +1,329 @@
+# archive.py
+from __future__ import annotations
+import asyncio
+import glob
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import quote, unquote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from sqlalchemy import BigInteger, Boolean, Float, Integer, and_, delete, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from dbhandler import ASYNC_DSN
+from logger import get_logger, setup_logging
+from models import Measurement, SessionArchive, SessionStats
+
+setup_logging()
+log = get_logger("archive")
+
+# Adresár stĺpcového archívu; prázdny = archivácia vypnutá.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+# Ako často sa hľadajú sessions na archiváciu (s).
+ARCHIVE_INTERVAL_S = float(os.getenv("ARCHIVE_INTERVAL_S", "300"))
+# Session bez zmeny v session_stats dlhšie ako N s sa považuje za skončenú.
+ARCHIVE_IDLE_S = float(os.getenv("ARCHIVE_IDLE_S", "3600"))
+# Session so session_summary od klienta sa archivuje už po N s
+# (rezerva na dobehnutie fronty workera a flush rollupov).
+ARCHIVE_GRACE_S = float(os.getenv("ARCHIVE_GRACE_S", "120"))
+# Max. sessions za jeden priechod.
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "20"))
+# Po zápise zmazať riadky session z measurements.
+ARCHIVE_PRUNE = os.getenv("ARCHIVE_PRUNE", "false").lower() in ("1", "true", "yes")
+# Riadkov na jeden fetch pri čítaní session / na jeden DELETE pri prune.
+ARCHIVE_PAGE_SIZE = int(os.getenv("ARCHIVE_PAGE_SIZE", "10000"))
+
+COLUMNS: List[str] = [c.name for c in Measurement.__table__.columns]
+
+_ARROW_TYPES = {BigInteger: pa.int64(), Integer: pa.int32(), Float: pa.float64(),
+                Boolean: pa.bool_()}
+# rovnaké stĺpce (a poradie) ako models.Measurement; String -> utf8
+SCHEMA = pa.schema([
+    pa.field(c.name, _ARROW_TYPES.get(type(c.type), pa.string()), nullable=not c.primary_key)
+    for c in Measurement.__table__.columns
+])
+
+
+def _day(ts_ms: Optional[int]) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime((ts_ms or 0) / 1000))
+
+
+def _session_dir(root: str, day: str, session_id: str) -> str:
+    # session_id je od klienta – v názve adresára nesmie byť '/' ani '..'
+    return os.path.join(root, day, quote(session_id, safe=""))
+
+
+def _part_path(root: str, day: str, session_id: str, part: int) -> str:
+    return os.path.join(_session_dir(root, day, session_id), f"part-{part:05d}.arrow")
+
+
+def write_part(path: str, table: pa.Table) -> int:
+    """
+    Zapíše tabuľku ako nekomprimovaný Arrow IPC súbor (dá sa čítať
+    memory-mapped bez kópie) cez dočasný súbor + fsync + rename, takže čitateľ
+    nikdy nevidí polovičný súbor. Vráti veľkosť v bajtoch.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with pa.OSFile(tmp, "wb") as f:
+        with pa.ipc.new_file(f, table.schema) as w:
+            w.write_table(table)
+    fd = os.open(tmp, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def read_part(path: str) -> pa.Table:
+    """Memory-mapped čítanie jedného part súboru (buffery ukazujú do mmap)."""
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+class ArchiveReader:
+    """
+    Čítanie archívu pre analytiku a export bez dotazov na živú DB.
+    Rozloženie: ARCHIVE_DIR/<YYYY-MM-DD>/<session_id (URL-encoded)>/part-NNNNN.arrow,
+    deň = deň prvého merania session (UTC). Session má viac partov len pri
+    ARCHIVE_PRUNE, keď po archivácii ešte prišli merania. Tabuľky sú
+    memory-mapped; .to_pylist() / .column(c).to_numpy() kopírujú až pri použití.
+    """
+
+    def __init__(self, root: str = ARCHIVE_DIR) -> None:
+        self.root = root
+
+    def days(self) -> List[str]:
+        return sorted(d for d in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, d))) if os.path.isdir(self.root) else []
+
+    def sessions(self, day: Optional[str] = None) -> List[str]:
+        days = [day] if day is not None else self.days()
+        out = set()
+        for d in days:
+            base = os.path.join(self.root, d)
+            if os.path.isdir(base):
+                out.update(unquote(s) for s in os.listdir(base))
+        return sorted(out)
+
+    def session_paths(self, session_id: str) -> List[str]:
+        pattern = os.path.join(self.root, "*", glob.escape(quote(session_id, safe="")), "part-*.arrow")
+        return sorted(glob.glob(pattern))
+
+    def has_session(self, session_id: str) -> bool:
+        return bool(self.session_paths(session_id))
+
+    def read_session(self, session_id: str, columns: Optional[Sequence[str]] = None) -> pa.Table:
+        return self._read(self.session_paths(session_id), columns)
+
+    def read_day(self, day: str, columns: Optional[Sequence[str]] = None) -> pa.Table:
+        return self._read(sorted(glob.glob(os.path.join(self.root, day, "*", "part-*.arrow"))),
+                          columns)
+
+    @staticmethod
+    def _read(paths: List[str], columns: Optional[Sequence[str]]) -> pa.Table:
+        tables = [read_part(p) for p in paths]
+        table = pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+        return table.select(list(columns)) if columns is not None else table
+
+
+def filter_table(table: pa.Table, from_ts: Optional[int] = None, to_ts: Optional[int] = None,
+                 network_tech: Optional[str] = None, band: Optional[str] = None,
+                 cell_id: Optional[int] = None) -> pa.Table:
+    """Rovnaké filtre ako export.ExportQuery (to_ts exkluzívne); null hodnoty neprejdú."""
+    conds = []
+    if from_ts is not None:
+        conds.append(pc.greater_equal(table["Timestamp"], from_ts))
+    if to_ts is not None:
+        conds.append(pc.less(table["Timestamp"], to_ts))
+    if network_tech is not None:
+        conds.append(pc.equal(table["NetworkTech"], network_tech))
+    if band is not None:
+        conds.append(pc.equal(table["BAND"], band))
+    if cell_id is not None:
+        conds.append(pc.equal(table["CellID"], cell_id))
+    if not conds:
+        return table
+    mask = conds[0]
+    for c in conds[1:]:
+        mask = pc.and_(mask, c)
+    return table.filter(mask)
+
+
+class SessionArchiver:
+    """
+    Na pozadí zapisuje skončené sessions do ARCHIVE_DIR (pozri ArchiveReader).
+    - Kandidát: session_stats bez zmeny ARCHIVE_IDLE_S, alebo so session_summary
+      od klienta a bez zmeny ARCHIVE_GRACE_S; a zároveň ešte nearchivovaná
+      alebo zmenená od poslednej archivácie (session_archive.source_updated_at).
+    - Riadky session sa čítajú po ARCHIVE_PAGE_SIZE cez vlastný malý engine
+      (jedno spojenie), takže archivácia nezaberá pool ingestu.
+    - Bez prune sa part-00000 pri zmene prepíše celou session. S prune sa
+      po zápise v jednej transakcii uloží session_archive a zmažú presne
+      zapísané Id; neskoršie merania tej session pôjdu do ďalšieho partu.
+    """
+
+    def __init__(self, root: str = ARCHIVE_DIR, dsn: Optional[str] = ASYNC_DSN,
+                 interval_s: float = ARCHIVE_INTERVAL_S, idle_s: float = ARCHIVE_IDLE_S,
+                 grace_s: float = ARCHIVE_GRACE_S, batch: int = ARCHIVE_BATCH,
+                 prune: bool = ARCHIVE_PRUNE, page_size: int = ARCHIVE_PAGE_SIZE) -> None:
+        self.root = root
+        self.dsn = dsn
+        self.interval_s = interval_s
+        self.idle_s = idle_s
+        self.grace_s = grace_s
+        self.batch = batch
+        self.prune = prune
+        self.page_size = page_size
+        self.engine: Optional[AsyncEngine] = None
+        self.reader = ArchiveReader(root)
+        self.stats: Dict[str, int] = {"sessions": 0, "rows": 0, "bytes": 0,
+                                      "pruned_rows": 0, "failed": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        # engine vznikne až pri prvom priechode (run_once)
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="session-archiver")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_s)
+            try:
+                # kým je čo archivovať, ďalší priechod ide hneď
+                while await self.run_once() >= self.batch:
+                    pass
+            except Exception:
+                log.exception("Session archiving failed")
+
+    async def run_once(self) -> int:
+        """
+        Jeden priechod: archivuje najviac `batch` sessions; vráti počet
+        úspešných (zlyhaná session ostáva kandidátom na ďalší priechod).
+        """
+        if self.engine is None:
+            self.engine = create_async_engine(self.dsn, pool_size=1, max_overflow=0)
+        done = 0
+        for c in await self._candidates():
+            try:
+                await self.archive_session(c)
+                done += 1
+            except Exception:
+                self.stats["failed"] += 1
+                log.exception("Archiving session %s failed", c["session_id"])
+        return done
+
+    async def _candidates(self) -> List[Dict[str, Any]]:
+        S, A = SessionStats, SessionArchive
+        now = datetime.now(timezone.utc)
+        stmt = (
+            select(S.session_id, S.updated_at, S.first_ts_ms, S.started_at_ms,
+                   A.day, A.parts, A.rows, A.pruned)
+            .select_from(S.__table__.outerjoin(A.__table__, A.session_id == S.session_id))
+            .where(or_(A.session_id.is_(None), A.source_updated_at < S.updated_at))
+            .where(or_(S.updated_at < now - timedelta(seconds=self.idle_s),
+                       and_(S.client_reported, S.ended_at_ms.is_not(None),
+                            S.updated_at < now - timedelta(seconds=self.grace_s))))
+            .order_by(S.updated_at)
+            .limit(self.batch)
+        )
+        async with self.engine.connect() as conn:
+            return [dict(r._mapping) for r in (await conn.execute(stmt)).all()]
+
+    async def archive_session(self, c: Dict[str, Any]) -> int:
+        """Zapíše jednu session (riadok z _candidates); vráti počet zapísaných riadkov."""
+        sid = c["session_id"]
+        table = await self._read_rows(sid)
+        n = table.num_rows
+        day = c["day"] or _day(c["first_ts_ms"] or c["started_at_ms"])
+        # po predošlom prune sú v DB len novšie riadky -> ďalší part;
+        # inak DB drží celú session -> part-00000 sa prepíše
+        append = bool(c["pruned"])
+        part = (c["parts"] or 0) if append else 0
+        size = write_part(_part_path(self.root, day, sid, part), table) if n else 0
+        ts = table["Timestamp"]
+        stmt = insert(SessionArchive).values(
+            session_id=sid, day=day, parts=part + 1 if n else 0, rows=n, bytes=size,
+            first_ts_ms=pc.min(ts).as_py(), last_ts_ms=pc.max(ts).as_py(),
+            pruned=self.prune, source_updated_at=c["updated_at"])
+        ex = stmt.excluded
+        A = SessionArchive.__table__.c
+        set_: Dict[str, Any] = {"source_updated_at": ex.source_updated_at,
+                                "archived_at": func.now()}
+        if n and append:
+            # nový part k existujúcim
+            set_.update(parts=ex.parts, rows=A.rows + ex.rows, bytes=A.bytes + ex.bytes,
+                        first_ts_ms=func.least(A.first_ts_ms, ex.first_ts_ms),
+                        last_ts_ms=func.greatest(A.last_ts_ms, ex.last_ts_ms), pruned=True)
+        elif n:
+            # part-00000 prepísaný celou session
+            set_.update({k: ex[k] for k in ("parts", "rows", "bytes", "first_ts_ms",
+                                            "last_ts_ms", "pruned")})
+        stmt = stmt.on_conflict_do_update(index_elements=["session_id"], set_=set_)
+        pruned = 0
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt)
+            if self.prune and n:
+                ids = table["Id"].to_pylist()
+                M = Measurement
+                for i in range(0, n, self.page_size):
+                    res = await conn.execute(delete(M).where(
+                        M.SessionId == sid, M.Id.in_(ids[i:i + self.page_size])))
+                    pruned += res.rowcount
+        self.stats["sessions"] += 1
+        self.stats["rows"] += n
+        self.stats["bytes"] += size
+        self.stats["pruned_rows"] += pruned
+        log.info("Archived session %s: %d rows, %d bytes (part %d, pruned %d)",
+                 sid, n, size, part, pruned)
+        return n
+
+    async def _read_rows(self, session_id: str) -> pa.Table:
+        M = Measurement
+        stmt = (select(*[M.__table__.c[c] for c in COLUMNS])
+                .where(M.SessionId == session_id)
+                .order_by(M.Timestamp, M.Id))
+        batches: List[pa.RecordBatch] = []
+        async with self.engine.connect() as conn:
+            res = await conn.stream(stmt.execution_options(yield_per=self.page_size))
+            async for rows in res.partitions(self.page_size):
+                batches.append(pa.RecordBatch.from_arrays(
+                    [pa.array(col, type=f.type) for col, f in zip(zip(*rows), SCHEMA)],
+                    schema=SCHEMA))
+        return pa.Table.from_batches(batches, schema=SCHEMA).combine_chunks()
+
+
+def create_archiver() -> Optional[SessionArchiver]:
+    return SessionArchiver() if ARCHIVE_DIR else None
+
+
+async def main() -> None:
+    """Jednorazový priechod z príkazového riadka (napr. cron): python archive.py"""
+    archiver = SessionArchiver(root=ARCHIVE_DIR or "archive")
+    try:
+        while await archiver.run_once() >= archiver.batch:
+            pass
+    finally:
+        await archiver.stop()
+    log.info("Archive run finished: %s", archiver.stats)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,532 @@
+# backfill.py
+"""
+Backfill a replay zachytenej prevádzky: JSONL, jeden WS rámec na riadok
+(aj .gz / .bz2 / .xz), číta sa prúdovo s konštantnou pamäťou.
+
+- do DB (predvolené): rámce idú cez rovnaký decode_frame / _extract_fields
+  ako /ws do MessageProcessor – paralelné shardy, dávkové inserty,
+  idempotency cache a ON CONFLICT, RTT updaty, session_summary aj rollupy.
+  Priebeh sa periodicky checkpointuje do --state (offset v rozbalenom
+  prúde, až keď je všetko pred ním zapísané v DB); --resume pokračuje od
+  checkpointu, --offset od daného bajtu. Opakovaný zápis je idempotentný.
+- --ws URL: prehrá rámce na bežiaci server s pôvodným časovaním
+  (timestamp_sent, zrýchlenie --speed) ako záťažový test; jedno spojenie
+  na session, meria ACK latenciu a oneskorenie voči plánu.
+
+    python backfill.py drive.jsonl.gz --state drive.state --resume
+    python backfill.py drive.jsonl --ws ws://localhost:8000/ws --speed 10
+"""
+import argparse
+import asyncio
+import bz2
+import gzip
+import json
+import lzma
+import os
+import random
+import sys
+import time
+from collections import Counter
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from dbhandler import DB_BACKEND, ROW_KEY, create_repository
+from decoding import decode_frame
+from logger import get_logger, setup_logging
+from worker import BATCH_SIZE, WORKER_COUNT, MessageProcessor
+
+setup_logging()
+log = get_logger("backfill")
+
+# rozbaľovanie podľa prípony súboru (len stdlib kodeky)
+_CODECS = {
+    ".gz": lambda raw: gzip.GzipFile(fileobj=raw),
+    ".bz2": bz2.BZ2File,
+    ".xz": lzma.LZMAFile,
+    ".lzma": lzma.LZMAFile,
+}
+_READ_CHUNK = 1 << 20
+# po koľkých riadkoch pustiť slučku k workerom (inak bežia až pri plnej fronte)
+_YIELD_EVERY = 256
+# replay: ako dlho po session_summary čakať na prípadné retry_after pred zavretím
+_SUMMARY_GRACE_S = 0.5
+
+
+class Capture:
+    """
+    Zachytená prevádzka ako prúd riadkov. `offset` je bajt v rozbalenom
+    prúde hneď za posledným vráteným riadkom (pre checkpoint / --offset),
+    `progress` podiel prečítaného súboru (pri kompresii podľa komprimovaných
+    bajtov; None pre stdin).
+    """
+
+    def __init__(self, path: str, offset: int = 0) -> None:
+        self.path = path
+        self.offset = 0
+        self._start = max(0, int(offset))
+        self._raw: Optional[BinaryIO] = None
+        self._f: Optional[BinaryIO] = None
+        self._size: Optional[int] = None
+
+    def __enter__(self) -> "Capture":
+        if self.path == "-":
+            self._raw = sys.stdin.buffer
+        else:
+            self._raw = open(self.path, "rb", buffering=_READ_CHUNK)
+            self._size = os.fstat(self._raw.fileno()).st_size
+        codec = _CODECS.get(os.path.splitext(self.path)[1].lower())
+        self._f = codec(self._raw) if codec else self._raw
+        self._skip(self._start)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._f is not self._raw:
+            self._f.close()
+        if self._raw is not sys.stdin.buffer:
+            self._raw.close()
+
+    def _skip(self, n: int) -> None:
+        if not n:
+            return
+        if self._f is self._raw and self._raw.seekable():
+            self.offset = self._raw.seek(n)
+            return
+        # komprimovaný prúd / stdin: rozbaliť a zahodiť
+        while self.offset < n:
+            chunk = self._f.read(min(_READ_CHUNK, n - self.offset))
+            if not chunk:
+                break
+            self.offset += len(chunk)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for line in self._f:
+            self.offset += len(line)
+            yield line
+
+    @property
+    def progress(self) -> Optional[float]:
+        if not self._size:
+            return None
+        return min(1.0, self._raw.tell() / self._size)
+
+
+def load_state(path: str, capture: str) -> Tuple[int, int]:
+    """(offset, riadok) posledného checkpointu; (0, 0) ak stav ešte neexistuje."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return 0, 0
+    if state.get("capture") != os.path.abspath(capture):
+        raise SystemExit(f"{path} belongs to {state.get('capture')}, not {capture}")
+    return int(state["offset"]), int(state.get("line", 0))
+
+
+def save_state(path: str, capture: str, offset: int, line: int, done: bool = False) -> None:
+    """Atomicky prepíše stav (tmp + rename), aby ho pád nenechal rozbitý."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"capture": os.path.abspath(capture), "offset": offset, "line": line,
+                   "done": done, "updated_at": int(time.time() * 1000)}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _session_id(data: Dict[str, Any]) -> Optional[str]:
+    """session_id rámca; pri dávke z rámca alebo prvej položky (ako websocket.py)."""
+    sid = data.get("session_id")
+    if sid is None and data.get("type") == "measurement_batch" and data.get("items"):
+        sid = data["items"][0].get("session_id")
+    return str(sid) if sid is not None else None
+
+
+def _measurement_ids(data: Dict[str, Any]) -> List[str]:
+    if data.get("type") == "measurement_batch":
+        return [it["id"] for it in data["items"] if it.get("id")]
+    if data.get("type") == "measurement" and data.get("id"):
+        return [data["id"]]
+    return []
+
+
+def _frame_time_ms(data: Dict[str, Any]) -> Optional[int]:
+    """Čas odoslania rámca (timestamp_sent; pri dávke prvej položky), inak None."""
+    if data.get("type") == "measurement_batch":
+        items = data["items"]
+        if not items:
+            return None
+        data = items[0]
+    row = data.get(ROW_KEY)
+    ts = row.get("Timestamp") if row is not None else data.get("timestamp_sent")
+    return ts if isinstance(ts, int) else None
+
+
+class _Progress:
+    """Priebežný výpis (stderr): pozícia, počty a priepustnosť od štartu."""
+
+    def __init__(self, cap: Capture, interval_s: float) -> None:
+        self.cap = cap
+        self.interval_s = interval_s
+        self.t0 = time.monotonic()
+        self.offset0 = cap.offset
+        self.next = self.t0 + interval_s
+
+    def due(self) -> bool:
+        return self.interval_s > 0 and time.monotonic() >= self.next
+
+    def report(self, stats: Counter, extra: str = "") -> None:
+        now = time.monotonic()
+        self.next = now + self.interval_s
+        dt = max(1e-9, now - self.t0)
+        pct = self.cap.progress
+        print(f"{'%5.1f %%' % (pct * 100) if pct is not None else '    ?'}  "
+              f"offset {self.cap.offset}  lines {stats['lines']}  "
+              f"measurements {stats['measurements']}  invalid {stats['invalid']}  "
+              f"{stats['lines'] / dt:.0f} lines/s  {stats['measurements'] / dt:.0f} meas/s  "
+              f"{(self.cap.offset - self.offset0) / dt / 2**20:.1f} MiB/s{extra}",
+              file=sys.stderr, flush=True)
+
+
+async def backfill(args) -> Dict[str, Any]:
+    """Zachytené rámce -> MessageProcessor -> DB (rovnaká cesta ako /ws)."""
+    offset, line0 = args.offset, 0
+    if args.resume:
+        offset, line0 = load_state(args.state, args.capture)
+        log.info("Resuming %s from offset %d (line %d)", args.capture, offset, line0)
+
+    repo = create_repository(args.backend)
+    written: Counter = Counter(inserted=0, rtt_filled=0)
+
+    def count_writes(inserted: List[Dict[str, Any]], fills: List[Tuple[Any, float]]) -> None:
+        written["inserted"] += len(inserted)
+        written["rtt_filled"] += len(fills)
+
+    repo.write_listeners.append(count_writes)
+    # bez spoolu: checkpoint v --state plní rovnakú úlohu a zápis je idempotentný
+    processor = MessageProcessor(repo, workers=args.workers, batch_size=args.batch_size,
+                                 spool_dir="")
+    stats: Counter = Counter()
+    await repo.start()
+    await processor.start()
+    try:
+        with Capture(args.capture, offset) as cap:
+            progress = _Progress(cap, args.progress_s)
+
+            async def checkpoint(done: bool = False) -> None:
+                await processor.join()
+                # rollupy z už zapísaných riadkov musia byť v DB skôr než offset:
+                # replay ich nových riadkov by sa znova nepozoroval
+                try:
+                    await processor.rollups.flush()
+                    rollups_ok = True
+                except Exception as e:
+                    log.warning("Session rollup flush failed, checkpoint not saved: %s", e)
+                    rollups_ok = False
+                # po zlyhanom zápise checkpoint stojí, --resume ho zopakuje
+                if args.state and rollups_ok and not processor.flow_stats["failed_writes"]:
+                    save_state(args.state, args.capture, cap.offset,
+                               line0 + stats["lines"], done)
+                progress.report(stats, f"  inserted {written['inserted']}  "
+                                       f"rtt {written['rtt_filled']}  "
+                                       f"failed {processor.flow_stats['failed_writes']}")
+
+            # routing kľúč rámcov bez session_id: posledná videná session (ako spojenie)
+            key = ""
+            for line in cap:
+                stats["lines"] += 1
+                if line.strip():
+                    data = decode_frame(line)
+                    if data is None:
+                        stats["invalid"] += 1
+                    else:
+                        key = _session_id(data) or key
+                        stats[data.get("type") or "untyped"] += 1
+                        stats["measurements"] += len(_measurement_ids(data))
+                        await processor.enqueue(data, key)
+                if stats["lines"] % _YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+                    if progress.due():
+                        await checkpoint()
+                if args.limit and stats["lines"] >= args.limit:
+                    break
+            await checkpoint(done=not args.limit or stats["lines"] < args.limit)
+            elapsed = time.monotonic() - progress.t0
+            end = cap.offset
+    finally:
+        await processor.stop(drain=True)
+        await repo.stop()
+    return {
+        "capture": args.capture, "offset": end, "elapsed_s": round(elapsed, 3),
+        "lines_per_s": round(stats["lines"] / max(elapsed, 1e-9)),
+        **stats, **written, "failed": processor.flow_stats["failed_writes"],
+    }
+
+
+class _Reservoir:
+    """Rovnomerná vzorka max. k hodnôt (percentily latencií pri konštantnej pamäti)."""
+
+    def __init__(self, k: int = 100_000) -> None:
+        self.k = k
+        self.n = 0
+        self.values: List[float] = []
+
+    def add(self, x: float) -> None:
+        self.n += 1
+        if len(self.values) < self.k:
+            self.values.append(x)
+        else:
+            i = random.randrange(self.n)
+            if i < self.k:
+                self.values[i] = x
+
+    def summary_ms(self) -> Dict[str, Optional[float]]:
+        v = sorted(self.values)
+        if not v:
+            return {"p50": None, "p95": None, "p99": None, "max": None}
+        pick = lambda p: round(v[min(len(v) - 1, int(p * len(v)))] * 1000, 2)  # noqa: E731
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+                "max": round(v[-1] * 1000, 2)}
+
+
+class _ReplayConn:
+    """
+    Jedno WS spojenie replay (jedna session): odosielanie, ACK a retry_after.
+    Rámce bez id (rtt_updates, session_summary) server potvrdzuje len
+    odmietnutím – odmietnutý sa pošle znova (zápis je idempotentný); za
+    prijatý sa považuje, keď príde odpoveď na neskôr odoslaný rámec.
+    """
+
+    def __init__(self, ws: Any, stats: Counter, ack_latency: _Reservoir) -> None:
+        self.ws = ws
+        self.stats = stats
+        self.ack_latency = ack_latency
+        self.seq = 0
+        # id merania -> (čas prvého odoslania, rámec, poradie) pre ešte neACKnuté
+        self.inflight: Dict[str, Tuple[float, str, int]] = {}
+        # (poradie, typ, rámec) odoslaných rámcov bez id, zatiaľ bez odpovede
+        self.plain: List[Tuple[int, Any, str]] = []
+        self.last_ack = time.monotonic()
+        self._retries: set = set()
+        self._reader = asyncio.create_task(self._read())
+
+    async def send(self, frame: str, ids: Sequence[str], msg_type: Any = None) -> None:
+        self.seq += 1
+        now = time.perf_counter()
+        for mid in ids:
+            sent = self.inflight.get(mid)
+            self.inflight[mid] = (sent[0] if sent else now, frame, self.seq)
+        if not ids:
+            self.plain.append((self.seq, msg_type, frame))
+        await self.ws.send(frame)
+
+    @property
+    def retrying(self) -> bool:
+        return bool(self._retries)
+
+    def _answered(self, seq: int) -> None:
+        """Odpoveď na rámec seq: skoršie rámce bez id server prijal (odpovedá v poradí)."""
+        if self.plain and self.plain[0][0] < seq:
+            self.plain = [p for p in self.plain if p[0] > seq]
+
+    async def _read(self) -> None:
+        async for raw in self.ws:
+            msg = json.loads(raw)
+            t = msg.get("type")
+            if t in ("measurement_ack", "measurement_batch_ack"):
+                now = time.perf_counter()
+                self.last_ack = time.monotonic()
+                for mid in msg.get("ids") or [msg.get("id")]:
+                    sent = self.inflight.pop(mid, None)
+                    if sent is not None:
+                        self.stats["acked"] += 1
+                        self.ack_latency.add(now - sent[0])
+                        self._answered(sent[2])
+            elif t == "retry_after":
+                self.stats["retry_after"] += 1
+                ids = msg.get("ids") or ([msg["id"]] if msg.get("id") else [])
+                if ids:
+                    frames: Dict[str, List[str]] = {}
+                    for mid in ids:
+                        sent = self.inflight.get(mid)
+                        if sent is not None:
+                            frames.setdefault(sent[1], []).append(mid)
+                            self._answered(sent[2])
+                    resend = [(frame, mids, None) for frame, mids in frames.items()]
+                else:
+                    # odpovede idú v poradí, takže skoršie prijaté rámce bez id už
+                    # vyčistila odpoveď na meranie medzi nimi: odmietnutý je
+                    # najstarší čakajúci rámec daného typu
+                    kind = msg.get("frame_type")
+                    i = next((i for i, p in enumerate(self.plain) if p[1] == kind), None)
+                    resend = [(self.plain.pop(i)[2], (), kind)] if i is not None else []
+                task = asyncio.ensure_future(
+                    self._retry(msg.get("retry_after_ms", 1000) / 1000, resend))
+                self._retries.add(task)
+                task.add_done_callback(self._retries.discard)
+            elif t == "slow_down":
+                self.stats["slow_down"] += 1
+
+    async def _retry(self, delay: float, frames: List[Tuple[str, Sequence[str], Any]]) -> None:
+        await asyncio.sleep(delay)
+        for frame, ids, kind in frames:
+            self.stats["resent"] += 1
+            try:
+                await self.send(frame, ids, kind)
+            except Exception:
+                return
+
+    async def drain(self, timeout: float) -> None:
+        """Počká na zvyšné ACK (kým chodia, max. timeout s od posledného)."""
+        self.last_ack = max(self.last_ack, time.monotonic())
+        while ((self.inflight or self._retries) and not self._reader.done()
+               and time.monotonic() - self.last_ack < timeout):
+            await asyncio.sleep(0.05)
+
+    async def close(self, timeout: float) -> None:
+        await self.drain(timeout)
+        self.stats["unacked"] += len(self.inflight)
+        self._reader.cancel()
+        for task in list(self._retries):
+            task.cancel()
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+
+
+async def replay(args) -> Dict[str, Any]:
+    """Zachytené rámce -> bežiaci server (/ws) s pôvodným časovaním."""
+    import websockets
+
+    stats: Counter = Counter()
+    ack_latency, send_lag = _Reservoir(), _Reservoir()
+    conns: Dict[str, _ReplayConn] = {}
+    closing: set = set()
+    loop = asyncio.get_running_loop()
+
+    async def connection(key: str) -> _ReplayConn:
+        conn = conns.get(key)
+        if conn is not None and not conn._reader.done():
+            return conn
+        if conn is not None:
+            stats["reconnects"] += 1
+        ws = await websockets.connect(args.ws, max_queue=None, open_timeout=30)
+        stats["connections"] += 1
+        conns[key] = conn = _ReplayConn(ws, stats, ack_latency)
+        return conn
+
+    async def finish(conn: _ReplayConn, frame: str) -> None:
+        # session_summary až po ACK meraní session (kreditné okno je prázdne,
+        # takže ho server neodmietne), potom sa spojenie zavrie
+        await conn.drain(args.ack_timeout)
+        try:
+            await conn.send(frame, (), "session_summary")
+            # odpoveď príde len pri odmietnutí (retry_after): krátko počkať
+            # a prípadné opakované odoslanie nechať dobehnúť
+            while True:
+                await asyncio.sleep(_SUMMARY_GRACE_S)
+                if not conn.retrying:
+                    break
+                await conn.drain(args.ack_timeout)
+        except Exception as e:
+            stats["errors"] += 1
+            log.warning("Replay send failed for session summary: %s", e)
+        await conn.close(args.ack_timeout)
+
+    t0 = ts0 = None
+    with Capture(args.capture, args.offset) as cap:
+        progress = _Progress(cap, args.progress_s)
+        key = ""
+        for line in cap:
+            if args.limit and stats["lines"] >= args.limit:
+                break
+            stats["lines"] += 1
+            data = decode_frame(line) if line.strip() else None
+            if data is None:
+                stats["invalid"] += int(bool(line.strip()))
+                continue
+            key = _session_id(data) or key
+            ts = _frame_time_ms(data)
+            if ts is not None and args.speed > 0:
+                now = loop.time()
+                if ts0 is None:
+                    t0, ts0 = now, ts
+                due = t0 + (ts - ts0) / 1000 / args.speed
+                if due - now > args.max_gap_s:
+                    # dlhé prestávky (offline úseky, noc) sa skrátia, ďalšie rámce
+                    # si zachovajú vzájomné časovanie
+                    t0 -= due - now - args.max_gap_s
+                    due = now + args.max_gap_s
+                if due > now:
+                    await asyncio.sleep(due - now)
+                else:
+                    send_lag.add(now - due)
+            ids = _measurement_ids(data)
+            frame = line.rstrip(b"\r\n").decode("utf-8", "replace")
+            try:
+                conn = await connection(key)
+                if data.get("type") == "session_summary":
+                    task = asyncio.ensure_future(finish(conns.pop(key), frame))
+                    closing.add(task)
+                    task.add_done_callback(closing.discard)
+                else:
+                    await conn.send(frame, ids, data.get("type"))
+            except Exception as e:
+                stats["errors"] += 1
+                log.warning("Replay send failed for session %s: %s", key, e)
+                continue
+            stats["frames"] += 1
+            stats["measurements"] += len(ids)
+            if progress.due():
+                progress.report(stats, f"  acked {stats['acked']}  "
+                                       f"connections {len(conns)}")
+        elapsed = time.monotonic() - progress.t0
+    await asyncio.gather(*(c.close(args.ack_timeout) for c in conns.values()), *closing)
+    return {
+        "capture": args.capture, "url": args.ws, "speed": args.speed,
+        "elapsed_s": round(elapsed, 3),
+        "frames_per_s": round(stats["frames"] / max(elapsed, 1e-9)),
+        **stats, "ack_latency_ms": ack_latency.summary_ms(),
+        "send_lag_ms": send_lag.summary_ms(),
+    }
+
+
+def parse_args(argv: Optional[Sequence[str]] = None):
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("capture", help="JSONL (.gz/.bz2/.xz) s rámcami; '-' = stdin")
+    ap.add_argument("--offset", type=int, default=0,
+                    help="začať od bajtu v rozbalenom prúde (začiatok riadku)")
+    ap.add_argument("--state", help="súbor s checkpointom (offset) pre --resume")
+    ap.add_argument("--resume", action="store_true", help="pokračovať od checkpointu v --state")
+    ap.add_argument("--limit", type=int, default=0, help="max. počet riadkov (0 = všetky)")
+    ap.add_argument("--progress-s", type=float, default=5.0,
+                    help="interval výpisu priebehu a checkpointu v s (0 = len na konci)")
+    ap.add_argument("--backend", choices=["sqlalchemy", "asyncpg", "memory"], default=DB_BACKEND,
+                    help="repository pre zápis (predvolene DB_BACKEND; asyncpg je najrýchlejší)")
+    ap.add_argument("--workers", type=int, default=WORKER_COUNT, help="paralelné shardy zápisu")
+    ap.add_argument("--batch-size", type=int, default=max(BATCH_SIZE, 2000),
+                    help="max. meraní v jednej DB dávke")
+    ap.add_argument("--ws", help="prehrať na bežiaci server (ws://host:port/ws) namiesto DB")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="zrýchlenie pôvodného časovania pri --ws (0 = bez čakania)")
+    ap.add_argument("--max-gap-s", type=float, default=10.0,
+                    help="dlhšie prestávky v zázname sa pri --ws skrátia na N s")
+    ap.add_argument("--ack-timeout", type=float, default=10.0,
+                    help="pri --ws čakať na zvyšné ACK, kým neprídu N s žiadne")
+    args = ap.parse_args(argv)
+    if args.resume and not args.state:
+        ap.error("--resume requires --state")
+    if args.resume and args.ws:
+        ap.error("--resume is only for DB backfill; use --offset with --ws")
+    return args
+
+
+async def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    result = await (replay(args) if args.ws else backfill(args))
+    print(json.dumps(result, ensure_ascii=False), flush=True)
+    return 1 if result.get("failed") or result.get("errors") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
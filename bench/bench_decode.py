@@ -0,0 +1,96 @@
+# bench_decode.py
+"""
+Micro-benchmark: pôvodná cesta (json.loads + _extract_fields) vs.
+decoding.decode_frame (msgspec, schéma len so stĺpcami Measurement).
+
+    python bench/bench_decode.py -n 50000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dbhandler import ROW_KEY, _extract_fields  # noqa: E402
+from decoding import decode_frame  # noqa: E402
+
+
+def make_payload(i: int) -> dict:
+    rnd = random.Random(i)
+    return {
+        "type": "measurement",
+        "id": f"{1700000000000 + i}-{rnd.getrandbits(32):08x}",
+        "session_id": f"sess-{i % 50}",
+        "timestamp_sent": 1700000000000 + i,
+        "outage": rnd.random() < 0.05,
+        "radio": {
+            "rsrp": rnd.randint(-120, -70), "rsrq": rnd.randint(-20, -3),
+            "sinr": rnd.randint(-5, 30), "cell_id": rnd.randint(1, 10**9),
+            "network_type": "LTE", "network_mode": "NSA", "lte_rssi": "-61",
+            "cgi": "231-02-1234-5678", "serving_time_ms": 12345, "band": "B20",
+            "bandwidth_khz": 10000,
+            "neighbors": [
+                {"cell_id": 11, "level": -101, "qual": -12},
+                {"cellId": 12, "rsrp": "-105", "rsrq": None, "Qual": -14},
+                {"cid": 13, "Level": -110},
+                {"CellID": 14, "level": -115},
+            ],
+        },
+        "position": {"lat": 48.1 + rnd.random(), "lon": 17.1 + rnd.random(), "speed_kmh": 95.2},
+        "device": {"operator": "O2", "device_id": "TEST_" + uuid.uuid4().hex[:8]},
+        "v2x": {"kind": "BSM", "payload": {"speed_kmh": 95.2, "heading_deg": 182.4,
+                                           "path": [[rnd.random(), rnd.random()] for _ in range(10)]}},
+        "rtt_updates": [{"id": f"x-{j}", "rtt_ms": rnd.random() * 100} for j in range(20)],
+    }
+
+
+def old_path(raw: str) -> dict:
+    return _extract_fields(json.loads(raw))
+
+
+def new_path(raw: str) -> dict:
+    return _extract_fields(decode_frame(raw))
+
+
+def bench(fn, frames, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for raw in frames:
+            fn(raw)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("-n", type=int, default=20000, help="počet rámcov")
+    ap.add_argument("-r", "--rounds", type=int, default=5, help="opakovania (berie sa najlepšie)")
+    args = ap.parse_args()
+
+    # logovanie by prekrylo samotné dekódovanie
+    logging.disable(logging.INFO)
+
+    frames = [json.dumps(make_payload(i), separators=(",", ":")) for i in range(args.n)]
+
+    # výsledok musí byť identický so _extract_fields
+    for raw in frames[:1000]:
+        expected = old_path(raw)
+        got = decode_frame(raw)[ROW_KEY]
+        assert got == expected, (expected, got)
+
+    old = bench(old_path, frames, args.rounds)
+    new = bench(new_path, frames, args.rounds)
+    print(f"frames={args.n} avg_bytes={sum(map(len, frames)) // len(frames)}")
+    print(f"json.loads + _extract_fields : {old / args.n * 1e6:8.2f} us/frame")
+    print(f"decode_frame (msgspec)       : {new / args.n * 1e6:8.2f} us/frame")
+    print(f"speedup                      : {old / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# bench_gateway.py
+"""
+Škálovanie ingestu cez viac procesov: pre každý počet procesov spustí buď
+writer.py + N gateway procesov (INGEST_MODE=gateway), alebo pre porovnanie
+N samostatných in-process uvicorn workerov, pustí na ne loadgen (--backend
+external) a zmeria priepustnosť, latenciu ACK, počet perzistovaných riadkov
+a maximum DB spojení (pg_stat_activity) počas behu.
+
+    python bench/bench_gateway.py --workers 1,2,4 --mode gateway,inprocess \\
+        --sessions 200 --rate 5 --duration 15
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(__file__))
+
+from sqlalchemy import text  # noqa: E402
+
+import dbhandler  # noqa: E402
+import loadgen  # noqa: E402
+
+
+def spawn(mode: str, workers: int, port: int, sock: str) -> List[subprocess.Popen]:
+    env = dict(os.environ, LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"))
+    uvicorn = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning", "--workers", str(workers)]
+    if mode == "inprocess":
+        return [subprocess.Popen(uvicorn, cwd=ROOT, env=dict(env, INGEST_MODE="inprocess"))]
+    env.update(WRITER_SOCKET=sock, WRITER_METRICS_PORT="0")
+    writer = subprocess.Popen([sys.executable, "writer.py"], cwd=ROOT, env=env)
+    gateways = subprocess.Popen(uvicorn, cwd=ROOT, env=dict(env, INGEST_MODE="gateway"))
+    # gatewaye zastaviť skôr ako writer
+    return [gateways, writer]
+
+
+def terminate(procs: List[subprocess.Popen]) -> None:
+    for p in procs:
+        p.send_signal(signal.SIGTERM)
+        try:
+            p.wait(30)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+
+async def wait_ready(port: int, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /health HTTP/1.0\r\n\r\n")
+            await writer.drain()
+            status = await reader.readline()
+            writer.close()
+            if b" 200 " in status:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"server on port {port} not ready")
+
+
+async def count_rows(engine) -> int:
+    async with engine.connect() as c:
+        return (await c.execute(text(
+            "SELECT count(*) FROM measurements WHERE \"SessionId\" LIKE 'LOAD\\_%'"))).scalar()
+
+
+async def sample_connections(engine, peak: Dict[str, int], stop: asyncio.Event) -> None:
+    """Maximum spojení do našej DB okrem vlastného (vzorkuje sa každých 100 ms)."""
+    async with engine.connect() as c:
+        while not stop.is_set():
+            n = (await c.execute(text(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE datname = current_database() AND pid <> pg_backend_pid()"))).scalar()
+            peak["max"] = max(peak["max"], n)
+            try:
+                await asyncio.wait_for(stop.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def settle(engine, expected: int, quiet: float = 10.0, timeout: float = 120.0) -> int:
+    """
+    Počká, kým sú v DB všetky ACK-nuté riadky, alebo kým sa počet `quiet`
+    sekúnd nezmení (dávka sa commituje naraz, počet teda rastie skokmi).
+    """
+    last, changed = -1, time.monotonic()
+    deadline = changed + timeout
+    while time.monotonic() < deadline:
+        n = await count_rows(engine)
+        if n >= expected:
+            return n
+        if n != last:
+            last, changed = n, time.monotonic()
+        elif time.monotonic() - changed >= quiet:
+            break
+        await asyncio.sleep(0.5)
+    return last
+
+
+async def run_one(mode: str, workers: int, args) -> Dict[str, Any]:
+    engine = dbhandler.get_engine()
+    procs = spawn(mode, workers, args.port, args.socket)
+    try:
+        await wait_ready(args.port)
+        before = await count_rows(engine)
+        peak, stop = {"max": 0}, asyncio.Event()
+        sampler = asyncio.create_task(sample_connections(engine, peak, stop))
+        lg = loadgen.parse_args([
+            "--backend", "external", "--url", f"ws://127.0.0.1:{args.port}/ws",
+            "--sessions", str(args.sessions), "--rate", str(args.rate),
+            "--duration", str(args.duration), "--ramp", str(args.ramp)])
+        result = await loadgen.main_async(lg)
+        persisted = await settle(engine, before + result["acked"]) - before
+        stop.set()
+        await sampler
+    finally:
+        terminate(procs)
+    lat = result["ack_latency_ms"]
+    return {"mode": mode, "workers": workers, "msgs_per_s": result["msgs_per_s"],
+            "acked": result["acked"], "persisted": persisted, "errors": result["errors"],
+            "p50": lat["p50"], "p99": lat["p99"], "db_conns": peak["max"]}
+
+
+async def main_async(args) -> None:
+    rows = []
+    for mode in args.mode.split(","):
+        for workers in (int(w) for w in args.workers.split(",")):
+            rows.append(await run_one(mode, workers, args))
+    await dbhandler.get_engine().dispose()
+    print(f"{'mode':10s} {'procs':>5s} {'msg/s':>9s} {'acked':>8s} {'persisted':>9s} "
+          f"{'errors':>6s} {'ack p50':>9s} {'ack p99':>9s} {'db conns':>8s}")
+    for r in rows:
+        print(f"{r['mode']:10s} {r['workers']:5d} {r['msgs_per_s']:9.1f} {r['acked']:8d} "
+              f"{r['persisted']:9d} {r['errors']:6d} {r['p50'] or 0:9.1f} {r['p99'] or 0:9.1f} "
+              f"{r['db_conns']:8d}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", default="1,2,4", help="počty procesov oddelené čiarkou")
+    ap.add_argument("--mode", default="gateway,inprocess", help="gateway a/alebo inprocess")
+    ap.add_argument("--sessions", type=int, default=200)
+    ap.add_argument("--rate", type=float, default=5.0, help="meraní za sekundu na session")
+    ap.add_argument("--duration", type=float, default=15.0)
+    ap.add_argument("--ramp", type=float, default=2.0)
+    ap.add_argument("--port", type=int, default=8030)
+    ap.add_argument("--socket", default="/tmp/drivetest-bench-writer.sock")
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# bench_kpi.py
+"""
+KPI engine (kpi.KpiReader): vloží syntetickú session s N riadkami (generate_series
+priamo v DB), zmeria studený výpočet (COPY + pyarrow + NumPy), odpoveď z cache
+a pre porovnanie výpočet riadok po riadku v Pythone (ako v notebooku) nad
+prvými --baseline-rows riadkami; na nich overí, že výsledky sa zhodujú.
+
+    python bench/bench_kpi.py --rows 2000000 --baseline-rows 200000
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pyarrow as pa  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+import dbhandler  # noqa: E402
+import kpi  # noqa: E402
+
+# ~70 % LTE/B3, zvyšok NR/n78 v blokoch; bunka sa mení každých 500 meraní;
+# výpadok 20 s každých 5000 meraní; RTT chýba pri každom 3., CellID pri každom 97.
+_INSERT = """
+INSERT INTO measurements ("Id", "SessionId", "Timestamp", "Latitude", "Longitude", "Speed",
+    "Level", "Qual", "SNR", "CellID", "NetworkTech", "BAND", "Outage", "RTT_ms")
+SELECT :sid || '-' || i, :sid, 1700000000000 + i * 1000 + (i % 7) * 10,
+    48.1 + i * 1e-5 * sin(i / 5000.0), 17.1 + i * 1e-5 * cos(i / 5000.0), 15,
+    -80 - (i * 7919 % 41), -10 - (i * 104729 % 11), (i * 1299709 % 31) - 5,
+    CASE WHEN i % 97 = 0 THEN NULL ELSE 1000 + i / 500 END,
+    CASE WHEN i % 1000 < 700 THEN 'LTE' ELSE 'NR' END,
+    CASE WHEN i % 1000 < 700 THEN 'B3' ELSE 'n78' END,
+    CASE WHEN i % 5000 < 20 THEN true WHEN i % 5000 = 20 THEN false END,
+    CASE WHEN i % 3 = 0 THEN NULL ELSE 15 + (i * 31 % 90) + (i % 11) / 10.0 END
+FROM generate_series(0::bigint, :n - 1) AS i
+"""
+
+
+async def prepare(engine, sid: str, rows: int) -> None:
+    async with engine.begin() as c:
+        have = (await c.execute(text('SELECT count(*) FROM measurements WHERE "SessionId" = :sid'),
+                                {"sid": sid})).scalar()
+        if have == rows:
+            return
+        await c.execute(text('DELETE FROM measurements WHERE "SessionId" = :sid'), {"sid": sid})
+        t0 = time.perf_counter()
+        await c.execute(text(_INSERT), {"sid": sid, "n": rows})
+    print(f"inserted {rows} rows in {time.perf_counter() - t0:.1f} s")
+    async with engine.connect() as c:
+        c = await c.execution_options(isolation_level="AUTOCOMMIT")
+        await c.execute(text("VACUUM ANALYZE measurements"))
+
+
+def row_by_row(rows: Sequence[Tuple[Any, ...]], max_gap_ms: int,
+               max_speed_kmh: float) -> Dict[str, Any]:
+    """Rovnaké KPI slučkou cez riadky (stĺpce v poradí kpi.COLUMNS)."""
+    rows = sorted(rows, key=lambda r: r[0])
+    rsrp: List[float] = []
+    rtt: List[float] = []
+    tech_ms: Dict[Any, int] = {}
+    handovers, last_cell = 0, None
+    outages, outage_ms, since = 0, 0, None
+    dist, last_fix = 0.0, None
+    for i, (ts, lat, lon, level, _, _, cell, tech, _, outage, rtt_ms) in enumerate(rows):
+        if level is not None:
+            rsrp.append(level)
+        if rtt_ms is not None:
+            rtt.append(rtt_ms)
+        dt = rows[i + 1][0] - ts if i + 1 < len(rows) else 0
+        tech_ms[tech] = tech_ms.get(tech, 0) + (dt if dt <= max_gap_ms else 0)
+        if cell is not None:
+            if last_cell is not None and cell != last_cell:
+                handovers += 1
+            last_cell = cell
+        if outage and since is None:
+            since, outages = ts, outages + 1
+        elif outage is False and since is not None:
+            outage_ms += ts - since
+            since = None
+        if lat is not None and lon is not None and (lat, lon) != (0, 0):
+            if last_fix is not None:
+                t0, la0, lo0 = last_fix
+                p0, p1 = math.radians(la0), math.radians(lat)
+                a = (math.sin((p1 - p0) / 2) ** 2 + math.cos(p0) * math.cos(p1)
+                     * math.sin(math.radians(lon - lo0) / 2) ** 2)
+                d = 2 * 6371008.8 * math.asin(math.sqrt(min(a, 1.0)))
+                if d <= max_speed_kmh / 3.6 * (ts - t0) / 1000:
+                    dist += d
+            last_fix = (ts, lat, lon)
+    if since is not None:
+        outage_ms += rows[-1][0] - since
+    rsrp.sort()
+    rtt.sort()
+    return {"rsrp_p50": _median(rsrp), "rtt_p50": _median(rtt), "tech_ms": tech_ms,
+            "handovers": handovers, "outages": outages, "outage_ms": outage_ms,
+            "distance_m": round(dist, 1)}
+
+
+def _median(xs: List[float]) -> float:
+    n = len(xs)
+    return float(xs[n // 2]) if n % 2 else (xs[n // 2 - 1] + xs[n // 2]) / 2
+
+
+def same(vec: Dict[str, Any], ref: Dict[str, Any]) -> bool:
+    return (vec["rsrp"]["p50"] == ref["rsrp_p50"]
+            and math.isclose(vec["rtt"]["p50"], ref["rtt_p50"], abs_tol=1e-3)
+            and {t["value"]: t["ms"] for t in vec["network_tech"]} == ref["tech_ms"]
+            and vec["handovers"]["count"] == ref["handovers"]
+            and vec["outages"]["count"] == ref["outages"]
+            and vec["outages"]["total_ms"] == ref["outage_ms"]
+            and math.isclose(vec["distance"]["m"], ref["distance_m"], abs_tol=1.0))
+
+
+async def main_async(args) -> None:
+    engine = dbhandler.get_engine()
+    await prepare(engine, args.session, args.rows)
+
+    cold = []
+    for _ in range(args.repeat):
+        reader = kpi.KpiReader(engine, kpi.KpiCache())
+        t0 = time.perf_counter()
+        res = await reader.get(args.session)
+        cold.append((time.perf_counter() - t0, res["load_ms"], res["compute_ms"]))
+    best = min(cold)
+    print(f"vectorised  {res['rows']:9d} rows: {best[0]:6.2f} s  (COPY {best[1] / 1000:.2f} s, "
+          f"parse + NumPy {best[2] / 1000:.2f} s)  {res['rows'] / best[0]:10.0f} rows/s")
+    data = await reader._copy(args.session)
+    t0 = time.perf_counter()
+    cols = kpi.columns(kpi.read_copy_csv(data))
+    t_parse = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    kpi.compute(cols)
+    t_numpy = time.perf_counter() - t0
+    print(f"            CSV -> NumPy columns {t_parse:.2f} s, KPI compute {t_numpy:.2f} s "
+          f"({res['rows'] / t_numpy:.0f} rows/s)")
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        await reader.get(args.session)
+    print(f"cached      {(time.perf_counter() - t0) * 1000:.3f} µs / request")
+
+    # notebook: SELECT cez driver (riadok = Python objekt) a slučka cez riadky
+    n = min(args.baseline_rows, args.rows)
+    t0 = time.perf_counter()
+    async with engine.connect() as c:
+        rows = (await c.execute(text(
+            "SELECT " + ", ".join(f'"{col}"' for col in kpi.COLUMNS) + " FROM measurements "
+            'WHERE "SessionId" = :sid ORDER BY "Timestamp" LIMIT :n'),
+            {"sid": args.session, "n": n})).all()
+    t_fetch = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    ref = row_by_row(rows, kpi.KPI_MAX_GAP_MS, kpi.KPI_MAX_SPEED_KMH)
+    t_loop = time.perf_counter() - t0
+    print(f"row-by-row  {n:9d} rows: {t_fetch + t_loop:6.2f} s  (SELECT {t_fetch:.2f} s, "
+          f"loop {t_loop:.2f} s)  {n / (t_fetch + t_loop):10.0f} rows/s")
+    # rovnaké riadky vektorovo -> kontrola zhody výsledkov
+    vec = kpi.kpis_from_table(pa.table({c: [r[i] for r in rows] for i, c in enumerate(kpi.COLUMNS)}))
+    print(f"speedup     {res['rows'] / best[0] / (n / (t_fetch + t_loop)):.1f}x end-to-end, "
+          f"{res['rows'] / t_numpy / (n / t_loop):.1f}x compute; "
+          f"results match: {same(vec, ref)}")
+
+    if not args.keep:
+        async with engine.begin() as c:
+            await c.execute(text('DELETE FROM measurements WHERE "SessionId" = :sid'),
+                            {"sid": args.session})
+    await engine.dispose()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=2_000_000, help="riadkov syntetickej session")
+    ap.add_argument("--baseline-rows", type=int, default=200_000,
+                    help="riadkov pre porovnanie s výpočtom riadok po riadku")
+    ap.add_argument("--repeat", type=int, default=3, help="opakovaní studeného výpočtu")
+    ap.add_argument("--session", default="KPI_BENCH")
+    ap.add_argument("--keep", action="store_true", help="nezmazať session po behu")
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# bench_queue_memory.py
+"""
+Pamäť jednej položky vo fronte workera: čo fronta držala doteraz
+(json.loads dict / štíhly dict z decode_frame) vs. records.compact.
+Meria sa tracemalloc-om (skutočne alokované bajty na položku) a porovná
+s odhadom nbytes, z ktorého počíta bajtový limit fronty.
+
+    python bench/bench_queue_memory.py -n 20000
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bench_decode import make_payload  # noqa: E402
+from decoding import decode_frame  # noqa: E402
+from records import compact  # noqa: E402
+
+
+def retained(build, frames) -> float:
+    """Bajty na položku, ktoré ostanú alokované, kým sú všetky položky v zozname."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [build(raw) for raw in frames]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    n = len(items)
+    del items
+    return (after - before) / n
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("-n", type=int, default=20000, help="počet rámcov")
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+
+    frames = [json.dumps(make_payload(i), separators=(",", ":")) for i in range(args.n)]
+    # odhad nbytes pre bajtový limit
+    est = sum(compact(decode_frame(raw)).nbytes for raw in frames) / args.n
+
+    full = retained(json.loads, frames)
+    slim = retained(decode_frame, frames)
+    rec = retained(lambda raw: compact(decode_frame(raw)), frames)
+    print(f"frames={args.n} avg_bytes={sum(map(len, frames)) // len(frames)} "
+          "(device, v2x.payload, 4 susedia, 20 rtt_updates)")
+    print(f"json.loads dict (generická cesta) : {full:8.0f} B/item")
+    print(f"decode_frame dict (doterajšia)    : {slim:8.0f} B/item")
+    print(f"records.compact                   : {rec:8.0f} B/item "
+          f"({slim / rec:.1f}x menej ako decode_frame dict)")
+    print(f"odhad nbytes (bajtový limit)      : {est:8.0f} B/item")
+
+
+if __name__ == "__main__":
+    main()
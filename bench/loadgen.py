@@ -0,0 +1,353 @@
+# loadgen.py
+"""
+Záťažový generátor pre /ws: simuluje veľa súbežných drive sessions a meria
+priepustnosť, latenciu ACK a oneskorenie perzistencie.
+
+Režimy (--backend):
+  memory    server beží v tomto procese s InMemoryRepository (bez Postgresu)
+  postgres  server beží v tomto procese s PostgresRepository (DATABASE_URL)
+  asyncpg   ako postgres, ale s AsyncpgRepository
+  external  server už beží inde (--url); perzistenčný lag sa nemeria
+
+Príklad:
+    python bench/loadgen.py --backend memory --sessions 2000 --rate 2 \\
+        --duration 30 --out bench/results/$(git rev-parse --short HEAD).json
+    python bench/loadgen.py --compare old.json new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import msgspec
+import websockets
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+SUBPROTOCOL_MSGPACK = "drivetest.msgpack"
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.sent = 0
+        self.acked = 0
+        self.retries = 0
+        self.slow_downs = 0
+        self.reconnects = 0
+        self.errors = 0
+        self.ack_latency: List[float] = []
+        # id -> čas prijatia ACK (perf_counter), pre perzistenčný lag
+        self.acked_at: Dict[str, float] = {}
+
+
+class TimedRepo:
+    """Obal repository, ktorý si zapamätá čas commitu každého merania."""
+
+    def __init__(self, repo: Any) -> None:
+        self._repo = repo
+        self.committed_at: Dict[str, float] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._repo, name)
+
+    async def insert_measurements_flat(self, payloads, rtts=None):
+        n = await self._repo.insert_measurements_flat(payloads, rtts)
+        now = time.perf_counter()
+        for p in payloads:
+            self.committed_at.setdefault(str(p.get("id")), now)
+        return n
+
+    async def insert_measurement_flat(self, payload, rtt_ms=None):
+        n = await self._repo.insert_measurement_flat(payload, rtt_ms)
+        self.committed_at.setdefault(str(payload.get("id")), time.perf_counter())
+        return n
+
+
+def make_measurement(session_id: str, rtt_updates: List[Dict[str, Any]], args) -> Dict[str, Any]:
+    mid = f"{int(time.time() * 1000)}-{secrets.token_hex(6)}"
+    neighbors = [{"cell_id": 1000 + i, "level": -100 - i, "qual": -12}
+                 for i in range(args.neighbors)]
+    m = {
+        "type": "measurement",
+        "id": mid,
+        "session_id": session_id,
+        "timestamp_sent": int(time.time() * 1000),
+        "radio": {"rsrp": random.randint(-120, -70), "rsrq": random.randint(-20, -3),
+                  "sinr": random.randint(-5, 30), "cell_id": random.randint(1, 10**6),
+                  "network_type": "LTE", "band": "B20", "neighbors": neighbors},
+        "position": {"lat": 48.1 + random.random(), "lon": 17.1 + random.random(),
+                     "speed_kmh": random.random() * 130},
+        "device": {"operator": "O2", "device_id": session_id},
+        "rtt_updates": rtt_updates[-args.rtt_window:] if args.rtt_window > 0 else [],
+    }
+    if args.v2x_bytes > 0:
+        m["v2x"] = {"kind": "BSM", "payload": "x" * args.v2x_bytes}
+    return m
+
+
+async def run_session(n: int, args, stats: Stats, deadline: float) -> None:
+    session_id = f"LOAD_{n:05d}_{secrets.token_hex(3)}"
+    msgpack = args.encoding == "msgpack"
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    rtt_outbox: List[Dict[str, Any]] = []
+    # id -> (čas odoslania, rámec) pre ešte neACKnuté rámce (replay po reconnecte)
+    inflight: Dict[str, tuple] = {}
+
+    def encode(obj):
+        return msgspec.msgpack.encode(obj) if msgpack else msgspec.json.encode(obj).decode()
+
+    await asyncio.sleep(random.random() * args.ramp)
+    while time.perf_counter() < deadline:
+        conn_deadline = deadline
+        if args.reconnect_every > 0:
+            conn_deadline = min(deadline, time.perf_counter()
+                                + random.expovariate(1.0 / args.reconnect_every))
+        try:
+            async with websockets.connect(
+                args.url, compression="deflate" if args.compress else None,
+                subprotocols=[SUBPROTOCOL_MSGPACK] if msgpack else None,
+                max_queue=None, open_timeout=30,
+            ) as ws:
+                paused_until = [0.0]
+
+                async def reader():
+                    async for raw in ws:
+                        msg = msgspec.msgpack.decode(raw) if isinstance(raw, bytes) \
+                            else msgspec.json.decode(raw)
+                        t = msg.get("type")
+                        now = time.perf_counter()
+                        if t in ("measurement_ack", "measurement_batch_ack"):
+                            ids = msg.get("ids") or [msg.get("id")]
+                            for mid in ids:
+                                sent = inflight.pop(mid, None)
+                                if sent is not None:
+                                    stats.acked += 1
+                                    stats.ack_latency.append(now - sent[0])
+                                    stats.acked_at.setdefault(mid, now)
+                                    rtt_outbox.append({"id": mid, "rtt_ms": (now - sent[0]) * 1000})
+                            del rtt_outbox[:-max(100, args.rtt_window)]
+                        elif t == "retry_after":
+                            stats.retries += 1
+                            paused_until[0] = now + msg.get("retry_after_ms", 1000) / 1000
+                            for mid in msg.get("ids") or [msg.get("id")]:
+                                sent = inflight.get(mid)
+                                if sent is not None:
+                                    # znova pošle sender po uplynutí pauzy
+                                    inflight[mid] = (sent[0], sent[1], True)
+                        elif t == "slow_down":
+                            stats.slow_downs += 1
+                            paused_until[0] = now + msg.get("retry_after_ms", 1000) / 1000
+
+                rtask = asyncio.create_task(reader())
+                try:
+                    # po reconnecte najprv replay neACKnutých rámcov (duplicity sú OK)
+                    for mid, (_, frame, *_rest) in list(inflight.items()):
+                        await ws.send(frame)
+                    nxt = time.perf_counter()
+                    while time.perf_counter() < conn_deadline:
+                        now = time.perf_counter()
+                        if now < paused_until[0]:
+                            await asyncio.sleep(paused_until[0] - now)
+                            continue
+                        for mid, entry in list(inflight.items()):
+                            if len(entry) > 2:
+                                inflight[mid] = entry[:2]
+                                await ws.send(entry[1])
+                        if args.batch > 0:
+                            items = [make_measurement(session_id, rtt_outbox if i == 0 else [], args)
+                                     for i in range(args.batch)]
+                            frame = encode({"type": "measurement_batch",
+                                            "session_id": session_id, "items": items})
+                        else:
+                            items = [make_measurement(session_id, rtt_outbox, args)]
+                            frame = encode(items[0])
+                        t_send = time.perf_counter()
+                        for it in items:
+                            inflight[it["id"]] = (t_send, frame)
+                        await ws.send(frame)
+                        stats.sent += len(items)
+                        if interval > 0:
+                            nxt += interval * max(1, args.batch)
+                            await asyncio.sleep(max(0.0, nxt - time.perf_counter()))
+                        else:
+                            await asyncio.sleep(0)
+                    # krátko počkať na posledné ACK
+                    t_end = time.perf_counter() + 2.0
+                    while inflight and time.perf_counter() < t_end and conn_deadline >= deadline:
+                        await asyncio.sleep(0.05)
+                finally:
+                    rtask.cancel()
+        except Exception:
+            stats.errors += 1
+            await asyncio.sleep(0.5)
+        if time.perf_counter() < deadline:
+            stats.reconnects += 1
+
+
+def _pct(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def _summary_ms(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": _ms(_pct(values, 50)),
+        "p99": _ms(_pct(values, 99)),
+        "p999": _ms(_pct(values, 99.9)),
+        "max": _ms(max(values) if values else None),
+    }
+
+
+def _ms(v: Optional[float]) -> Optional[float]:
+    return round(v * 1000.0, 3) if v is not None else None
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_inprocess_server(args):
+    """Spustí app:app v tomto procese (uvicorn) a vráti (server, task, TimedRepo)."""
+    os.environ["DB_BACKEND"] = {"postgres": "sqlalchemy"}.get(args.backend, args.backend)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("MEMREPO_COMMIT_LATENCY_MS", str(args.mem_latency_ms))
+    import uvicorn
+    import app as app_module
+
+    timed = TimedRepo(app_module.repo)
+    app_module.processor.repo = timed
+    port = _free_port()
+    config = uvicorn.Config(app_module.app, host="127.0.0.1", port=port,
+                            log_level="warning", ws_max_queue=1024)
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    args.url = f"ws://127.0.0.1:{port}/ws"
+    return server, task, timed, app_module
+
+
+async def main_async(args) -> Dict[str, Any]:
+    server = task = timed = app_module = None
+    if args.backend != "external":
+        server, task, timed, app_module = await start_inprocess_server(args)
+
+    stats = Stats()
+    t0 = time.perf_counter()
+    deadline = t0 + args.ramp + args.duration
+    await asyncio.gather(*(run_session(n, args, stats, deadline) for n in range(args.sessions)))
+    elapsed = time.perf_counter() - t0
+
+    persist: List[float] = []
+    if timed is not None:
+        # počkať, kým worker dopíše všetko prijaté
+        await asyncio.wait_for(
+            asyncio.gather(*(q.join() for q in app_module.processor.queues)), 60)
+        for mid, t_ack in stats.acked_at.items():
+            t_commit = timed.committed_at.get(mid)
+            if t_commit is not None:
+                persist.append(max(0.0, t_commit - t_ack))
+        server.should_exit = True
+        await task
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": int(time.time()),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "elapsed_s": round(elapsed, 3),
+        "sent": stats.sent,
+        "acked": stats.acked,
+        "msgs_per_s": round(stats.acked / elapsed, 1) if elapsed > 0 else 0,
+        "retries": stats.retries,
+        "slow_downs": stats.slow_downs,
+        "reconnects": stats.reconnects,
+        "errors": stats.errors,
+        "ack_latency_ms": _summary_ms(stats.ack_latency),
+        "persist_lag_ms": _summary_ms(persist) if timed is not None else None,
+        "persisted": len(timed.committed_at) if timed is not None else None,
+    }
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'metric':28s} {'old':>12s} {'new':>12s} {'delta':>9s}")
+
+    def row(name, a, b):
+        if a is None or b is None:
+            return
+        d = (b - a) / a * 100.0 if a else 0.0
+        print(f"{name:28s} {a:12.3f} {b:12.3f} {d:+8.1f}%")
+
+    row("msgs_per_s", old["msgs_per_s"], new["msgs_per_s"])
+    for key in ("ack_latency_ms", "persist_lag_ms"):
+        for p in ("p50", "p99", "p999"):
+            row(f"{key}.{p}", (old.get(key) or {}).get(p), (new.get(key) or {}).get(p))
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--backend", choices=["memory", "postgres", "asyncpg", "external"],
+                    default="memory")
+    ap.add_argument("--url", default="ws://127.0.0.1:8000/ws", help="pre --backend external")
+    ap.add_argument("--sessions", type=int, default=200, help="počet súbežných sessions")
+    ap.add_argument("--rate", type=float, default=2.0,
+                    help="meraní za sekundu na session (0 = čo najrýchlejšie)")
+    ap.add_argument("--duration", type=float, default=20.0, help="trvanie v sekundách")
+    ap.add_argument("--ramp", type=float, default=2.0, help="rozloženie štartu sessions (s)")
+    ap.add_argument("--batch", type=int, default=0, help="measurement_batch po N (0 = po jednom)")
+    ap.add_argument("--rtt-window", type=int, default=20, help="počet rtt_updates v rámci")
+    ap.add_argument("--neighbors", type=int, default=3, help="počet susedných buniek v payloade")
+    ap.add_argument("--v2x-bytes", type=int, default=0, help="veľkosť v2x payloadu (bytes)")
+    ap.add_argument("--encoding", choices=["json", "msgpack"], default="json")
+    ap.add_argument("--compress", action="store_true", help="permessage-deflate")
+    ap.add_argument("--reconnect-every", type=float, default=0.0,
+                    help="priemerný čas medzi reconnectami session (s, 0 = nikdy)")
+    ap.add_argument("--mem-latency-ms", type=float, default=0.0,
+                    help="simulovaný čas commitu pre --backend memory")
+    ap.add_argument("--out", help="zapísať výsledky ako JSON")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                    help="porovnať dva výsledkové JSON súbory a skončiť")
+    return ap.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    result = asyncio.run(main_async(args))
+    print(json.dumps(result, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy import text
 from models import Base
 from dbhandler import _ensure_asyncpg, DATABASE_URL
+from partitions import PARTITION_INTERVAL, PartitionManager
+import tiles
 
 
 async def main():
@@ -13,26 +15,38 @@ async def main():
     parser.add_argument("--recreate", action="store_true",
                         help="Drop and recreate all tables (DESTRUCTIVE).")
     parser.add_argument("--truncate", action="store_true",
-                        help="TRUNCATE TABLE measurements after ensuring schema.")
+                        help="TRUNCATE TABLE measurements (and coverage_tiles) after ensuring schema.")
+    parser.add_argument("--partition", choices=["none", "daily", "weekly"],
+                        default=PARTITION_INTERVAL,
+                        help="Range-partition measurements by Timestamp; an existing "
+                             "unpartitioned table is migrated (default: MEASUREMENTS_PARTITION).")
+    parser.add_argument("--rebuild-tiles", action="store_true",
+                        help="Recompute coverage_tiles from all measurements (TILE_ZOOMS).")
     args = parser.parse_args()
 
     dsn = _ensure_asyncpg(os.getenv("DATABASE_URL", DATABASE_URL))
     engine = create_async_engine(dsn)
 
-    async with engine.begin() as conn:
-        if args.recreate:
+    if args.recreate:
+        async with engine.begin() as conn:
             print("DROP ALL (entire metadata)…")
             await conn.run_sync(Base.metadata.drop_all)
-            print("CREATE ALL…")
-            await conn.run_sync(Base.metadata.create_all)
-        else:
 
-            print("CREATE ALL (idempotent; existing data preserved)…")
-            await conn.run_sync(Base.metadata.create_all)
-
-        if args.truncate:
-            print("TRUNCATE measurements…")
-            await conn.execute(text("TRUNCATE TABLE measurements"))
+    print(f"CREATE ALL (idempotent; existing data preserved; partition={args.partition})…")
+    partitions = PartitionManager(engine, interval=args.partition)
+    # vždy plné DDL (aj keď fingerprint sedí) – create_db je manuálny nástroj
+    if await partitions.setup(force=True):
+        print("measurements is partitioned.")
+
+    if args.truncate:
+        async with engine.begin() as conn:
+            # coverage_tiles sú odvodené z measurements
+            print("TRUNCATE measurements, coverage_tiles…")
+            await conn.execute(text("TRUNCATE TABLE measurements, coverage_tiles"))
+
+    if args.rebuild_tiles:
+        print(f"REBUILD coverage_tiles (zooms {list(tiles.TILE_ZOOMS)})…")
+        print(f"{await tiles.rebuild(engine)} tiles.")
 
     await engine.dispose()
     print("Done.")
@@ -1,26 +1,57 @@
 # dbhandler.py
 from __future__ import annotations
-from models import Base, Measurement, SessionStats
+from models import Measurement, SessionStats
+import asyncio
 import os
-from typing import Any, Dict, List, Optional
-from logger import get_logger, setup_logging
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from logger import get_logger, get_hot_logger, setup_logging
+from partitions import PartitionManager, conflict_keys, fill_partition_key
+from rollups import rtt_quantiles
+import tiles
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.engine import make_url
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy import update, text, func
+from sqlalchemy import select, update, text, func, values, column, String, Float
 from dotenv import load_dotenv
 
 
 setup_logging()
 log = get_logger("dbhandler")
+hot_log = get_hot_logger("dbhandler")
 
 load_dotenv()
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Kľúč, pod ktorým decoding.decode_frame prikladá už vytiahnuté stĺpce meraní.
+ROW_KEY = "_row"
+
+# Postgres povolí max. 32767 bind parametrov na jeden príkaz.
+_PG_MAX_PARAMS = 32767
+
+# DB_BACKEND=asyncpg -> priamy asyncpg writer (COPY pre dávky),
+# DB_BACKEND=memory -> bez databázy (benchmarky), inak SQLAlchemy
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlalchemy").lower()
+# Koľko sekúnd pri štarte čakať, kým DB začne odpovedať.
+DB_WAIT_S = float(os.getenv("DB_WAIT_S", "60"))
+# Koľko spojenia poolu sa pri štarte otvorí a zahreje ingest príkazmi (0 = nič).
+DB_PREWARM_CONNECTIONS = int(os.getenv("DB_PREWARM_CONNECTIONS", "4"))
+
+
+def redact_dsn(dsn: Optional[str]) -> str:
+    """DSN bez hesla (na logovanie)."""
+    if not dsn:
+        return str(dsn)
+    try:
+        return make_url(dsn).render_as_string(hide_password=True)
+    except Exception:
+        return "<unparseable DSN>"
+
 
 def _ensure_asyncpg(dsn: str) -> str:
-    log.info("Ensuring asyncpg in DSN: %s", dsn)
     if dsn.startswith("postgresql+asyncpg://"):
         return dsn
     if dsn.startswith("postgresql://"):
@@ -28,54 +59,246 @@ def _ensure_asyncpg(dsn: str) -> str:
     return dsn
 
 
-ASYNC_DSN = _ensure_asyncpg(DATABASE_URL)
-engine = create_async_engine(ASYNC_DSN, pool_size=10, max_overflow=20)
-SessionLocal = async_sessionmaker(
-    engine, class_=AsyncSession, expire_on_commit=False)
+ASYNC_DSN = _ensure_asyncpg(DATABASE_URL) if DATABASE_URL else None
+
+# Engine ingestu sa vytvorí až pri prvom get_engine() (v lifespan), nie pri
+# importe – import modulu nič nepripája ani nezapisuje DSN do logu.
+_engine: Optional[AsyncEngine] = None
+_session_factory: Optional[async_sessionmaker] = None
+
+
+def get_engine() -> AsyncEngine:
+    global _engine, _session_factory
+    if _engine is None:
+        if not ASYNC_DSN:
+            raise RuntimeError("DATABASE_URL is not set")
+        log.info("Creating DB engine for %s", redact_dsn(ASYNC_DSN))
+        _engine = create_async_engine(ASYNC_DSN, pool_size=10, max_overflow=20)
+        _session_factory = async_sessionmaker(
+            _engine, class_=AsyncSession, expire_on_commit=False)
+    return _engine
+
+
+def session_factory() -> async_sessionmaker:
+    get_engine()
+    return _session_factory
+
+
+async def wait_for_db(engine: AsyncEngine, timeout_s: float = DB_WAIT_S) -> None:
+    """Opakuje SELECT 1, kým DB neodpovie (nahrádza čakanie v entrypoint.sh)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_s
+    delay = 0.1
+    while True:
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return
+        except Exception as e:
+            if loop.time() + delay > deadline:
+                raise
+            log.info("DB not ready yet (%s); retrying in %.1fs", type(e).__name__, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2.0)
 
 
 class PostgresRepository:
     def __init__(self) -> None:
-        self._sf = SessionLocal
+        # engine, session factory a PartitionManager vzniknú až v start()
+        self._engine: Optional[AsyncEngine] = None
+        self._sf: Optional[async_sessionmaker] = None
+        self._partitions: Optional[PartitionManager] = None
+        # unikátny kľúč measurements po start() (Id, pri partíciách Id + Timestamp)
+        self.conflict_key = conflict_keys(False)
+        # volané po commite: (novo vložené riadky, [(session_id, rtt_ms)]
+        # RTT doplnené k už existujúcim riadkom); pozri rollups.SessionRollups
+        self.write_listeners: List[Callable] = []
 
     async def start(self) -> None:
-        log.info("Starting PostgresRepository with DSN: %s", ASYNC_DSN)
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+        log.info("Starting PostgresRepository (%s)", redact_dsn(ASYNC_DSN))
+        self._engine = get_engine()
+        self._sf = session_factory()
+        self._partitions = PartitionManager(self._engine)
+        await wait_for_db(self._engine)
+        partitioned = await self._partitions.setup()
+        self.conflict_key = conflict_keys(partitioned)
+        self._partitions.start()
+
+    async def warm_up(self, connections: int = DB_PREWARM_CONNECTIONS) -> int:
+        """
+        Otvorí `connections` spojení poolu naraz a na každom raz vykoná
+        ingest príkazy v transakcii, ktorá sa rollbackne – skompilované
+        príkazy (SQLAlchemy cache) aj prepared statements (asyncpg) sú
+        pripravené ešte pred prvým meraním. Vráti počet zahriatych spojení.
+        """
+        n = min(max(0, connections), self._engine.pool.size())
+        if n == 0:
+            return 0
+        barrier = asyncio.Barrier(n)
+
+        async def warm(k: int) -> None:
+            async with self._sf() as s:
+                try:
+                    rows = _warmup_rows(self._partitions.partitioned, k)
+                    for r in rows:
+                        await _insert_rows(s, [r], self.conflict_key)
+                    await s.execute(
+                        update(Measurement)
+                        .where(Measurement.Id == rows[0]["Id"], Measurement.RTT_ms.is_(None))
+                        .values(RTT_ms=0.0)
+                        .returning(Measurement.SessionId, Measurement.RTT_ms))
+                    # spojenie sa drží, kým ho nemajú všetky – inak by pool vrátil to isté
+                    await barrier.wait()
+                except BaseException:
+                    barrier.abort()
+                    raise
+                finally:
+                    await s.rollback()
+
+        await asyncio.gather(*(warm(k) for k in range(n)))
+        return n
 
     async def stop(self) -> None:
         log.info("Stopping PostgresRepository")
-        await engine.dispose()
+        if self._partitions is not None:
+            await self._partitions.stop()
+        if self._engine is not None:
+            await self._engine.dispose()
+
+    async def ping(self, timeout: float = 1.0) -> bool:
+        """True ak DB odpovie na SELECT 1 do timeout sekúnd."""
+        if self._engine is None:
+            return False
+        try:
+            async with asyncio.timeout(timeout):
+                async with self._engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    def pool_status(self) -> Dict[str, int]:
+        if self._engine is None:
+            return {"checked_out": 0, "overflow": 0, "size": 0}
+        pool = self._engine.pool
+        return {
+            "checked_out": pool.checkedout(),
+            "overflow": max(0, pool.overflow()),
+            "size": pool.size(),
+        }
 
-    async def insert_measurement_flat(self, payload: Dict[str, Any]) -> None:
+    async def insert_measurement_flat(self, payload: Dict[str, Any],
+                                      rtt_ms: Optional[float] = None) -> int:
         """
         Rozparsuje prichádzajúci measurement JSON na ploché stĺpce a uloží.
         Idempotentne: pri kolízii id sa insert preskočí (DO NOTHING).
+        Ak je zadané rtt_ms, uloží sa rovno s riadkom (pri kolízii len ak
+        RTT_ms ešte nie je vyplnené – rovnaká sémantika ako apply_rtt).
+        Vráti počet vložených riadkov (0 = duplikát, aj keď sa mu doplnilo RTT).
         """
-        log.info("Inserting measurement")
+        hot_log.info("Inserting measurement")
         m = _extract_fields(payload)
+        if rtt_ms is not None:
+            m["RTT_ms"] = float(rtt_ms)
+        if self._partitions.partitioned:
+            fill_partition_key([m])
         async with self._sf() as s:
-            stmt = insert(Measurement).values(
-                **m).on_conflict_do_nothing(index_elements=[Measurement.Id])
-            await s.execute(stmt)
+            written, new_rows, fills, aggs = await _insert_rows(s, [m], self.conflict_key)
+            await s.commit()
+        tiles.TILE_CACHE.invalidate(aggs)
+        _notify(self.write_listeners, new_rows, fills)
+        return written
+
+    async def insert_measurements_flat(self, payloads: List[Dict[str, Any]],
+                                       rtts: Optional[Dict[str, float]] = None) -> int:
+        """
+        Dávkový variant insert_measurement_flat: všetky merania uloží
+        viacriadkovým INSERT ... ON CONFLICT v jednej transakcii.
+        rtts (id -> rtt_ms) sa zlúčia priamo do insertovaných riadkov.
+        Pri chybe sa rollbackne celá dávka (fallback rieši volajúci).
+        V tej istej transakcii pripočíta novo vložené riadky do coverage_tiles.
+        Vráti počet vložených riadkov (duplikáty s doplneným RTT sa nepočítajú).
+        """
+        if not payloads:
+            return 0
+        hot_log.info("Inserting batch of %d measurements", len(payloads))
+        rows = _dedupe_rows([_extract_fields(p) for p in payloads])
+        if rtts:
+            # multi-row VALUES potrebuje rovnaké kľúče vo všetkých riadkoch
+            for r in rows:
+                rtt = rtts.get(r["Id"])
+                r["RTT_ms"] = float(rtt) if rtt is not None else None
+        if self._partitions.partitioned:
+            fill_partition_key(rows)
+        async with self._sf() as s:
+            written, new_rows, fills, aggs = await _insert_rows(s, rows, self.conflict_key)
             await s.commit()
+        tiles.TILE_CACHE.invalidate(aggs)
+        _notify(self.write_listeners, new_rows, fills)
+        return written
 
-    async def apply_rtt(self, meas_id: str, rtt_ms: float) -> None:
-        """Doplní RTT iba ak ešte nie je vyplnené (idempotentné)."""
-        log.info("Applying RTT for measurement %s: %s ms", meas_id, rtt_ms)
+    async def apply_rtt(self, meas_id: str, rtt_ms: float) -> int:
+        """Doplní RTT iba ak ešte nie je vyplnené (idempotentné). Vráti počet zmenených riadkov."""
+        hot_log.info("Applying RTT for measurement %s: %s ms", meas_id, rtt_ms)
         async with self._sf() as s:
             stmt = (
                 update(Measurement)
                 .where(Measurement.Id == meas_id, Measurement.RTT_ms.is_(None))
                 .values(RTT_ms=float(rtt_ms))
+                .returning(Measurement.SessionId, Measurement.RTT_ms)
             )
-            await s.execute(stmt)
+            fills = [tuple(r) for r in (await s.execute(stmt)).all()]
             await s.commit()
+        _notify(self.write_listeners, [], fills)
+        return len(fills)
+
+    async def apply_rtt_many(self, rtts: Dict[str, float]) -> int:
+        """
+        Set-based variant apply_rtt: jeden UPDATE ... FROM (VALUES ...) pre
+        celú dávku (id -> rtt_ms), opäť len tam, kde RTT_ms IS NULL.
+        Vráti počet zmenených riadkov.
+        """
+        if not rtts:
+            return 0
+        hot_log.info("Applying %d RTT updates", len(rtts))
+        items = [(str(k), float(v)) for k, v in rtts.items()]
+        chunk = _PG_MAX_PARAMS // 2
+        fills: List[Tuple[Optional[str], float]] = []
+        async with self._sf() as s:
+            for i in range(0, len(items), chunk):
+                v = values(column("id", String), column("rtt", Float),
+                           name="v").data(items[i:i + chunk])
+                stmt = (
+                    update(Measurement)
+                    .where(Measurement.Id == v.c.id, Measurement.RTT_ms.is_(None))
+                    .values(RTT_ms=v.c.rtt)
+                    .returning(Measurement.SessionId, Measurement.RTT_ms)
+                )
+                fills.extend(tuple(r) for r in (await s.execute(stmt)).all())
+            await s.commit()
+        _notify(self.write_listeners, [], fills)
+        return len(fills)
+
+    async def recent_ids(self, since_ms: int, limit: int) -> List[Tuple[str, bool]]:
+        """
+        (Id, má RTT) max. limit meraní s Timestamp >= since_ms, v ľubovoľnom poradí.
+        Pre warm-up idempotency cache pri štarte; bez ORDER BY netriedi celé okno
+        a rozsah po Timestamp môže ísť cez BRIN.
+        """
+        stmt = (
+            select(Measurement.Id, Measurement.RTT_ms.is_not(None))
+            .where(Measurement.Timestamp >= since_ms)
+            .limit(limit)
+        )
+        async with self._engine.connect() as conn:
+            return [tuple(r) for r in (await conn.execute(stmt)).all()]
 
     async def upsert_session_stats(self, payload: Dict[str, Any]) -> None:
         """
         Idempotentne uloží summary pre session_id.
         Ak záznam existuje, spraví UPDATE (napr. ak to pošleš 2x).
+        Začiatok/koniec sa zlúčia so serverovými rollupmi (skorší / neskorší
+        vyhráva); reconnect_count a total_downtime_ms pozná len klient.
         """
         sid = _s(payload.get("session_id"))
         if not sid:
@@ -91,20 +314,176 @@ class PostgresRepository:
         }
 
         async with self._sf() as s:
-            stmt = insert(SessionStats).values(**values)
+            stmt = insert(SessionStats).values(**values, client_reported=True)
+            t = SessionStats.__table__.c
             stmt = stmt.on_conflict_do_update(
                 index_elements=["session_id"],
                 set_={
-                    "started_at_ms": stmt.excluded.started_at_ms,
-                    "ended_at_ms": stmt.excluded.ended_at_ms,
+                    "started_at_ms": func.least(t.started_at_ms, stmt.excluded.started_at_ms),
+                    "ended_at_ms": func.greatest(t.ended_at_ms, stmt.excluded.ended_at_ms),
                     "reconnect_count": stmt.excluded.reconnect_count,
                     "total_downtime_ms": stmt.excluded.total_downtime_ms,
+                    "client_reported": True,
                     "updated_at": func.now(),
                 },
             )
             await s.execute(stmt)
             await s.commit()
 
+    async def upsert_session_rollups(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Pripočíta delty serverových rollupov (rollups.SessionRollup.take_delta)
+        do session_stats jedným viacriadkovým upsertom; sessions s novými RTT
+        dostanú v tej istej transakcii kvantily zo zlúčeného sketchu.
+        """
+        if not rows:
+            return
+        async with self._sf() as s:
+            await s.execute(_rollup_upsert(rows))
+            sids = [r["session_id"] for r in rows if r["rtt_count"]]
+            if sids:
+                res = await s.execute(
+                    select(SessionStats.session_id, SessionStats.rtt_sketch)
+                    .where(SessionStats.session_id.in_(sids)))
+                await s.execute(update(SessionStats), [
+                    {"session_id": sid, **rtt_quantiles(sketch)} for sid, sketch in res.all()])
+            await s.commit()
+
+
+def create_repository(backend: str = DB_BACKEND) -> Any:
+    """Repository podľa DB_BACKEND (app.py aj writer.py)."""
+    if backend == "asyncpg":
+        from pgwriter import AsyncpgRepository
+        return AsyncpgRepository()
+    if backend == "memory":
+        from memrepo import InMemoryRepository
+        return InMemoryRepository(float(os.getenv("MEMREPO_COMMIT_LATENCY_MS", "0")))
+    return PostgresRepository()
+
+
+async def _insert_rows(s: AsyncSession, rows: List[Dict[str, Any]],
+                       keys=("Id",)) -> tuple:
+    """
+    Vloží riadky po chunkoch (limit bind parametrov). RETURNING rozlíši
+    naozaj vložené riadky od RTT updatov existujúcich; z vložených sa pri
+    TILES_ENABLED upsertnú agregáty dlaždíc.
+    Vráti (počet vložených, nové riadky, [(session_id, rtt)] doplnené RTT, agregáty);
+    duplikát, ktorému sa len doplnilo RTT, sa do vložených nepočíta.
+    """
+    chunk = max(1, _PG_MAX_PARAMS // len(Measurement.__table__.columns))
+    new_ids = set()
+    fills: List[Tuple[Optional[str], float]] = []
+    for i in range(0, len(rows), chunk):
+        stmt = _measurement_insert(rows[i:i + chunk], keys).returning(
+            Measurement.Id, tiles.INSERTED, Measurement.SessionId, Measurement.RTT_ms)
+        for rid, inserted, sid, rtt in (await s.execute(stmt)).all():
+            if inserted:
+                new_ids.add(rid)
+            else:
+                fills.append((sid, rtt))
+    new_rows = [r for r in rows if r["Id"] in new_ids] if new_ids else []
+    aggs = tiles.aggregate(new_rows) if tiles.TILES_ENABLED and new_rows else []
+    chunk = max(1, _PG_MAX_PARAMS // len(tiles.KEY_COLUMNS + tiles.AGG_COLUMNS))
+    for i in range(0, len(aggs), chunk):
+        await s.execute(tiles.upsert_statement(aggs[i:i + chunk]))
+    return len(new_rows), new_rows, fills, aggs
+
+
+_WARMUP_TAG = uuid.uuid4().hex[:12]
+
+
+def _warmup_rows(partitioned: bool, k: int = 0) -> List[Dict[str, Any]]:
+    """
+    Riadky pre warm-up (bez RTT / s RTT = obe varianty ON CONFLICT); vždy sa
+    rollbacknú. Id je per proces a spojenie – rovnaký kľúč v súbežných
+    transakciách (aj z inej repliky štartujúcej naraz) by čakal na zámok
+    riadku, kým tie čakajú na bariéru.
+    """
+    rows = []
+    for rtt in (None, 0.0):
+        r = _extract_fields({"id": f"__warmup__{_WARMUP_TAG}.{k}", "session_id": "__warmup__",
+                             "timestamp_sent": int(time.time() * 1000)})
+        r["RTT_ms"] = rtt
+        rows.append(r)
+    if partitioned:
+        fill_partition_key(rows)
+    return rows
+
+
+def _notify(listeners: List[Callable], new_rows: List[Dict[str, Any]],
+            fills: List[Tuple[Optional[str], float]]) -> None:
+    if not (new_rows or fills):
+        return
+    for fn in listeners:
+        try:
+            fn(new_rows, fills)
+        except Exception:
+            log.exception("write listener failed")
+
+
+def _rollup_upsert(rows: List[Dict[str, Any]]):
+    """
+    INSERT ... ON CONFLICT pre session_stats z delty rollupov: počty a súčty
+    sa pripočítajú, sketch RTT sa sčíta po prvkoch, first/last cez LEAST/GREATEST.
+    """
+    now_ms = int(time.time() * 1000)
+    vals = [dict(r, started_at_ms=r["first_ts_ms"] or now_ms, ended_at_ms=r["last_ts_ms"])
+            for r in rows]
+    stmt = insert(SessionStats).values(vals)
+    t, ex = SessionStats.__table__.c, stmt.excluded
+    set_: Dict[str, Any] = {
+        c: t[c] + ex[c] for c in ("msg_count", "rtt_count", "rtt_sum_ms",
+                                  "outage_count", "outage_ms", "cell_changes")
+    }
+    set_.update({
+        "first_ts_ms": func.least(t.first_ts_ms, ex.first_ts_ms),
+        "last_ts_ms": func.greatest(t.last_ts_ms, ex.last_ts_ms),
+        "started_at_ms": func.least(t.started_at_ms, ex.started_at_ms),
+        "ended_at_ms": func.greatest(t.ended_at_ms, ex.ended_at_ms),
+        "outage_max_ms": func.greatest(t.outage_max_ms, ex.outage_max_ms),
+        "rtt_sketch": text(_SKETCH_MERGE),
+        "updated_at": func.now(),
+    })
+    return stmt.on_conflict_do_update(index_elements=["session_id"], set_=set_)
+
+
+# Sčítanie sketchov po prvkoch (unnest s dvoma poliami ich zipne).
+_SKETCH_MERGE = (
+    "CASE WHEN session_stats.rtt_sketch IS NULL THEN excluded.rtt_sketch "
+    "ELSE ARRAY(SELECT COALESCE(a, 0) + COALESCE(b, 0) "
+    "FROM unnest(session_stats.rtt_sketch, excluded.rtt_sketch) WITH ORDINALITY AS u(a, b, i) "
+    "ORDER BY i) END"
+)
+
+
+def _measurement_insert(rows: List[Dict[str, Any]], keys=("Id",)):
+    """
+    INSERT pre merania. Bez RTT: DO NOTHING. S RTT: pri kolízii sa doplní
+    iba RTT_ms a iba ak v DB ešte chýba (ostatné stĺpce sa nemenia).
+    keys = unikátny kľúč pre ON CONFLICT (pozri partitions.conflict_keys).
+    """
+    stmt = insert(Measurement).values(rows)
+    if not any(r.get("RTT_ms") is not None for r in rows):
+        return stmt.on_conflict_do_nothing(index_elements=list(keys))
+    return stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={"RTT_ms": stmt.excluded.RTT_ms},
+        where=Measurement.RTT_ms.is_(None) & stmt.excluded.RTT_ms.isnot(None),
+    )
+
+
+def _dedupe_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Ponechá prvý výskyt každého Id (rovnako ako DO NOTHING pri replayi)."""
+    seen = set()
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        rid = r.get("Id")
+        if rid in seen:
+            continue
+        seen.add(rid)
+        out.append(r)
+    return out
+
 
 def _get_neighbor_list(radio: Dict[str, Any]) -> List[Dict[str, Any]]:
     n = radio.get("neighbors")
@@ -128,7 +507,11 @@ def _neighbor_get_int(n: Dict[str, Any], *keys: str) -> Optional[int]:
 
 def _extract_fields(data: Dict[str, Any]) -> Dict[str, Any]:
     """Bezpečne vytiahne hodnoty z vnoreného JSONu do plochej mapy stĺpcov."""
-    log.info("Extracting fields from data")
+    row = data.get(ROW_KEY)
+    if row is not None:
+        # už dekódované cez decoding.decode_frame
+        return dict(row)
+    hot_log.info("Extracting fields from data")
     radio = data.get("radio") or {}
     pos = data.get("position") or {}
 
@@ -0,0 +1,217 @@
+# decoding.py
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Union
+
+import msgspec
+
+from dbhandler import ROW_KEY, _extract_fields, _f, _i, _s
+from logger import get_logger, setup_logging
+
+setup_logging()
+log = get_logger("decoding")
+
+
+# Schéma obsahuje iba kľúče, ktoré mapujeme do stĺpcov Measurement (+ routing /
+# RTT). Všetko ostatné (device, v2x.payload, ...) decoder preskočí bez alokácie.
+# Typ Any = hodnota sa prevezme tak, ako prišla; koerciu robia _i/_f/_s rovnako
+# lenientne ako _extract_fields.
+class _Neighbor(msgspec.Struct):
+    cell_id: Any = None
+    cellId: Any = None
+    cid: Any = None
+    CellID: Any = None
+    level: Any = None
+    rsrp: Any = None
+    Level: Any = None
+    qual: Any = None
+    rsrq: Any = None
+    Qual: Any = None
+
+
+class _Radio(msgspec.Struct):
+    rsrp: Any = None
+    rsrq: Any = None
+    sinr: Any = None
+    cell_id: Any = None
+    network_type: Any = None
+    network_mode: Any = None
+    lte_rssi: Any = None
+    cgi: Any = None
+    serving_time_ms: Any = None
+    band: Any = None
+    bandwidth_khz: Any = None
+    neighbors: Optional[List[_Neighbor]] = None
+
+
+class _Position(msgspec.Struct):
+    lat: Any = None
+    lon: Any = None
+    speed_kmh: Any = None
+
+
+class _Frame(msgspec.Struct, tag_field="type", tag="measurement"):
+    id: Any = None
+    session_id: Any = None
+    timestamp_sent: Any = None
+    outage: Any = None
+    radio: Optional[_Radio] = None
+    position: Optional[_Position] = None
+    rtt_updates: Any = None
+
+
+class _BatchFrame(msgspec.Struct, tag_field="type", tag="measurement_batch"):
+    # session_id dávky platí pre položky, ktoré vlastné nemajú
+    session_id: Any = None
+    items: List[_Frame] = []
+
+
+# Podporované kódovania rámcov na /ws (MessagePack sa dohodne cez subprotocol).
+JSON = "json"
+MSGPACK = "msgpack"
+
+_frame_decoders = {
+    JSON: msgspec.json.Decoder(Union[_Frame, _BatchFrame]),
+    MSGPACK: msgspec.msgpack.Decoder(Union[_Frame, _BatchFrame]),
+}
+_any_decoders = {
+    JSON: msgspec.json.Decoder(),
+    MSGPACK: msgspec.msgpack.Decoder(),
+}
+_encoders = {
+    JSON: msgspec.json.Encoder(),
+    MSGPACK: msgspec.msgpack.Encoder(),
+}
+
+_EMPTY_NEIGHBOR = _Neighbor()
+
+
+def _first(*vals: Any) -> Optional[int]:
+    # rovnaké poradie aliasov ako _neighbor_get_int v dbhandler
+    for v in vals:
+        if v is not None:
+            return _i(v)
+    return None
+
+
+def _row(fr: _Frame, session_id: Any) -> Dict[str, Any]:
+    """Ploché stĺpce Measurement z typovaného rámca (ekvivalent _extract_fields)."""
+    radio = fr.radio or _Radio()
+    pos = fr.position or _Position()
+    nb = (radio.neighbors or [])[:3]
+    n1 = nb[0] if len(nb) > 0 else _EMPTY_NEIGHBOR
+    n2 = nb[1] if len(nb) > 1 else _EMPTY_NEIGHBOR
+    n3 = nb[2] if len(nb) > 2 else _EMPTY_NEIGHBOR
+
+    return {
+        "Id": _s(fr.id),
+        "SessionId": _s(session_id),
+        "Timestamp": _i(fr.timestamp_sent),
+        "Latitude": _f(pos.lat),
+        "Longitude": _f(pos.lon),
+        "Speed": _f(pos.speed_kmh),
+        "Level": _i(radio.rsrp),
+        "Qual": _i(radio.rsrq),
+        "SNR": _i(radio.sinr),
+        "CellID": _i(radio.cell_id),
+        "NetworkTech": _s(radio.network_type),
+        "NetworkMode": _s(radio.network_mode),
+        "LTERSSI": _i(radio.lte_rssi),
+        "CGI": _s(radio.cgi),
+        "SERVINGTIME": _i(radio.serving_time_ms),
+        "BAND": _s(radio.band),
+        "BANDWIDTH": _i(radio.bandwidth_khz),
+        "Outage": bool(fr.outage) if fr.outage is not None else None,
+
+        "CellID_n1": _first(n1.cell_id, n1.cellId, n1.cid, n1.CellID),
+        "CellID_n2": _first(n2.cell_id, n2.cellId, n2.cid, n2.CellID),
+        "CellID_n3": _first(n3.cell_id, n3.cellId, n3.cid, n3.CellID),
+
+        "Level_n1": _first(n1.level, n1.rsrp, n1.Level),
+        "Level_n2": _first(n2.level, n2.rsrp, n2.Level),
+        "Level_n3": _first(n3.level, n3.rsrp, n3.Level),
+
+        "Qual_n1": _first(n1.qual, n1.rsrq, n1.Qual),
+        "Qual_n2": _first(n2.qual, n2.rsrq, n2.Qual),
+        "Qual_n3": _first(n3.qual, n3.rsrq, n3.Qual),
+    }
+
+
+def _measurement(fr: _Frame, batch_session_id: Any = None) -> Dict[str, Any]:
+    sid = fr.session_id if fr.session_id is not None else batch_session_id
+    return {
+        "type": "measurement",
+        "id": fr.id,
+        "session_id": sid,
+        "rtt_updates": fr.rtt_updates,
+        ROW_KEY: _row(fr, sid),
+    }
+
+
+def encode_message(obj: Any, fmt: str = JSON) -> bytes:
+    """Zakóduje odpoveď (napr. ACK) v rovnakom kódovaní ako prišla požiadavka."""
+    return _encoders[fmt].encode(obj)
+
+
+def decode_frame(raw: bytes | str, fmt: str = JSON) -> Optional[Dict[str, Any]]:
+    """
+    Jedným prechodom dekóduje prichádzajúci rámec (fmt: JSON alebo MSGPACK).
+    - measurement: vráti štíhly dict (type/id/session_id/rtt_updates) a ploché
+      stĺpce pod ROW_KEY; _extract_fields ich potom už len prevezme.
+    - measurement_batch: {"type", "session_id", "items": [štíhle measurement dicty]}.
+    - iné typy (session_summary, rtt_updates, ...): celý JSON objekt ako dict.
+    - nevalidný JSON alebo nie-objekt: None.
+    Ak tvar rámca nesedí so schémou (napr. radio nie je objekt), použije sa
+    pôvodná cesta cez _extract_fields, aby sa zachovalo lenientné správanie.
+    """
+    try:
+        fr = _frame_decoders[fmt].decode(raw)
+    except msgspec.ValidationError:
+        return _decode_generic(raw, fmt)
+    except msgspec.DecodeError:
+        return None
+
+    if isinstance(fr, _BatchFrame):
+        return {
+            "type": "measurement_batch",
+            "session_id": fr.session_id,
+            "items": [_measurement(it, fr.session_id) for it in fr.items],
+        }
+    return _measurement(fr)
+
+
+def _decode_generic(raw: bytes | str, fmt: str) -> Optional[Dict[str, Any]]:
+    try:
+        data = _any_decoders[fmt].decode(raw)
+    except msgspec.DecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    # ROW_KEY smie nastaviť len dekodér, nikdy klient
+    data.pop(ROW_KEY, None)
+    msg_type = data.get("type")
+    if msg_type == "measurement":
+        _attach_row(data)
+    elif msg_type == "measurement_batch":
+        sid = data.get("session_id")
+        items = data.get("items")
+        out: List[Dict[str, Any]] = []
+        for it in items if isinstance(items, list) else []:
+            if not isinstance(it, dict):
+                continue
+            it.setdefault("type", "measurement")
+            if it.get("session_id") is None and sid is not None:
+                it["session_id"] = sid
+            _attach_row(it)
+            out.append(it)
+        data["items"] = out
+    return data
+
+
+def _attach_row(data: Dict[str, Any]) -> None:
+    """Ploché stĺpce pod ROW_KEY; klientom poslaný ROW_KEY sa vždy zahodí."""
+    data.pop(ROW_KEY, None)
+    try:
+        data[ROW_KEY] = _extract_fields(data)
+    except Exception:
+        # rovnako ako doteraz: zlý tvar sa prejaví až pri inserte
+        pass
@@ -1,35 +1,45 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-echo "[entrypoint] Waiting for DB at ${DATABASE_URL} ..."
+# Čakanie na DB aj schéma sú v lifespan aplikácie (DB_WAIT_S, fingerprint v
+# schema_version), takže tu sa už nespúšťa ďalší Python proces.
+# Manuálne DDL operácie (--recreate, --truncate, --partition): python create_db.py
 
-RETRIES=30
-until python - <<'PY'
-import os, asyncio
-from sqlalchemy.ext.asyncio import create_async_engine
-async def ping():
-    dsn = os.getenv("DATABASE_URL")
-    eng = create_async_engine(dsn)
-    async with eng.begin() as conn:
-        await conn.run_sync(lambda *_: None)
-    await eng.dispose()
-asyncio.run(ping())
-PY
-do
-  RETRIES=$((RETRIES-1))
-  if [ "$RETRIES" -le 0 ]; then
-    echo "[entrypoint] DB not reachable in time."
-    exit 1
-  fi
-  echo "[entrypoint] DB not ready yet, retrying ..."
-  sleep 2
-done
+GATEWAY_WORKERS="${GATEWAY_WORKERS:-1}"
 
-echo "[entrypoint] Applying metadata (create_db.py) ..."
+if [ "${GATEWAY_WORKERS}" -le 1 ]; then
+  echo "[entrypoint] Starting API (uvicorn ${APP_MODULE}) ..."
+  # permessage-deflate na /ws (klient ho musí ponúknuť); vypnúť: WS_PER_MESSAGE_DEFLATE=false
+  exec uvicorn "${APP_MODULE}" --host "${HOST}" --port "${PORT}" --log-level "${LOG_LEVEL}" \
+    --ws-per-message-deflate "${WS_PER_MESSAGE_DEFLATE:-true}"
+fi
 
-# dri drope --recreate
+# Gateway režim: jeden writer (workery + DB pool) a N uvicorn procesov, ktoré
+# mu posielajú záznamy cez WRITER_SOCKET. Gatewaye čakajú na writer sami
+# (GATEWAY_CONNECT_S). Pri SIGTERM sa najprv zastavia gatewaye (dotečú
+# otvorené spojenia), až potom writer (vyprázdni fronty do DB).
+echo "[entrypoint] Starting writer (python writer.py) ..."
+python writer.py &
+WRITER_PID=$!
 
-python create_db.py || true
+echo "[entrypoint] Starting ${GATEWAY_WORKERS} gateways (uvicorn ${APP_MODULE}) ..."
+INGEST_MODE=gateway uvicorn "${APP_MODULE}" --host "${HOST}" --port "${PORT}" --log-level "${LOG_LEVEL}" \
+  --ws-per-message-deflate "${WS_PER_MESSAGE_DEFLATE:-true}" --workers "${GATEWAY_WORKERS}" &
+GATEWAY_PID=$!
 
-echo "[entrypoint] Starting API (uvicorn ${APP_MODULE}) ..."
-exec uvicorn "${APP_MODULE}" --host "${HOST}" --port "${PORT}" --log-level "${LOG_LEVEL}"
+shutdown() {
+  echo "[entrypoint] Stopping gateways ..."
+  kill -TERM "${GATEWAY_PID}" 2>/dev/null || true
+  wait "${GATEWAY_PID}" 2>/dev/null || true
+  echo "[entrypoint] Stopping writer ..."
+  kill -TERM "${WRITER_PID}" 2>/dev/null || true
+  wait "${WRITER_PID}" 2>/dev/null || true
+}
+trap 'shutdown; exit 0' TERM INT
+
+# skončí, keď padne ktorýkoľvek z procesov; potom zastav aj druhý
+set +e
+wait -n "${WRITER_PID}" "${GATEWAY_PID}"
+status=$?
+shutdown
+exit "${status}"
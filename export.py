@@ -0,0 +1,208 @@
+# export.py
+from __future__ import annotations
+import csv
+import io
+import os
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, List, Optional, Sequence, Tuple
+
+import msgspec
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from archive import ArchiveReader, filter_table
+from dbhandler import ASYNC_DSN
+from logger import get_logger, setup_logging
+from models import Measurement
+
+setup_logging()
+log = get_logger("export")
+
+# Export má vlastný malý pool, aby pomalí HTTP klienti nezabrali spojenia
+# ingest workeru. Pri plnom poole sa na spojenie čaká max. EXPORT_POOL_TIMEOUT_S.
+EXPORT_POOL_SIZE = int(os.getenv("EXPORT_POOL_SIZE", "2"))
+EXPORT_POOL_TIMEOUT_S = float(os.getenv("EXPORT_POOL_TIMEOUT_S", "5"))
+# Riadkov na jednu keyset stránku (jeden krátky SELECT).
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "5000"))
+EXPORT_STATEMENT_TIMEOUT_MS = int(os.getenv("EXPORT_STATEMENT_TIMEOUT_MS", "30000"))
+
+NDJSON = "ndjson"
+CSV = "csv"
+MEDIA_TYPES = {NDJSON: "application/x-ndjson", CSV: "text/csv; charset=utf-8"}
+
+COLUMNS: List[str] = [c.name for c in Measurement.__table__.columns]
+# export session: poradie indexu ix_measurements_session_ts (+ Id pre jednoznačnosť)
+_SESSION_KEY = (Measurement.SessionId, Measurement.Timestamp, Measurement.Id)
+# časové okno naprieč sessions: podľa času, rozsah Timestamp ide cez BRIN
+_RANGE_KEY = (Measurement.Timestamp, Measurement.Id)
+
+_json = msgspec.json.Encoder()
+
+
+class ExportUnavailable(Exception):
+    """Export pool je vyčerpaný alebo DB neodpovedá (HTTP 503)."""
+
+
+@dataclass
+class ExportQuery:
+    session_id: Optional[str] = None
+    from_ts: Optional[int] = None
+    to_ts: Optional[int] = None
+    network_tech: Optional[str] = None
+    band: Optional[str] = None
+    cell_id: Optional[int] = None
+    limit: Optional[int] = None
+
+
+def parse_columns(spec: Optional[str]) -> List[str]:
+    """'Id,Timestamp,Level' -> zoznam stĺpcov; ValueError pri neznámom stĺpci."""
+    if not spec:
+        return list(COLUMNS)
+    cols = [c.strip() for c in spec.split(",") if c.strip()]
+    unknown = [c for c in cols if c not in COLUMNS]
+    if unknown:
+        raise ValueError(f"unknown columns: {', '.join(unknown)}")
+    return cols
+
+
+class MeasurementExporter:
+    """
+    Streamuje merania po keyset stránkach: session na (SessionId, Timestamp, Id),
+    časové okno bez session na (Timestamp, Id).
+    - Každá stránka je samostatný krátky SELECT ... LIMIT; spojenie sa medzi
+      stránkami vracia do poolu, takže sa nedrží počas zápisu klientovi.
+    - Ďalšia stránka sa načíta až keď ASGI server odošle predošlú, takže
+      pomalý klient spomalí aj čítanie z DB (backpressure) a v pamäti je
+      naraz najviac jedna stránka.
+    - Riadky bez Timestamp sa neexportujú (filter Timestamp IS NOT NULL;
+      keyset porovnanie s NULL by ich inak vrátilo len na prvej stránke).
+    - Engine vznikne až v start() (lifespan), nie pri importe aplikácie.
+    - Session, ktorá v DB nemá žiadne riadky (ARCHIVE_PRUNE), sa číta
+      z archívu (archive), ak je zadaný.
+    """
+
+    def __init__(self, dsn: Optional[str] = ASYNC_DSN, pool_size: int = EXPORT_POOL_SIZE,
+                 page_size: int = EXPORT_PAGE_SIZE,
+                 archive: Optional[ArchiveReader] = None) -> None:
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.page_size = page_size
+        self.archive = archive
+        self.engine: Optional[AsyncEngine] = None
+
+    def start(self) -> AsyncEngine:
+        if self.engine is None:
+            self.engine = create_async_engine(
+                self.dsn,
+                pool_size=self.pool_size,
+                max_overflow=0,
+                pool_timeout=EXPORT_POOL_TIMEOUT_S,
+                connect_args={"server_settings": {
+                    "statement_timeout": str(EXPORT_STATEMENT_TIMEOUT_MS),
+                    "default_transaction_read_only": "on",
+                }},
+            )
+        return self.engine
+
+    async def stop(self) -> None:
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def stream(self, q: ExportQuery, columns: Sequence[str],
+                     fmt: str = NDJSON) -> AsyncIterator[bytes]:
+        """
+        Vráti async iterátor bajtov pre StreamingResponse. Prvá stránka sa
+        načíta hneď, aby sa chyba poolu/DB dala vrátiť ako 503 ešte pred
+        odoslaním hlavičiek.
+        """
+        try:
+            first = await self._page(q, columns, None, self._page_limit(q, 0))
+        except Exception as e:
+            log.warning("Export unavailable: %s", e)
+            raise ExportUnavailable(str(e)) from e
+        if not first and q.session_id is not None and self.archive is not None \
+                and self.archive.has_session(q.session_id):
+            return self._iter_archive(q, columns, fmt)
+        return self._iter(q, columns, fmt, first)
+
+    def _page_limit(self, q: ExportQuery, sent: int) -> int:
+        if q.limit is None:
+            return self.page_size
+        return max(0, min(self.page_size, q.limit - sent))
+
+    async def _iter(self, q: ExportQuery, columns: Sequence[str], fmt: str,
+                    page: List[Tuple[Any, ...]]) -> AsyncIterator[bytes]:
+        encode = _encode_csv if fmt == CSV else _encode_ndjson
+        if fmt == CSV:
+            yield _encode_csv([tuple(columns)])
+        sent = 0
+        n_key = len(_key(q))
+        while page:
+            sent += len(page)
+            yield encode([r[n_key:] for r in page], columns)
+            limit = self._page_limit(q, sent)
+            if len(page) < self.page_size or limit == 0:
+                break
+            page = await self._page(q, columns, page[-1][:n_key], limit)
+        log.info("Export finished: %d rows (session=%s)", sent, q.session_id)
+
+    async def _iter_archive(self, q: ExportQuery, columns: Sequence[str],
+                            fmt: str) -> AsyncIterator[bytes]:
+        table = filter_table(self.archive.read_session(q.session_id),
+                             q.from_ts, q.to_ts, q.network_tech, q.band, q.cell_id)
+        if q.limit is not None:
+            table = table.slice(0, q.limit)
+        table = table.select(list(columns))
+        encode = _encode_csv if fmt == CSV else _encode_ndjson
+        if fmt == CSV:
+            yield _encode_csv([tuple(columns)])
+        for off in range(0, table.num_rows, self.page_size):
+            page = table.slice(off, self.page_size)
+            yield encode(list(zip(*(page[c].to_pylist() for c in columns))), columns)
+        log.info("Export finished: %d rows from archive (session=%s)",
+                 table.num_rows, q.session_id)
+
+    async def _page(self, q: ExportQuery, columns: Sequence[str],
+                    after: Optional[Tuple[Any, ...]], limit: int) -> List[Tuple[Any, ...]]:
+        if limit <= 0:
+            return []
+        M = Measurement
+        key = _key(q)
+        stmt = select(*key, *[M.__table__.c[c] for c in columns]).where(M.Timestamp.is_not(None))
+        if q.session_id is not None:
+            stmt = stmt.where(M.SessionId == q.session_id)
+        if q.from_ts is not None:
+            stmt = stmt.where(M.Timestamp >= q.from_ts)
+        if q.to_ts is not None:
+            stmt = stmt.where(M.Timestamp < q.to_ts)
+        if q.network_tech is not None:
+            stmt = stmt.where(M.NetworkTech == q.network_tech)
+        if q.band is not None:
+            stmt = stmt.where(M.BAND == q.band)
+        if q.cell_id is not None:
+            stmt = stmt.where(M.CellID == q.cell_id)
+        if after is not None:
+            stmt = stmt.where(tuple_(*key) > tuple_(*after))
+            if key is _RANGE_KEY:
+                # BRIN nevie použiť porovnanie riadkov; samotný Timestamp áno
+                stmt = stmt.where(M.Timestamp >= after[0])
+        stmt = stmt.order_by(*key).limit(limit)
+        async with self.engine.connect() as conn:
+            res = await conn.execute(stmt)
+            return [tuple(r) for r in res.all()]
+
+
+def _key(q: ExportQuery) -> Tuple[Any, ...]:
+    return _SESSION_KEY if q.session_id is not None else _RANGE_KEY
+
+
+def _encode_ndjson(rows: List[Tuple[Any, ...]], columns: Sequence[str]) -> bytes:
+    return b"".join(_json.encode(dict(zip(columns, r))) + b"\n" for r in rows)
+
+
+def _encode_csv(rows: List[Tuple[Any, ...]], columns: Sequence[str] = ()) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerows(rows)
+    return buf.getvalue().encode("utf-8")
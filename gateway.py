@@ -0,0 +1,451 @@
+# gateway.py
+from __future__ import annotations
+import asyncio
+import itertools
+import os
+import struct
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import msgspec
+
+from logger import get_logger, get_hot_logger, setup_logging
+import tiles
+from records import compact, from_wire, to_wire
+from worker import (
+    SHED_POLICY, Admission, CreditWindow, MessageProcessor, _message_cost, _routing_key,
+)
+
+setup_logging()
+log = get_logger("gateway")
+hot_log = get_hot_logger("gateway")
+
+# Multi-process režim: N gateway procesov (uvicorn --workers N, INGEST_MODE=gateway)
+# posiela kompaktné záznamy cez Unix socket jedinému writer procesu (writer.py),
+# ktorý vlastní DB pool a MessageProcessor.
+WRITER_SOCKET = os.getenv("WRITER_SOCKET", "/tmp/drivetest-writer.sock")
+# Ako dlho gateway pri štarte čaká na writer (s).
+GATEWAY_CONNECT_S = float(os.getenv("GATEWAY_CONNECT_S", "60"))
+# Ako často si gateway obnoví stav front writera pre /queues, /health a /metrics (s).
+GATEWAY_STATS_S = float(os.getenv("GATEWAY_STATS_S", "1"))
+# Timeout jednej požiadavky na writer (s); potom sa WS spojenie zavrie bez ACK.
+GATEWAY_RPC_TIMEOUT_S = float(os.getenv("GATEWAY_RPC_TIMEOUT_S", "30"))
+
+# rámec = 4 bajty dĺžky (big-endian) + MessagePack pole
+_LEN = struct.Struct(">I")
+# gateway -> writer
+OP_OFFER, OP_PUT, OP_CLOSE, OP_STATS, OP_PING, OP_LIVE = range(6)
+# writer -> gateway
+OP_REPLY, OP_EVENT, OP_INVALIDATE = 100, 101, 102
+# writer.write buffer nad ktorým sa čaká na drain
+_HIGH_WATER = 1 << 20
+
+_encode = msgspec.msgpack.Encoder().encode
+_decode = msgspec.msgpack.Decoder().decode
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Any:
+    (n,) = _LEN.unpack(await reader.readexactly(4))
+    return _decode(await reader.readexactly(n))
+
+
+def _frame(obj: Any) -> bytes:
+    body = _encode(obj)
+    return _LEN.pack(len(body)) + body
+
+
+def _admission_reply(adm: Admission, window: CreditWindow) -> tuple:
+    return (adm.accepted, adm.congested, adm.retry_after_ms, adm.shed, window.available)
+
+
+class WriterServer:
+    """
+    Strana writer procesu: Unix socket, na ktorý sa pripájajú gateway procesy.
+    - Požiadavky jedného gateway sa vybavujú postupne v poradí príchodu, takže
+      poradie rámcov jedného WS spojenia (a teda session) ostáva zachované.
+    - OFFER ide do MessageProcessor.admit s kreditným oknom daného WS spojenia
+      (okno žije tu, kredit sa vráti až po spracovaní workerom); PUT (politika
+      block) čaká na miesto vo fronte a tým brzdí celý gateway.
+    - Zapísané riadky (write listener) sa posielajú len gateway procesom,
+      ktoré majú /live odberateľov; kompaktnú invalidáciu (dotknuté sessions
+      a dlaždice) dostanú všetky, lebo /tiles aj KPI cache obsluhujú gatewaye.
+    """
+
+    def __init__(self, processor: MessageProcessor, repo: Any, path: str = WRITER_SOCKET) -> None:
+        self.processor = processor
+        self.repo = repo
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._live: Dict[asyncio.StreamWriter, bool] = {}
+        # (zoom, x, y) zmenených agregátov od poslednej invalidácie
+        self._tiles: Set[Tuple[int, int, int]] = set()
+        self.stats: Counter = Counter()
+        tiles.TILE_CACHE.listeners.append(self._tiles_changed)
+        repo.write_listeners.append(self._publish)
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        log.info("Writer listening on %s", self.path)
+
+    async def stop(self) -> None:
+        """Prestane prijímať gateway spojenia; otvorené dobehnú, kým ich gateway zavrie."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        windows: Dict[int, CreditWindow] = {}
+        self._live[writer] = False
+        self.stats["connects"] += 1
+        log.info("Gateway connected (%d connected)", len(self._live))
+        processor = self.processor
+        try:
+            while True:
+                msg = await _read_frame(reader)
+                op = msg[0]
+                if op == OP_OFFER:
+                    _, req, conn, size, rkey, cost, wire = msg
+                    window = windows.get(conn)
+                    if window is None:
+                        window = windows[conn] = CreditWindow(size)
+                    adm = processor.admit(rkey, from_wire(wire), cost, window)
+                    if type(adm) is not Admission:
+                        # spool: poradie je dané už zaradením, odpoveď až po fsync
+                        # (ďalšie rámce medzitým nečakajú -> group commit)
+                        asyncio.create_task(self._reply_durable(writer, req, adm, window))
+                        continue
+                    reply = (OP_REPLY, req, _admission_reply(adm, window))
+                elif op == OP_PUT:
+                    _, req, rkey, cost, wire = msg
+                    await processor.put(rkey, from_wire(wire), cost)
+                    reply = (OP_REPLY, req, None)
+                elif op == OP_CLOSE:
+                    # záznamy vo fronte si okno držia, kým ich worker nespracuje
+                    windows.pop(msg[1], None)
+                    continue
+                elif op == OP_STATS:
+                    reply = (OP_REPLY, msg[1], self._snapshot())
+                elif op == OP_PING:
+                    # DB ping nesmie zdržať rámce za ním
+                    asyncio.create_task(self._ping(writer, msg[1]))
+                    continue
+                elif op == OP_LIVE:
+                    self._live[writer] = bool(msg[1])
+                    continue
+                else:
+                    log.warning("Unknown gateway op %r", op)
+                    continue
+                writer.write(_frame(reply))
+                if writer.transport.get_write_buffer_size() > _HIGH_WATER:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            log.exception("Gateway connection failed")
+        finally:
+            self._live.pop(writer, None)
+            writer.close()
+            log.info("Gateway disconnected (%d connected)", len(self._live))
+
+    async def _reply_durable(self, writer: asyncio.StreamWriter, req: int,
+                             pending: Any, window: CreditWindow) -> None:
+        adm = await pending
+        if not writer.is_closing():
+            writer.write(_frame((OP_REPLY, req, _admission_reply(adm, window))))
+
+    async def _ping(self, writer: asyncio.StreamWriter, req: int) -> None:
+        ok = await self.repo.ping()
+        if not writer.is_closing():
+            writer.write(_frame((OP_REPLY, req, ok)))
+
+    def _snapshot(self) -> Dict[str, Any]:
+        p = self.processor
+        return {
+            "shards": p.shard_stats(),
+            "flow": dict(p.flow_stats),
+            "idcache": p.ids.stats() if p.ids is not None else None,
+            "high_water": p.high_water,
+            "high_water_bytes": p.high_water_bytes,
+            "durable": p.durable,
+            "pool": self.repo.pool_status(),
+        }
+
+    def _tiles_changed(self, aggs: List[Dict[str, Any]]) -> None:
+        """TILE_CACHE listener: repo ho volá tesne pred write listenermi tej istej dávky."""
+        self._tiles.update((a["zoom"], a["x"], a["y"]) for a in aggs)
+
+    def _publish(self, new_rows: List[Dict[str, Any]],
+                 fills: List[Tuple[Optional[str], float]]) -> None:
+        """
+        write listener: všetkým gateway procesom invalidácia KPI / dlaždíc,
+        tým s /live odberateľmi aj zapísané riadky.
+        """
+        changed, self._tiles = self._tiles, set()
+        if not self._live:
+            return
+        sids = {r.get("SessionId") for r in new_rows}
+        sids.update(sid for sid, _ in fills)
+        sids.discard(None)
+        invalidate = _frame((OP_INVALIDATE, list(sids), [list(t) for t in changed]))
+        event = None
+        for w, live in self._live.items():
+            # invalidácia je malá a nezahadzuje sa (inak by cache držala staré dáta až do TTL)
+            w.write(invalidate)
+            if not live:
+                continue
+            if w.transport.get_write_buffer_size() > _HIGH_WATER:
+                # gateway nestíha čítať – /live je best-effort, ingest nebrzdí
+                self.stats["live_dropped"] += 1
+                continue
+            if event is None:
+                event = _frame((OP_EVENT, new_rows, fills))
+            w.write(event)
+
+
+class GatewayClient:
+    """
+    Strana gateway procesu: spojenie na writer. V app.py zastupuje repository
+    (start/stop, ping, pool_status, write_listeners pre /live) a je transportom
+    pre RemoteProcessor. Stav front writera sa obnovuje každých
+    GATEWAY_STATS_S, takže /queues, /health aj /metrics čítajú lokálny snímok.
+    """
+
+    def __init__(self, path: str = WRITER_SOCKET, connect_s: float = GATEWAY_CONNECT_S,
+                 stats_s: float = GATEWAY_STATS_S) -> None:
+        self.path = path
+        self.connect_s = connect_s
+        self.stats_s = stats_s
+        self.write_listeners: List[Callable] = []
+        # (session_ids, [(zoom, x, y)]) zmenené writerom – pre KPI a tile cache (app.py)
+        self.invalidate_listeners: List[Callable] = []
+        # vráti True, ak sú v tomto procese /live odberatelia (nastaví app.py)
+        self.live_active: Callable[[], bool] = lambda: False
+        self.snapshot: Dict[str, Any] = {}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+        self._live_sent = False
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        deadline = time.monotonic() + self.connect_s
+        while True:
+            try:
+                await self._connect()
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"writer not reachable on {self.path}") from e
+                log.info("Waiting for writer on %s", self.path)
+                await asyncio.sleep(0.5)
+        self._tasks.append(asyncio.create_task(self._stats_loop(), name="gateway-stats"))
+        await self._refresh()
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._live_sent = False
+        self._tasks.append(asyncio.create_task(
+            self._recv_loop(self._reader, self._writer), name="gateway-recv"))
+        log.info("Connected to writer on %s", self.path)
+
+    async def warm_up(self, connections: int = 0) -> int:
+        # DB pool má writer; gateway nemá čo zahrievať
+        return 0
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(ConnectionError("gateway stopped"))
+
+    def send(self, msg: tuple) -> None:
+        if not self.connected:
+            raise ConnectionError("writer connection lost")
+        self._writer.write(_frame(msg))
+
+    async def call(self, op: int, *args: Any) -> Any:
+        """Požiadavka s odpoveďou; poradie odoslania = poradie vybavenia writerom."""
+        req = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req] = fut
+        try:
+            self.send((op, req, *args))
+            if self._writer.transport.get_write_buffer_size() > _HIGH_WATER:
+                await self._writer.drain()
+            return await asyncio.wait_for(fut, GATEWAY_RPC_TIMEOUT_S)
+        finally:
+            self._pending.pop(req, None)
+
+    async def ping(self, timeout: float = 1.0) -> bool:
+        """True ak writer beží a jeho DB odpovedá."""
+        if not self.connected:
+            return False
+        try:
+            return bool(await asyncio.wait_for(self.call(OP_PING), timeout + 1.0))
+        except Exception:
+            return False
+
+    def pool_status(self) -> Dict[str, int]:
+        return self.snapshot.get("pool", {})
+
+    async def _recv_loop(self, reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                msg = await _read_frame(reader)
+                if msg[0] == OP_REPLY:
+                    fut = self._pending.get(msg[1])
+                    if fut is not None and not fut.done():
+                        fut.set_result(msg[2])
+                elif msg[0] == OP_EVENT:
+                    for fn in self.write_listeners:
+                        try:
+                            fn(msg[1], msg[2])
+                        except Exception:
+                            log.exception("write listener failed")
+                elif msg[0] == OP_INVALIDATE:
+                    for fn in self.invalidate_listeners:
+                        try:
+                            fn(msg[1], msg[2])
+                        except Exception:
+                            log.exception("invalidate listener failed")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.error("Writer connection lost")
+        finally:
+            writer.close()
+            self._fail_pending(ConnectionError("writer connection lost"))
+
+    def _fail_pending(self, exc: Exception) -> None:
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+        self._pending.clear()
+
+    async def _stats_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_s)
+            try:
+                if not self.connected:
+                    # writer reštartoval; WS spojenia bez ACK klienti zopakujú
+                    self._tasks = [t for t in self._tasks if not t.done()]
+                    await self._connect()
+                await self._refresh()
+            except Exception as e:
+                hot_log.info("Writer stats refresh failed: %s", e)
+
+    async def _refresh(self) -> None:
+        live = bool(self.live_active())
+        if live != self._live_sent:
+            self.send((OP_LIVE, live))
+            self._live_sent = live
+        self.snapshot = await self.call(OP_STATS)
+
+
+class _IdCacheView:
+    """Snímok štatistík idempotency cache writera (rozhranie ako IdempotencyCache.stats)."""
+
+    def __init__(self, client: GatewayClient) -> None:
+        self._client = client
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return self._client.snapshot.get("idcache") or {}
+
+
+class RemoteProcessor:
+    """
+    MessageProcessor pre gateway proces: rámec sa tu len skompaktuje
+    (records.compact) a pošle writeru; offer vráti Admission až po jeho
+    rozhodnutí, takže ACK stále znamená "prijaté do fronty writera".
+    Kreditné okno spojenia sa prepočíta z odpovede writera.
+    """
+
+    def __init__(self, client: GatewayClient, shed_policy: str = SHED_POLICY) -> None:
+        self.client = client
+        self.shed_policy = shed_policy
+        self._flow: Counter = Counter()
+
+    async def start(self) -> None:
+        await self.client.start()
+
+    async def stop(self, drain: bool = True) -> None:
+        # fronty drží writer; ten ich pri svojom stope dočerpá
+        return None
+
+    async def offer(self, data: Dict[str, Any], key: Optional[str] = None,
+                    window: Optional[CreditWindow] = None) -> Admission:
+        rkey = _routing_key(data, key)
+        size = window.size if window is not None else 0
+        res = await self.client.call(OP_OFFER, id(window), size, rkey, _message_cost(data),
+                                     to_wire(compact(data)))
+        accepted, congested, retry_after_ms, shed, available = res
+        if window is not None:
+            window.used = window.size - available
+        return Admission(accepted, congested, retry_after_ms, shed)
+
+    async def enqueue(self, data: Dict[str, Any], key: Optional[str] = None) -> None:
+        await self.client.call(OP_PUT, _routing_key(data, key), _message_cost(data),
+                               to_wire(compact(data)))
+
+    @property
+    def durable(self) -> bool:
+        """Writer má spool -> ACK aj pri politike block až po zápise (pozri websocket)."""
+        return self.client.snapshot.get("durable", False)
+
+    def close_window(self, window: CreditWindow) -> None:
+        if self.client.connected:
+            self.client.send((OP_CLOSE, id(window)))
+
+    # ---- snímok stavu writera (pre /queues, /health, /metrics) ----
+
+    @property
+    def ids(self) -> Optional[_IdCacheView]:
+        return _IdCacheView(self.client) if self.client.snapshot.get("idcache") else None
+
+    @property
+    def high_water(self) -> int:
+        return self.client.snapshot.get("high_water", 1)
+
+    @property
+    def high_water_bytes(self) -> int:
+        return self.client.snapshot.get("high_water_bytes", 1)
+
+    def shard_stats(self, top: int = 3) -> List[Dict[str, Any]]:
+        shards = self.client.snapshot.get("shards", [])
+        return [dict(s, hot_sessions=s["hot_sessions"][:top]) for s in shards]
+
+    def qsize(self) -> int:
+        return sum(s["depth"] for s in self.client.snapshot.get("shards", []))
+
+    def queue_bytes(self) -> int:
+        return sum(s["bytes"] for s in self.client.snapshot.get("shards", []))
+
+    @property
+    def flow_stats(self) -> Counter:
+        """Počty writera zo snímku + lokálne udalosti gateway (slow_down_sent)."""
+        for k, v in self.client.snapshot.get("flow", {}).items():
+            self._flow[k] = v
+        return self._flow
@@ -0,0 +1,121 @@
+# idcache.py
+from __future__ import annotations
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from logger import get_logger, setup_logging
+
+setup_logging()
+log = get_logger("idcache")
+
+# Max. počet id v každej cache (uložené merania / merania s RTT); 0 = vypnuté.
+IDCACHE_SIZE = int(os.getenv("IDCACHE_SIZE", "100000"))
+# Pri štarte sa načítajú id meraní s Timestamp za posledných N sekúnd (0 = bez warm-upu).
+IDCACHE_WARMUP_S = float(os.getenv("IDCACHE_WARMUP_S", "900"))
+
+
+class IdCache:
+    """Ohraničená LRU množina id s počtami hit / miss / eviction."""
+
+    __slots__ = ("maxsize", "_ids", "hits", "misses", "evictions")
+
+    def __init__(self, maxsize: int = IDCACHE_SIZE) -> None:
+        self.maxsize = max(1, int(maxsize))
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, key: str) -> bool:
+        # bez štatistík a bez posunu v LRU
+        return key in self._ids
+
+    def seen(self, key: str) -> bool:
+        """Dotaz pred DB prácou: True = id je známe (hit)."""
+        if key in self._ids:
+            self._ids.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key: str) -> None:
+        ids = self._ids
+        if key in ids:
+            ids.move_to_end(key)
+            return
+        ids[key] = None
+        if len(ids) > self.maxsize:
+            ids.popitem(last=False)
+            self.evictions += 1
+
+    def add_many(self, keys: Iterable[str]) -> None:
+        for k in keys:
+            self.add(k)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._ids), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+class IdempotencyCache:
+    """
+    Krátkodobá pamäť toho, čo už určite je v DB, aby replaye po reconnecte
+    a opakované RTT okná nestáli DB round-trip.
+    - measurements: id, ktoré sú v measurements (nové aj duplicitné po
+      úspešnom inserte);
+    - rtts: id, ktoré už majú RTT_ms vyplnené – ďalší apply_rtt by nič nezmenil.
+    Do cache sa pridáva až po úspešnom commite; vyradenie z LRU len znamená
+    zbytočný round-trip. Správnosť stále stojí na ON CONFLICT a RTT_ms IS NULL.
+    """
+
+    def __init__(self, maxsize: int = IDCACHE_SIZE) -> None:
+        self.measurements = IdCache(maxsize)
+        self.rtts = IdCache(maxsize)
+
+    def known_measurement(self, mid: str) -> bool:
+        return self.measurements.seen(mid)
+
+    def known_rtt(self, mid: str) -> bool:
+        return self.rtts.seen(mid)
+
+    def stored(self, ids: Iterable[str], rtt_ids: Iterable[str] = ()) -> None:
+        """Insert dávky prebehol: všetky id sú v DB, rtt_ids majú RTT (ON CONFLICT doplní chýbajúce)."""
+        self.measurements.add_many(ids)
+        self.rtts.add_many(rtt_ids)
+
+    def applied(self, ids: Iterable[str]) -> None:
+        """
+        apply_rtt prebehol: známe (uložené) merania teraz určite majú RTT –
+        buď ho UPDATE práve doplnil, alebo už bol vyplnený. Neznáme id sa
+        nepridajú (meranie ešte nemusí byť v DB).
+        """
+        m = self.measurements
+        self.rtts.add_many(i for i in ids if i in m)
+
+    async def warm_up(self, repo: Any, window_s: float = IDCACHE_WARMUP_S) -> int:
+        """Načíta id nedávnych meraní z DB (repo.recent_ids); vráti ich počet."""
+        if window_s <= 0:
+            return 0
+        since_ms = int((time.time() - window_s) * 1000)
+        t0 = time.perf_counter()
+        rows: List[Tuple[str, bool]] = await repo.recent_ids(since_ms, self.measurements.maxsize)
+        for mid, has_rtt in rows:
+            self.measurements.add(mid)
+            if has_rtt:
+                self.rtts.add(mid)
+        log.info("Idempotency cache warmed with %d ids in %.3fs",
+                 len(rows), time.perf_counter() - t0)
+        return len(rows)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"measurements": self.measurements.stats(), "rtts": self.rtts.stats()}
+
+
+def create_cache(maxsize: int = IDCACHE_SIZE) -> Optional[IdempotencyCache]:
+    return IdempotencyCache(maxsize) if maxsize > 0 else None
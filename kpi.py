@@ -0,0 +1,384 @@
+# kpi.py
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from archive import ARCHIVE_DIR, ArchiveReader
+from dbhandler import ASYNC_DSN
+from logger import get_logger, setup_logging
+
+setup_logging()
+log = get_logger("kpi")
+
+# LRU cache KPI (počet sessions / TTL v s). Nové merania alebo RTT session
+# záznam zneplatnia hneď (v gateway režime cez invalidáciu od writera); TTL
+# kryje zápisy mimo servera (napr. backfill.py priamo do DB).
+KPI_CACHE_SIZE = int(os.getenv("KPI_CACHE_SIZE", "256"))
+KPI_CACHE_TTL_S = float(os.getenv("KPI_CACHE_TTL_S", "300"))
+# Medzera medzi meraniami dlhšia ako N ms sa nezapočíta do času v technológii
+# / pásme (zariadenie vtedy nemeralo).
+KPI_MAX_GAP_MS = int(os.getenv("KPI_MAX_GAP_MS", "10000"))
+# Presun medzi dvoma GPS fixmi rýchlejší ako N km/h je skok GPS a do
+# prejdenej vzdialenosti sa nepočíta.
+KPI_MAX_SPEED_KMH = float(os.getenv("KPI_MAX_SPEED_KMH", "300"))
+# Max. počet intervalov výpadku v odpovedi (počet a súčty sú vždy úplné).
+KPI_MAX_INTERVALS = int(os.getenv("KPI_MAX_INTERVALS", "1000"))
+
+# stĺpce, z ktorých sa KPI počítajú (v tomto poradí ich vracia COPY)
+COLUMNS: Tuple[str, ...] = ("Timestamp", "Latitude", "Longitude", "Level", "Qual", "SNR",
+                            "CellID", "NetworkTech", "BAND", "Outage", "RTT_ms")
+# bez ORDER BY: triedenie podľa (Timestamp, Id) v DB stojí viac ako argsort v NumPy
+_COPY_SQL = (
+    "SELECT " + ", ".join(f'"{c}"' for c in COLUMNS) + " FROM measurements "
+    'WHERE "SessionId" = $1 AND "Timestamp" IS NOT NULL'
+)
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+_CSV_READ = pcsv.ReadOptions(column_names=list(COLUMNS))
+_CSV_CONVERT = pcsv.ConvertOptions(
+    column_types={"Timestamp": pa.int64(), "Latitude": pa.float64(), "Longitude": pa.float64(),
+                  "Level": pa.float64(), "Qual": pa.float64(), "SNR": pa.float64(),
+                  "CellID": pa.int64(), "NetworkTech": _CATEGORY, "BAND": _CATEGORY,
+                  "Outage": pa.bool_(), "RTT_ms": pa.float64()},
+    true_values=["t"], false_values=["f"], strings_can_be_null=True,
+)
+
+# (kľúč v odpovedi, stĺpec) pre rádiové metriky
+RADIO = (("rsrp", "Level"), ("rsrq", "Qual"), ("sinr", "SNR"))
+RADIO_PERCENTILES = (5, 10, 50, 90, 95)
+RTT_PERCENTILES = (50, 90, 95, 99)
+# hranice histogramu RTT v ms; posledný bucket je otvorený
+RTT_BUCKETS_MS = (0, 20, 50, 100, 200, 500, 1000, 2000)
+_EARTH_RADIUS_M = 6371008.8
+
+
+def read_copy_csv(data: bytes) -> pa.Table:
+    """Výstup COPY ... (FORMAT csv) so stĺpcami COLUMNS -> Arrow tabuľka."""
+    return pcsv.read_csv(pa.BufferReader(data), read_options=_CSV_READ,
+                         convert_options=_CSV_CONVERT)
+
+
+def columns(table: pa.Table) -> Dict[str, Any]:
+    """
+    Arrow tabuľka (z COPY alebo z archívu) -> NumPy stĺpce zoradené podľa
+    Timestamp. Chýbajúce hodnoty: float NaN, Outage -1, kategórie kód
+    posledného prvku zoznamu (None); CellID obsahuje len vyplnené hodnoty.
+    """
+    if table["Timestamp"].null_count:
+        table = table.filter(pc.is_valid(table["Timestamp"]))
+    ts = table["Timestamp"].to_numpy()
+    if ts.size > 1 and (ts[1:] < ts[:-1]).any():
+        order = np.argsort(ts, kind="stable")
+        table = table.take(order)
+        ts = ts[order]
+    out: Dict[str, Any] = {"Timestamp": ts}
+    for c in ("Latitude", "Longitude", "Level", "Qual", "SNR", "RTT_ms"):
+        out[c] = pc.cast(table[c], pa.float64()).to_numpy()
+    out["CellID"] = pc.drop_null(table["CellID"].cast(pa.int64())).to_numpy()
+    outage = table["Outage"].cast(pa.bool_())
+    out["Outage"] = np.where(pc.is_valid(outage).to_numpy(),
+                             pc.fill_null(outage, False).to_numpy(), -1).astype(np.int8)
+    for c in ("NetworkTech", "BAND"):
+        out[c] = _codes(table[c])
+    return out
+
+
+def _codes(col: pa.ChunkedArray) -> Tuple[Any, List[Optional[str]]]:
+    if not pa.types.is_dictionary(col.type):
+        col = pc.dictionary_encode(col.cast(pa.string()))
+    if col.num_chunks == 0:
+        return np.zeros(0, dtype=np.int64), [None]
+    arr = col.unify_dictionaries().combine_chunks()
+    names = arr.dictionary.to_pylist()
+    codes = pc.fill_null(arr.indices, len(names)).to_numpy()
+    return codes, names + [None]
+
+
+def compute(cols: Dict[str, Any], max_gap_ms: int = KPI_MAX_GAP_MS,
+            max_speed_kmh: float = KPI_MAX_SPEED_KMH,
+            max_intervals: int = KPI_MAX_INTERVALS) -> Dict[str, Any]:
+    """KPI session zo stĺpcov (pozri columns()); všetko vektorovo nad celými poľami."""
+    ts = cols["Timestamp"]
+    n = int(ts.size)
+    if n == 0:
+        return {"rows": 0}
+    # meranie "platí" do nasledujúceho, najviac max_gap_ms; posledné má 0
+    dt = np.diff(ts, append=ts[-1])
+    dt[dt > max_gap_ms] = 0
+    out: Dict[str, Any] = {
+        "rows": n,
+        "first_ts_ms": int(ts[0]),
+        "last_ts_ms": int(ts[-1]),
+        "duration_ms": int(ts[-1] - ts[0]),
+        "measured_ms": int(dt.sum()),
+    }
+    for key, col in RADIO:
+        out[key] = _distribution(cols[col], RADIO_PERCENTILES)
+    out["network_tech"] = _time_share(*cols["NetworkTech"], dt)
+    out["band"] = _time_share(*cols["BAND"], dt)
+    out["handovers"] = _handovers(cols["CellID"])
+    out["outages"] = _outages(ts, cols["Outage"], max_intervals)
+    out["distance"] = _distance(ts, cols["Latitude"], cols["Longitude"], max_speed_kmh)
+    rtt = _distribution(cols["RTT_ms"], RTT_PERCENTILES)
+    if rtt is not None:
+        x = cols["RTT_ms"]
+        counts, _ = np.histogram(x[~np.isnan(x)], bins=RTT_BUCKETS_MS + (np.inf,))
+        rtt["histogram"] = {"edges_ms": list(RTT_BUCKETS_MS), "counts": counts.tolist()}
+    out["rtt"] = rtt
+    return out
+
+
+def _distribution(x: Any, percentiles: Sequence[int]) -> Optional[Dict[str, Any]]:
+    x = x[~np.isnan(x)]
+    if not x.size:
+        return None
+    out = {"n": int(x.size), "mean": round(float(x.mean()), 3),
+           "min": float(x.min()), "max": float(x.max())}
+    for p, v in zip(percentiles, np.percentile(x, percentiles)):
+        out[f"p{p}"] = round(float(v), 3)
+    return out
+
+
+def _time_share(codes: Any, names: List[Optional[str]], dt: Any) -> List[Dict[str, Any]]:
+    k = len(names)
+    samples = np.bincount(codes, minlength=k)
+    ms = np.bincount(codes, weights=dt, minlength=k)
+    total = ms.sum()
+    out = [{"value": names[i], "samples": int(samples[i]), "ms": int(ms[i]),
+            "share": round(float(ms[i] / total), 4) if total else None}
+           for i in np.flatnonzero(samples)]
+    out.sort(key=lambda r: r["ms"], reverse=True)
+    return out
+
+
+def _handovers(cells: Any) -> Dict[str, Any]:
+    # zmena CellID medzi po sebe idúcimi vyplnenými hodnotami (ako rollupy)
+    return {"count": int(np.count_nonzero(cells[1:] != cells[:-1])),
+            "cells": int(np.unique(cells).size)}
+
+
+def _outages(ts: Any, outage: Any, max_intervals: int) -> Dict[str, Any]:
+    """
+    Rovnaká sémantika ako rollups.SessionRollup: výpadok začína prvým
+    Outage=true, končí prvým Outage=false (null sa ignoruje); neukončený
+    trvá do posledného merania session.
+    """
+    known = outage >= 0
+    o = outage[known].astype(bool)
+    t = ts[known]
+    prev = np.concatenate(([False], o[:-1]))
+    starts = t[o & ~prev]
+    ends = t[~o & prev]
+    if ends.size < starts.size:
+        ends = np.append(ends, ts[-1])
+    dur = np.maximum(ends - starts, 0)
+    shown = min(starts.size, max_intervals)
+    return {"count": int(starts.size), "total_ms": int(dur.sum()),
+            "max_ms": int(dur.max()) if dur.size else 0,
+            "intervals": np.stack([starts[:shown], ends[:shown]], axis=1).tolist(),
+            "truncated": bool(starts.size > shown)}
+
+
+def _distance(ts: Any, lat: Any, lon: Any, max_speed_kmh: float) -> Dict[str, Any]:
+    """Haversine medzi po sebe idúcimi platnými fixmi (bez NaN a 0/0), bez GPS skokov."""
+    ok = ~(np.isnan(lat) | np.isnan(lon) | ((lat == 0) & (lon == 0)))
+    la, lo, t = np.radians(lat[ok]), np.radians(lon[ok]), ts[ok]
+    if la.size < 2:
+        return {"m": 0.0, "fixes": int(la.size), "jumps": 0}
+    # a = sin²(Δφ/2) + cos φ1 · cos φ2 · sin²(Δλ/2), bez zbytočných dočasných polí
+    cos_la = np.cos(la)
+    a = np.sin(np.diff(la) / 2)
+    a *= a
+    b = np.sin(np.diff(lo) / 2)
+    b *= b
+    b *= cos_la[:-1]
+    b *= cos_la[1:]
+    a += b
+    np.minimum(a, 1.0, out=a)
+    d = 2 * _EARTH_RADIUS_M * np.arcsin(np.sqrt(a, out=a), out=a)
+    jump = d > max_speed_kmh / 3.6 * (np.diff(t) / 1000)
+    return {"m": round(float(d[~jump].sum()), 1), "fixes": int(la.size),
+            "jumps": int(np.count_nonzero(jump))}
+
+
+def kpis_from_table(table: pa.Table) -> Dict[str, Any]:
+    return compute(columns(table))
+
+
+class KpiCache:
+    """
+    LRU cache KPI per session. Záznam zneplatní zápis nového merania alebo
+    RTT session (observe ako write listener repozitára), najneskôr TTL.
+    Výsledok výpočtu, počas ktorého prišiel zápis session, sa neuloží.
+    """
+
+    def __init__(self, maxsize: int = KPI_CACHE_SIZE, ttl_s: float = KPI_CACHE_TTL_S) -> None:
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # session -> počas prebiehajúceho výpočtu prišiel zápis
+        self._loading: Dict[str, bool] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        item = self._data.get(session_id)
+        if item is None or time.monotonic() - item[0] > self.ttl_s:
+            if item is not None:
+                del self._data[session_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(session_id)
+        self.hits += 1
+        return item[1]
+
+    def begin(self, session_id: str) -> None:
+        self._loading[session_id] = False
+
+    def end(self, session_id: str, value: Optional[Dict[str, Any]]) -> None:
+        stale = self._loading.pop(session_id, True)
+        if value is not None and not stale:
+            self.put(session_id, value)
+
+    def put(self, session_id: str, value: Dict[str, Any]) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[session_id] = (time.monotonic(), value)
+        self._data.move_to_end(session_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, session_ids: Iterable[Optional[str]]) -> None:
+        for sid in session_ids:
+            self._data.pop(sid, None)
+            if sid in self._loading:
+                self._loading[sid] = True
+
+    def observe(self, inserted: List[Dict[str, Any]],
+                rtt_fills: List[Tuple[Optional[str], float]]) -> None:
+        """write listener: nové riadky meraní a RTT doplnené k starším riadkom."""
+        if not (self._data or self._loading):
+            return
+        sids = {r.get("SessionId") for r in inserted}
+        sids.update(sid for sid, _ in rtt_fills)
+        self.invalidate(sids)
+
+
+KPI_CACHE = KpiCache()
+
+
+class KpiReader:
+    """
+    KPI session pre endpoint /sessions/{id}/kpis a CLI.
+    - Stĺpce COLUMNS sa z DB načítajú jedným COPY (CSV), ktoré parsuje
+      pyarrow; parsovanie aj výpočet v NumPy bežia mimo event loopu.
+    - Session, ktorá v DB nemá žiadne riadky (ARCHIVE_PRUNE), sa číta
+      z archívu (archive), ak je zadaný.
+    - Súbežné požiadavky na tú istú session zdieľajú jeden výpočet.
+    """
+
+    def __init__(self, engine: AsyncEngine, cache: KpiCache = KPI_CACHE,
+                 archive: Optional[ArchiveReader] = None) -> None:
+        self.engine = engine
+        self.cache = cache
+        self.archive = archive
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """KPI session; None, ak session nemá žiadne merania."""
+        cached = self.cache.get(session_id)
+        if cached is not None:
+            return cached
+        fut = self._inflight.get(session_id)
+        if fut is None:
+            fut = self._inflight[session_id] = asyncio.ensure_future(self._compute(session_id))
+            fut.add_done_callback(lambda f: self._done(session_id, f))
+        return await asyncio.shield(fut)
+
+    def _done(self, session_id: str, fut: asyncio.Future) -> None:
+        self._inflight.pop(session_id, None)
+        if not fut.cancelled():
+            # výnimku dostanú čakajúci; bez nich by sa zalogovala ako nevyzdvihnutá
+            fut.exception()
+
+    async def _compute(self, session_id: str) -> Optional[Dict[str, Any]]:
+        self.cache.begin(session_id)
+        result = None
+        try:
+            t0 = time.perf_counter()
+            data = await self._copy(session_id)
+            t_load = time.perf_counter()
+            if data:
+                source = "db"
+                result = await asyncio.to_thread(lambda: kpis_from_table(read_copy_csv(data)))
+            elif self.archive is not None and self.archive.has_session(session_id):
+                source = "archive"
+                result = await asyncio.to_thread(
+                    lambda: kpis_from_table(self.archive.read_session(session_id, COLUMNS)))
+            else:
+                return None
+            if not result["rows"]:
+                result = None
+                return None
+            t_done = time.perf_counter()
+            result = {"session_id": session_id, "source": source, **result,
+                      "load_ms": round((t_load - t0) * 1000, 1),
+                      "compute_ms": round((t_done - t_load) * 1000, 1)}
+            log.info("KPIs for session %s: %d rows from %s in %.0f ms", session_id,
+                     result["rows"], source, (t_done - t0) * 1000)
+            return result
+        finally:
+            self.cache.end(session_id, result)
+
+    async def _copy(self, session_id: str) -> bytes:
+        chunks: List[bytes] = []
+
+        async def sink(chunk: bytes) -> None:
+            chunks.append(chunk)
+
+        async with self.engine.connect() as conn:
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.copy_from_query(
+                _COPY_SQL, session_id, output=sink, format="csv")
+        return b"".join(chunks)
+
+
+async def main(argv: Optional[Sequence[str]] = None) -> None:
+    """KPI sessions z príkazového riadka ako NDJSON: python kpi.py SESSION_ID [...]"""
+    ap = argparse.ArgumentParser(description="KPI drive-test sessions (NDJSON na stdout)")
+    ap.add_argument("session_ids", nargs="+")
+    ap.add_argument("--archive", default=ARCHIVE_DIR,
+                    help="adresár archívu pre sessions bez riadkov v DB")
+    ap.add_argument("--indent", type=int, default=None, help="odsadenie JSON")
+    args = ap.parse_args(argv)
+    if not ASYNC_DSN:
+        raise SystemExit("DATABASE_URL is not set")
+    engine = create_async_engine(ASYNC_DSN, pool_size=1, max_overflow=0)
+    reader = KpiReader(engine, KpiCache(maxsize=0),
+                       archive=ArchiveReader(args.archive) if args.archive else None)
+    try:
+        for sid in args.session_ids:
+            kpis = await reader.get(sid)
+            if kpis is None:
+                log.warning("Session %s has no measurements", sid)
+                continue
+            print(json.dumps(kpis, ensure_ascii=False, indent=args.indent), flush=True)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
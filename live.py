@@ -0,0 +1,309 @@
+# live.py
+from __future__ import annotations
+import asyncio
+import os
+from collections import Counter, OrderedDict, deque
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from decoding import JSON, MSGPACK, decode_frame, encode_message
+from logger import get_logger, get_hot_logger, setup_logging
+
+setup_logging()
+log = get_logger("live")
+hot_log = get_hot_logger("live")
+
+# Max. počet správ čakajúcich na odoslanie jednému odberateľovi.
+LIVE_BUFFER = int(os.getenv("LIVE_BUFFER", "256"))
+# Čo robiť pri plnom bufferi: drop_oldest (zahodí najstaršiu správu) alebo
+# conflate (drží len poslednú správu každej session).
+LIVE_POLICY = os.getenv("LIVE_POLICY", "drop_oldest").lower()
+# Max. počet súčasne pripojených dashboardov.
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "100"))
+
+DROP_OLDEST = "drop_oldest"
+CONFLATE = "conflate"
+POLICIES = (DROP_OLDEST, CONFLATE)
+
+# rovnaký subprotocol ako /ws (websocket.SUBPROTOCOL_MSGPACK)
+SUBPROTOCOL_MSGPACK = "drivetest.msgpack"
+
+
+class LiveMessage:
+    """
+    Jedna správa pre všetkých odberateľov. Zakóduje sa lenivo, až v odosielacej
+    úlohe prvého odberateľa, a najviac raz pre každé kódovanie (JSON / MessagePack).
+    """
+
+    __slots__ = ("key", "obj", "_payloads")
+
+    def __init__(self, key: Tuple[str, Any], obj: Dict[str, Any]) -> None:
+        # kľúč pre conflation: (druh správy, session_id)
+        self.key = key
+        self.obj = obj
+        self._payloads: Dict[str, bytes] = {}
+
+    def payload(self, fmt: str) -> bytes:
+        p = self._payloads.get(fmt)
+        if p is None:
+            p = self._payloads[fmt] = encode_message(self.obj, fmt)
+        return p
+
+
+class LiveSubscriber:
+    """
+    Jeden dashboard: filter (session_ids a/alebo bbox) a ohraničený buffer.
+    push() nikdy neblokuje – pri plnom bufferi sa podľa politiky zahodí
+    najstaršia správa, resp. sa nahradí staršia správa tej istej session.
+    """
+
+    __slots__ = ("fmt", "policy", "maxlen", "session_ids", "bbox",
+                 "dropped", "sent", "_buf", "_wake")
+
+    def __init__(self, fmt: str = JSON, policy: str = LIVE_POLICY,
+                 maxlen: int = LIVE_BUFFER) -> None:
+        self.fmt = fmt
+        self.maxlen = max(1, int(maxlen))
+        self.session_ids: Set[str] = set()
+        # (min_lon, min_lat, max_lon, max_lat)
+        self.bbox: Optional[Tuple[float, float, float, float]] = None
+        self.dropped = 0
+        self.sent = 0
+        self._wake = asyncio.Event()
+        self.policy = DROP_OLDEST
+        self._buf: Any = deque()
+        self.set_policy(policy)
+
+    def set_policy(self, policy: str) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy: {policy}")
+        if policy == self.policy:
+            return
+        pending = list(self._buf.values() if self.policy == CONFLATE else self._buf)
+        self.policy = policy
+        self._buf = OrderedDict() if policy == CONFLATE else deque()
+        for msg in pending:
+            self.push(msg)
+
+    def matches(self, lon: Optional[float], lat: Optional[float]) -> bool:
+        b = self.bbox
+        if b is None or lon is None or lat is None:
+            return False
+        return b[0] <= lon <= b[2] and b[1] <= lat <= b[3]
+
+    def push(self, msg: LiveMessage) -> None:
+        buf = self._buf
+        if self.policy == CONFLATE:
+            if msg.key in buf:
+                del buf[msg.key]
+                self.dropped += 1
+            elif len(buf) >= self.maxlen:
+                buf.popitem(last=False)
+                self.dropped += 1
+            buf[msg.key] = msg
+        else:
+            if len(buf) >= self.maxlen:
+                buf.popleft()
+                self.dropped += 1
+            buf.append(msg)
+        self._wake.set()
+
+    async def take(self) -> List[LiveMessage]:
+        """Počká na aspoň jednu správu a vyberie celý buffer."""
+        while not self._buf:
+            self._wake.clear()
+            await self._wake.wait()
+        buf = self._buf
+        out = list(buf.values()) if self.policy == CONFLATE else list(buf)
+        buf.clear()
+        return out
+
+
+class LiveHub:
+    """
+    Fan-out práve zapísaných meraní na dashboardy (/live).
+    - observe() je write listener repository: beží v ingest workeri po commite,
+      preto len nájde odberateľov a vloží im správu do bufferu (bez I/O a bez
+      serializácie; bez odberateľov nerobí nič).
+    - Každý odberateľ má vlastnú odosielaciu úlohu; pomalý dashboard zaplní
+      iba svoj buffer a ingest nikdy nebrzdí.
+    - Posielajú sa len naozaj vložené riadky (replaye po reconnecte nie)
+      a RTT doplnené k už uloženým meraniam.
+    """
+
+    def __init__(self, buffer: int = LIVE_BUFFER, policy: str = LIVE_POLICY,
+                 max_subscribers: int = LIVE_MAX_SUBSCRIBERS) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"LIVE_POLICY must be one of {POLICIES}, got {policy!r}")
+        self.buffer = buffer
+        self.policy = policy
+        self.max_subscribers = max_subscribers
+        self.subscribers: Set[LiveSubscriber] = set()
+        # session_id -> odberatelia tejto session
+        self._by_session: Dict[str, Set[LiveSubscriber]] = {}
+        self._bbox: Set[LiveSubscriber] = set()
+        # počty publikovaných / zahodených správ (pre monitoring)
+        self.stats: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def dropped(self) -> int:
+        """Zahodené správy spolu (odpojení + aktuálni odberatelia)."""
+        return self.stats["dropped"] + sum(s.dropped for s in self.subscribers)
+
+    def subscribe(self, sub: LiveSubscriber, session_ids: Iterable[str] = (),
+                  bbox: Optional[Tuple[float, float, float, float]] = None) -> None:
+        """Nastaví (nahradí) filter odberateľa."""
+        self.unsubscribe(sub)
+        sub.session_ids = {str(s) for s in session_ids}
+        sub.bbox = bbox
+        for sid in sub.session_ids:
+            self._by_session.setdefault(sid, set()).add(sub)
+        if bbox is not None:
+            self._bbox.add(sub)
+
+    def unsubscribe(self, sub: LiveSubscriber) -> None:
+        for sid in sub.session_ids:
+            subs = self._by_session.get(sid)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._by_session[sid]
+        sub.session_ids = set()
+        sub.bbox = None
+        self._bbox.discard(sub)
+
+    def observe(self, inserted: List[Dict[str, Any]],
+                rtt_fills: List[Tuple[Optional[str], float]]) -> None:
+        """write listener: nové riadky meraní a RTT doplnené k starším riadkom."""
+        if not (self._by_session or self._bbox):
+            return
+        by_session, by_bbox = self._by_session, self._bbox
+        published = 0
+        for row in inserted:
+            sid = row.get("SessionId")
+            targets = by_session.get(sid, ()) if sid else ()
+            if by_bbox:
+                lon, lat = row.get("Longitude"), row.get("Latitude")
+                hits = [s for s in by_bbox if s.matches(lon, lat)]
+                if hits:
+                    targets = set(targets).union(hits)
+            if not targets:
+                continue
+            msg = LiveMessage(("m", sid), {"type": "live_measurement", "row": row})
+            for sub in targets:
+                sub.push(msg)
+            published += 1
+        for sid, rtt in rtt_fills:
+            targets = by_session.get(sid) if sid else None
+            if not targets:
+                continue
+            msg = LiveMessage(("rtt", sid), {"type": "live_rtt", "session_id": sid,
+                                             "rtt_ms": rtt})
+            for sub in targets:
+                sub.push(msg)
+            published += 1
+        if published:
+            self.stats["published"] += published
+
+    async def handle(self, ws: WebSocket) -> None:
+        """
+        Protokol /live (JSON text alebo MessagePack cez subprotocol ako /ws):
+        - klient: {"type": "subscribe", "session_ids": [...],
+          "bbox": [min_lon, min_lat, max_lon, max_lat], "policy": "conflate"}
+          (nahradí predošlý filter), {"type": "unsubscribe"};
+        - server: "subscribed" / "error", potom "live_measurement" a "live_rtt";
+          pred nimi "live_dropped" s počtom zahodených správ od minulého odoslania.
+        """
+        offered = ws.scope.get("subprotocols") or []
+        subprotocol = SUBPROTOCOL_MSGPACK if SUBPROTOCOL_MSGPACK in offered else None
+        if len(self.subscribers) >= self.max_subscribers:
+            log.warning("Live subscriber limit reached (%d)", self.max_subscribers)
+            await ws.close(code=1013)
+            return
+        await ws.accept(subprotocol=subprotocol)
+        fmt = MSGPACK if subprotocol else JSON
+        sub = LiveSubscriber(fmt, self.policy, self.buffer)
+        self.subscribers.add(sub)
+        sender = asyncio.create_task(self._send_loop(ws, sub), name="live-sender")
+        log.info("Live subscriber connected from %s", getattr(ws.client, "host", "?"))
+        try:
+            while True:
+                msg = await ws.receive()
+                if msg["type"] == "websocket.disconnect":
+                    break
+                raw = msg.get("text")
+                data = decode_frame(raw if raw is not None else (msg.get("bytes") or b""),
+                                    JSON if raw is not None else fmt)
+                if data is None:
+                    continue
+                reply = self._control(sub, data)
+                if reply is not None:
+                    await _send(ws, encode_message(reply, fmt), fmt)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+            try:
+                await sender
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.unsubscribe(sub)
+            self.subscribers.discard(sub)
+            self.stats["dropped"] += sub.dropped
+            log.info("Live subscriber disconnected (sent=%d dropped=%d)",
+                     sub.sent, sub.dropped)
+
+    def _control(self, sub: LiveSubscriber, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        msg_type = data.get("type")
+        if msg_type == "unsubscribe":
+            self.unsubscribe(sub)
+            return {"type": "unsubscribed"}
+        if msg_type != "subscribe":
+            return {"type": "error", "error": f"unknown message type: {msg_type}"}
+        try:
+            session_ids = data.get("session_ids") or []
+            if not isinstance(session_ids, list):
+                raise ValueError("session_ids must be a list")
+            bbox = _parse_bbox(data.get("bbox"))
+            sub.set_policy(data.get("policy") or sub.policy)
+        except ValueError as e:
+            return {"type": "error", "error": str(e)}
+        self.subscribe(sub, session_ids, bbox)
+        return {"type": "subscribed", "session_ids": sorted(sub.session_ids),
+                "bbox": list(bbox) if bbox else None, "policy": sub.policy,
+                "buffer": sub.maxlen}
+
+    async def _send_loop(self, ws: WebSocket, sub: LiveSubscriber) -> None:
+        reported = 0
+        while True:
+            batch = await sub.take()
+            if sub.dropped > reported:
+                await _send(ws, encode_message(
+                    {"type": "live_dropped", "count": sub.dropped - reported}, sub.fmt), sub.fmt)
+                reported = sub.dropped
+            for m in batch:
+                await _send(ws, m.payload(sub.fmt), sub.fmt)
+            sub.sent += len(batch)
+            hot_log.info("Live sent %d messages", len(batch))
+
+
+def _parse_bbox(v: Any) -> Optional[Tuple[float, float, float, float]]:
+    if v is None:
+        return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(x) for x in v)
+    except (TypeError, ValueError):
+        raise ValueError("bbox must be [min_lon, min_lat, max_lon, max_lat]")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError("bbox min must not exceed max")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+async def _send(ws: WebSocket, payload: bytes, fmt: str) -> None:
+    if fmt == JSON:
+        await ws.send_text(payload.decode())
+    else:
+        await ws.send_bytes(payload)
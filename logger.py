@@ -1,24 +1,58 @@
 # logger.py
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+from collections import Counter
+from typing import Any, Dict, Optional
 
+LOG_FORMAT = "%(asctime)s | %(levelname)-8s | %(name)s | %(module)s.%(funcName)s:%(lineno)d | %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
 
-def setup_logging(level: str | None = None) -> None:
+# Počet potlačených per-message riadkov podľa loggera (pre monitoring).
+suppressed_lines: Counter = Counter()
+
+
+def setup_logging(level: str | None = None, mode: str | None = None) -> None:
+    """
+    mode (LOG_MODE):
+    - "sync" (default): ako doteraz, zápis priamo na stdout.
+    - "hotpath": záznamy idú cez QueueHandler do QueueListener vlákna,
+      per-message riadky (get_hot_logger) sa samplujú 1 z LOG_SAMPLE_N.
+    Formát riadku je v oboch režimoch rovnaký (LOG_FORMAT).
+    """
     if getattr(setup_logging, "_configured", False):
         return
 
     level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
-    fmt = "%(asctime)s | %(levelname)-8s | %(name)s | %(module)s.%(funcName)s:%(lineno)d | %(message)s"
-    datefmt = "%Y-%m-%d %H:%M:%S"
+    mode = (mode or os.getenv("LOG_MODE", "sync")).lower()
 
-    logging.basicConfig(
-        level=level,
-        format=fmt,
-        datefmt=datefmt,
-        stream=sys.stdout,
-        force=True,
-    )
+    if mode == "hotpath":
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+        q: queue.SimpleQueue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            q, handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        root = logging.getLogger()
+        for h in root.handlers[:]:
+            root.removeHandler(h)
+        root.addHandler(logging.handlers.QueueHandler(q))
+        root.setLevel(level)
+        setup_logging._sample_n = max(1, int(os.getenv("LOG_SAMPLE_N", "100")))
+    else:
+        logging.basicConfig(
+            level=level,
+            format=LOG_FORMAT,
+            datefmt=LOG_DATEFMT,
+            stream=sys.stdout,
+            force=True,
+        )
+        setup_logging._sample_n = 1
 
     logging.getLogger("asyncio").setLevel(logging.WARNING)
     logging.getLogger("uvicorn.error").setLevel(level)
@@ -29,3 +63,47 @@ def setup_logging(level: str | None = None) -> None:
 
 def get_logger(name: str = "app") -> logging.Logger:
     return logging.getLogger(name)
+
+
+class SampledLogger:
+    """
+    Logger pre riadky, ktoré vznikajú pri každej správe.
+    V hotpath režime prepustí prvý výskyt a potom 1 z N riadkov pre každý
+    formát správy; k prepustenému riadku pripíše počet potlačených.
+    Suppressed riadky nevytvárajú LogRecord ani neformátujú argumenty.
+    """
+
+    __slots__ = ("_log", "_suppressed")
+
+    def __init__(self, log: logging.Logger) -> None:
+        self._log = log
+        self._suppressed: Dict[str, int] = {}
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self._log.isEnabledFor(level)
+
+    def debug(self, msg: str, *args: Any) -> None:
+        self._emit(logging.DEBUG, msg, args)
+
+    def info(self, msg: str, *args: Any) -> None:
+        self._emit(logging.INFO, msg, args)
+
+    def _emit(self, level: int, msg: str, args: tuple) -> None:
+        if not self._log.isEnabledFor(level):
+            return
+        n = getattr(setup_logging, "_sample_n", 1)
+        if n > 1:
+            sup: Optional[int] = self._suppressed.get(msg)
+            if sup is not None and sup < n - 1:
+                self._suppressed[msg] = sup + 1
+                suppressed_lines[self._log.name] += 1
+                return
+            self._suppressed[msg] = 0
+            if sup:
+                msg = "%s [+%d suppressed]" % (msg, sup)
+        # stacklevel=3: module/funcName/lineno ukazujú na volajúceho, nie sem
+        self._log.log(level, msg, *args, stacklevel=3)
+
+
+def get_hot_logger(name: str = "app") -> SampledLogger:
+    return SampledLogger(logging.getLogger(name))
@@ -0,0 +1,148 @@
+# memrepo.py
+from __future__ import annotations
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dbhandler import _extract_fields, _dedupe_rows, _i, _notify, _s
+from logger import get_logger, get_hot_logger, setup_logging
+from rollups import rtt_quantiles
+
+setup_logging()
+log = get_logger("memrepo")
+hot_log = get_hot_logger("memrepo")
+
+_ADDITIVE = ("msg_count", "rtt_count", "rtt_sum_ms", "outage_count", "outage_ms", "cell_changes")
+
+
+class InMemoryRepository:
+    """
+    Repository bez databázy (DB_BACKEND=memory) pre benchmarky a lokálne
+    skúšanie WebSocket + worker pipeline. Rovnaká idempotencia ako
+    PostgresRepository: duplicitné Id sa preskočí, RTT sa doplní len ak chýba.
+    commit_latency_ms simuluje čas jedného DB commitu.
+    """
+
+    def __init__(self, commit_latency_ms: float = 0.0) -> None:
+        self.commit_latency_ms = commit_latency_ms
+        self.measurements: Dict[str, Dict[str, Any]] = {}
+        self.session_stats: Dict[str, Dict[str, Any]] = {}
+        self.write_listeners: List[Callable] = []
+        # rovnaký kontrakt ako PostgresRepository.conflict_key
+        self.conflict_key = ("Id",)
+
+    async def start(self) -> None:
+        log.info("Starting InMemoryRepository")
+
+    async def stop(self) -> None:
+        log.info("Stopping InMemoryRepository (%d measurements)", len(self.measurements))
+
+    async def warm_up(self, connections: int = 0) -> int:
+        return 0
+
+    async def ping(self, timeout: float = 1.0) -> bool:
+        return True
+
+    def pool_status(self) -> Dict[str, int]:
+        return {"checked_out": 0, "overflow": 0, "size": 0}
+
+    async def _commit(self) -> None:
+        if self.commit_latency_ms > 0:
+            await asyncio.sleep(self.commit_latency_ms / 1000.0)
+
+    def _put(self, row: Dict[str, Any], new_rows: List[Dict[str, Any]],
+             fills: List[tuple]) -> int:
+        rid = row.get("Id")
+        cur = self.measurements.get(rid)
+        if cur is None:
+            row.setdefault("RTT_ms", None)
+            self.measurements[rid] = row
+            new_rows.append(row)
+            return 1
+        if cur.get("RTT_ms") is None and row.get("RTT_ms") is not None:
+            cur["RTT_ms"] = row["RTT_ms"]
+            fills.append((cur.get("SessionId"), cur["RTT_ms"]))
+        # duplikát (aj s doplneným RTT) sa do vložených nepočíta
+        return 0
+
+    async def insert_measurement_flat(self, payload: Dict[str, Any],
+                                      rtt_ms: Optional[float] = None) -> int:
+        return await self.insert_measurements_flat(
+            [payload], {_s(payload.get("id")): rtt_ms} if rtt_ms is not None else None)
+
+    async def insert_measurements_flat(self, payloads: List[Dict[str, Any]],
+                                       rtts: Optional[Dict[str, float]] = None) -> int:
+        if not payloads:
+            return 0
+        hot_log.info("Inserting batch of %d measurements", len(payloads))
+        rows = _dedupe_rows([_extract_fields(p) for p in payloads])
+        rtts = rtts or {}
+        for r in rows:
+            rtt = rtts.get(r["Id"])
+            r["RTT_ms"] = float(rtt) if rtt is not None else None
+        await self._commit()
+        new_rows: List[Dict[str, Any]] = []
+        fills: List[tuple] = []
+        written = sum(self._put(r, new_rows, fills) for r in rows)
+        _notify(self.write_listeners, new_rows, fills)
+        return written
+
+    async def apply_rtt(self, meas_id: str, rtt_ms: float) -> int:
+        return await self.apply_rtt_many({meas_id: rtt_ms})
+
+    async def apply_rtt_many(self, rtts: Dict[str, float]) -> int:
+        if not rtts:
+            return 0
+        hot_log.info("Applying %d RTT updates", len(rtts))
+        await self._commit()
+        fills: List[tuple] = []
+        for uid, rtt in rtts.items():
+            cur = self.measurements.get(str(uid))
+            if cur is not None and cur.get("RTT_ms") is None:
+                cur["RTT_ms"] = float(rtt)
+                fills.append((cur.get("SessionId"), cur["RTT_ms"]))
+        _notify(self.write_listeners, [], fills)
+        return len(fills)
+
+    async def recent_ids(self, since_ms: int, limit: int) -> List[Tuple[str, bool]]:
+        rows = [r for r in self.measurements.values()
+                if (r.get("Timestamp") or 0) >= since_ms][:limit]
+        return [(r["Id"], r.get("RTT_ms") is not None) for r in rows]
+
+    async def upsert_session_stats(self, payload: Dict[str, Any]) -> None:
+        sid = _s(payload.get("session_id"))
+        if not sid:
+            log.info("upsert_session_stats: missing session_id")
+            return
+        await self._commit()
+        st = self.session_stats.setdefault(sid, {"session_id": sid})
+        st["started_at_ms"] = _least(st.get("started_at_ms"), _i(payload.get("started_at_ms")))
+        st["ended_at_ms"] = _greatest(st.get("ended_at_ms"), _i(payload.get("ended_at_ms")))
+        st["reconnect_count"] = _i(payload.get("reconnect_count")) or 0
+        st["total_downtime_ms"] = _i(payload.get("total_downtime_ms")) or 0
+        st["client_reported"] = True
+
+    async def upsert_session_rollups(self, rows: List[Dict[str, Any]]) -> None:
+        await self._commit()
+        for r in rows:
+            st = self.session_stats.setdefault(r["session_id"], {"session_id": r["session_id"]})
+            for c in _ADDITIVE:
+                st[c] = st.get(c, 0) + r[c]
+            st["first_ts_ms"] = _least(st.get("first_ts_ms"), r["first_ts_ms"])
+            st["last_ts_ms"] = _greatest(st.get("last_ts_ms"), r["last_ts_ms"])
+            st["started_at_ms"] = _least(st.get("started_at_ms"), r["first_ts_ms"])
+            st["ended_at_ms"] = _greatest(st.get("ended_at_ms"), r["last_ts_ms"])
+            st["outage_max_ms"] = _greatest(st.get("outage_max_ms"), r["outage_max_ms"])
+            old = st.get("rtt_sketch")
+            st["rtt_sketch"] = ([a + b for a, b in zip(old, r["rtt_sketch"])]
+                                if old else list(r["rtt_sketch"]))
+            if r["rtt_count"]:
+                st.update(rtt_quantiles(st["rtt_sketch"]))
+
+
+def _least(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    # ako SQL LEAST/GREATEST: NULL sa ignoruje
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _greatest(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    return b if a is None else a if b is None else max(a, b)
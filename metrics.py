@@ -0,0 +1,171 @@
+# metrics.py
+import os
+from typing import Any, Dict, Optional
+
+from logger import get_logger, setup_logging, suppressed_lines
+
+setup_logging()
+log = get_logger("metrics")
+
+# Pri METRICS_ENABLED=false sú všetky metriky no-op objekty (žiadne locky ani
+# alokácie v hot path) a /metrics vracia 404.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                300.0, 3600.0)
+
+
+class _Noop:
+    __slots__ = ()
+
+    def labels(self, *args: Any, **kwargs: Any) -> "_Noop":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+
+# MessageProcessor a repository pre gauges počítané až pri scrape (bind()).
+_processor: Optional[Any] = None
+_repo: Optional[Any] = None
+_live: Optional[Any] = None
+_archiver: Optional[Any] = None
+# trvanie fáz štartu v sekundách (import, db_start, prewarm, worker_start, total); plní app.lifespan
+STARTUP: Dict[str, float] = {}
+
+
+def bind(processor: Any, repo: Any, live: Optional[Any] = None,
+         archiver: Optional[Any] = None) -> None:
+    global _processor, _repo, _live, _archiver
+    _processor = processor
+    _repo = repo
+    _live = live
+    _archiver = archiver
+
+
+if METRICS_ENABLED:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest,
+    )
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+    _messages = Counter(
+        "ingest_messages_total", "Messages by pipeline stage", ["stage"])
+
+    RECEIVE_TO_ACK = Histogram(
+        "ingest_receive_to_ack_seconds", "Frame received -> ACK sent",
+        buckets=_LATENCY_BUCKETS)
+    ENQUEUE_TO_DEQUEUE = Histogram(
+        "ingest_enqueue_to_dequeue_seconds", "Time spent in the worker queue",
+        buckets=_LATENCY_BUCKETS)
+    DEQUEUE_TO_COMMIT = Histogram(
+        "ingest_dequeue_to_commit_seconds", "Worker batch processing incl. DB commit",
+        buckets=_LATENCY_BUCKETS)
+    DEVICE_LAG = Histogram(
+        "ingest_device_lag_seconds", "Server receive time - timestamp_sent",
+        buckets=_LAG_BUCKETS)
+
+    class _RuntimeCollector:
+        """Hodnoty, ktoré sa čítajú až pri scrape (nulová cena v hot path)."""
+
+        def collect(self):
+            if _processor is not None:
+                depth = GaugeMetricFamily(
+                    "ingest_queue_depth", "Worker shard queue depth", labels=["shard"])
+                cap = GaugeMetricFamily(
+                    "ingest_queue_capacity", "Worker shard queue capacity", labels=["shard"])
+                qbytes = GaugeMetricFamily(
+                    "ingest_queue_bytes", "Estimated memory of queued records", labels=["shard"])
+                qbytes_cap = GaugeMetricFamily(
+                    "ingest_queue_max_bytes", "Worker shard queue byte budget", labels=["shard"])
+                for s in _processor.shard_stats(top=0):
+                    depth.add_metric([str(s["shard"])], s["depth"])
+                    cap.add_metric([str(s["shard"])], s["maxsize"])
+                    qbytes.add_metric([str(s["shard"])], s["bytes"])
+                    qbytes_cap.add_metric([str(s["shard"])], s["max_bytes"])
+                yield depth
+                yield cap
+                yield qbytes
+                yield qbytes_cap
+                flow = CounterMetricFamily(
+                    "ingest_flow", "Admission control events", labels=["event"])
+                for event, n in _processor.flow_stats.items():
+                    flow.add_metric([event], n)
+                yield flow
+                if _processor.ids is not None:
+                    ids = CounterMetricFamily(
+                        "ingest_idcache", "Idempotency cache lookups",
+                        labels=["cache", "event"])
+                    size = GaugeMetricFamily(
+                        "ingest_idcache_size", "Idempotency cache entries", labels=["cache"])
+                    for cache, st in _processor.ids.stats().items():
+                        for event in ("hits", "misses", "evictions"):
+                            ids.add_metric([cache, event], st[event])
+                        size.add_metric([cache], st["size"])
+                    yield ids
+                    yield size
+            if _repo is not None:
+                pool = GaugeMetricFamily(
+                    "db_pool_connections", "DB pool connections", labels=["state"])
+                for state, n in _repo.pool_status().items():
+                    pool.add_metric([state], n)
+                yield pool
+            if _live is not None:
+                yield GaugeMetricFamily(
+                    "live_subscribers", "Connected /live dashboards", value=len(_live))
+                yield CounterMetricFamily(
+                    "live_published", "Messages fanned out to /live subscribers",
+                    value=_live.stats["published"])
+                yield CounterMetricFamily(
+                    "live_dropped", "Messages dropped or conflated for slow /live subscribers",
+                    value=_live.dropped())
+            if _archiver is not None:
+                arch = CounterMetricFamily(
+                    "session_archive", "Archived sessions, rows, bytes, pruned rows and failures", labels=["event"])
+                for event, n in _archiver.stats.items():
+                    arch.add_metric([event], n)
+                yield arch
+            if STARTUP:
+                startup = GaugeMetricFamily(
+                    "startup_seconds", "Import-to-ready time by phase", labels=["phase"])
+                for phase, sec in STARTUP.items():
+                    startup.add_metric([phase], sec)
+                yield startup
+            logs = CounterMetricFamily(
+                "log_suppressed_lines", "Sampled-out per-message log lines", labels=["logger"])
+            for name, n in suppressed_lines.items():
+                logs.add_metric([name], n)
+            yield logs
+
+    REGISTRY.register(_RuntimeCollector())
+
+    def render() -> tuple:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+    def serve(port: int) -> None:
+        """Samostatný /metrics HTTP server (writer.py nemá FastAPI)."""
+        from prometheus_client import start_http_server
+        start_http_server(port)
+else:
+    _messages = _Noop()
+    RECEIVE_TO_ACK = ENQUEUE_TO_DEQUEUE = DEQUEUE_TO_COMMIT = DEVICE_LAG = _Noop()
+
+    def render() -> tuple:
+        return b"", "text/plain"
+
+    def serve(port: int) -> None:
+        pass
+
+
+RECEIVED = _messages.labels("received")
+ACKED = _messages.labels("acked")
+ENQUEUED = _messages.labels("enqueued")
+INSERTED = _messages.labels("inserted")
+DUPLICATE = _messages.labels("duplicate")
+RTT_APPLIED = _messages.labels("rtt_applied")
+FAILED = _messages.labels("failed")
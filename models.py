@@ -4,7 +4,8 @@ from datetime import datetime
 from typing import Optional
 
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Boolean, String, Float, Integer, BigInteger, DateTime, func
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import Boolean, String, Float, Integer, SmallInteger, BigInteger, DateTime, Index, func
 
 
 class Base(DeclarativeBase):
@@ -13,11 +14,17 @@ class Base(DeclarativeBase):
 
 class Measurement(Base):
     __tablename__ = "measurements"
+    __table_args__ = (
+        # dotazy na session v časovom okne; pokrýva aj samotné SessionId
+        Index("ix_measurements_session_ts", "SessionId", "Timestamp"),
+        # Timestamp rastie s poradím insertov -> BRIN je malý a lacný na údržbu
+        Index("ix_measurements_ts_brin", "Timestamp", postgresql_using="brin"),
+    )
 
     Id: Mapped[str] = mapped_column(String, primary_key=True)
 
     SessionId: Mapped[str | None] = mapped_column(
-        String, nullable=True, index=True)
+        String, nullable=True)
 
     Timestamp: Mapped[Optional[int]] = mapped_column(
         BigInteger, nullable=True)
@@ -76,6 +83,120 @@ class SessionStats(Base):
     total_downtime_ms: Mapped[int] = mapped_column(
         BigInteger, nullable=False, default=0)
 
+    # ---- serverom počítané rollupy (rollups.SessionRollups) ----
+    msg_count: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, default=0, server_default="0")
+    first_ts_ms: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    last_ts_ms: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+
+    rtt_count: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, default=0, server_default="0")
+    rtt_sum_ms: Mapped[float] = mapped_column(
+        Float, nullable=False, default=0, server_default="0")
+    # rollups.RttSketch.counts (kvantily RTT)
+    rtt_sketch: Mapped[Optional[list]] = mapped_column(ARRAY(BigInteger), nullable=True)
+    # kvantily zo zlúčeného rtt_sketch, prepočítané pri každom flushi (rollups.RTT_QUANTILES)
+    rtt_p50_ms: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    rtt_p90_ms: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    rtt_p99_ms: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+    outage_count: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, server_default="0")
+    outage_ms: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, default=0, server_default="0")
+    outage_max_ms: Mapped[int] = mapped_column(
+        BigInteger, nullable=False, default=0, server_default="0")
+
+    cell_changes: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, server_default="0")
+
+    # prišiel aj session_summary od klienta
+    client_reported: Mapped[bool] = mapped_column(
+        Boolean, nullable=False, default=False, server_default="false")
+
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False
+    )
+
+
+class CoverageTile(Base):
+    """
+    Priebežné agregáty pokrytia pre mapové dlaždice (slippy-map zoom/x/y).
+    Kľúč: dlaždica × technológia × pásmo × bunka; chýbajúce hodnoty sú
+    '' / '' / -1, aby mohli byť súčasťou primárneho kľúča.
+    Pre každú metriku: počet, súčet, súčet štvorcov, min a max.
+    """
+    __tablename__ = "coverage_tiles"
+
+    zoom: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    x: Mapped[int] = mapped_column(Integer, primary_key=True)
+    y: Mapped[int] = mapped_column(Integer, primary_key=True)
+    network_tech: Mapped[str] = mapped_column(String(16), primary_key=True)
+    band: Mapped[str] = mapped_column(String, primary_key=True)
+    cell_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+
+    n: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    # RSRP (Measurement.Level)
+    level_n: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    level_sum: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    level_sumsq: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    level_min: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    level_max: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # RSRQ (Measurement.Qual)
+    qual_n: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    qual_sum: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    qual_sumsq: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    qual_min: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    qual_max: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # SINR (Measurement.SNR)
+    snr_n: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    snr_sum: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    snr_sumsq: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    snr_min: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    snr_max: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
     updated_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False
     )
+
+
+class SessionArchive(Base):
+    """
+    Session zapísaná do stĺpcového archívu (archive.SessionArchiver).
+    source_updated_at = session_stats.updated_at v čase archivácie; novší
+    updated_at znamená, že session treba archivovať znova.
+    """
+    __tablename__ = "session_archive"
+
+    session_id: Mapped[str] = mapped_column(String, primary_key=True)
+    # deň (UTC, YYYY-MM-DD) prvého merania = adresár v ARCHIVE_DIR
+    day: Mapped[str] = mapped_column(String(10), nullable=False)
+    parts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rows: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    first_ts_ms: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    last_ts_ms: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    # riadky session boli po zápise zmazané z measurements
+    pruned: Mapped[bool] = mapped_column(
+        Boolean, nullable=False, default=False, server_default="false")
+    source_updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    archived_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False
+    )
+
+
+class SchemaVersion(Base):
+    """
+    Jediný riadok s fingerprintom schémy, ktorú naposledy aplikoval
+    PartitionManager.setup(); pri zhode štart preskočí create_all a reflexiu.
+    """
+    __tablename__ = "schema_version"
+
+    id: Mapped[int] = mapped_column(SmallInteger, primary_key=True, default=1)
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+    applied_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False
+    )
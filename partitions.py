@@ -0,0 +1,388 @@
+# partitions.py
+from __future__ import annotations
+import asyncio
+import hashlib
+import os
+import re
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import (
+    Index, MetaData, PrimaryKeyConstraint, Table, inspect, text,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from logger import get_logger, setup_logging
+from models import Base, Measurement, SchemaVersion
+
+setup_logging()
+log = get_logger("partitions")
+
+# Range partitioning tabuľky measurements podľa Timestamp (epoch ms):
+# none (default, jedna tabuľka), daily alebo weekly (od pondelka, UTC).
+PARTITION_INTERVAL = os.getenv("MEASUREMENTS_PARTITION", "none").lower()
+# Koľko partícií dopredu (okrem aktuálnej) sa má vždy pripraviť.
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", "7"))
+# Partície celé staršie ako N dní sa odpoja a zmažú (0 = nikdy).
+PARTITION_RETENTION_DAYS = int(os.getenv("PARTITION_RETENTION_DAYS", "0"))
+# Ako často beží údržba (pre-create + retencia) v sekundách.
+PARTITION_MAINTENANCE_S = float(os.getenv("PARTITION_MAINTENANCE_S", "3600"))
+
+TABLE = Measurement.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+_LEGACY = f"{TABLE}_unpartitioned"
+
+_DAY_MS = 86_400_000
+# (dĺžka, posun od epochy) – 1970-01-01 bol štvrtok, pondelok je o 4 dni neskôr
+_STEPS = {
+    "daily": (_DAY_MS, 0),
+    "weekly": (7 * _DAY_MS, 4 * _DAY_MS),
+}
+# Migrácia starej tabuľky nevytvorí viac partícií (zvyšok skončí v default).
+_MIGRATE_MAX_PARTITIONS = 1000
+# Serializuje DDL medzi viacerými inštanciami aplikácie.
+_LOCK_KEY = 0x6D656173  # "meas"
+# Session lock pre CREATE INDEX CONCURRENTLY (mimo transakcie, vlastný kľúč,
+# aby naň nečakala transakcia setup(), na ktorú čaká stavba indexu).
+_INDEX_LOCK_KEY = 0x6D656169  # "meai"
+# Indexy nahradené novšími z modelu (SessionId -> ix_measurements_session_ts).
+_SUPERSEDED_INDEXES = (f"ix_{TABLE}_SessionId",)
+
+_BOUND_RE = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+
+def conflict_keys(partitioned: bool) -> Tuple[str, ...]:
+    """
+    Stĺpce unikátneho kľúča pre ON CONFLICT. Partíciovaná tabuľka musí mať
+    partition key v primárnom kľúči, takže idempotencia je na (Id, Timestamp)
+    – replay toho istého rámca nesie rovnaký timestamp_sent.
+    """
+    return ("Id", "Timestamp") if partitioned else ("Id",)
+
+
+def fill_partition_key(rows: Sequence[dict]) -> None:
+    """Timestamp je v partíciovanej tabuľke NOT NULL; chýbajúci -> 0 (default partícia)."""
+    for r in rows:
+        if r.get("Timestamp") is None:
+            r["Timestamp"] = 0
+
+
+def schema_fingerprint(interval: str = PARTITION_INTERVAL) -> str:
+    """Hash DDL všetkých modelov (tabuľky + indexy) a intervalu partícií."""
+    dialect = postgresql.dialect()
+    parts = [f"partition={interval}"]
+    for t in Base.metadata.sorted_tables:
+        parts.append(str(CreateTable(t).compile(dialect=dialect)))
+        parts.extend(sorted(str(CreateIndex(i).compile(dialect=dialect)) for i in t.indexes))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:32]
+
+
+def bucket_start(ts_ms: int, interval: str) -> int:
+    step, offset = _STEPS[interval]
+    return (ts_ms - offset) // step * step + offset
+
+
+def partition_name(start_ms: int) -> str:
+    return f"{TABLE}_p" + time.strftime("%Y%m%d", time.gmtime(start_ms / 1000))
+
+
+def _partitioned_table(metadata: MetaData) -> Table:
+    """Kópia measurements z modelu s PK (Id, Timestamp) a PARTITION BY RANGE."""
+    src = Measurement.__table__
+    cols = []
+    for c in src.columns:
+        c = c._copy()
+        c.primary_key = c.name in ("Id", "Timestamp")
+        c.nullable = not c.primary_key
+        c.index = None
+        cols.append(c)
+    table = Table(
+        TABLE, metadata, *cols,
+        PrimaryKeyConstraint("Id", "Timestamp", name=f"{TABLE}_pkey"),
+        postgresql_partition_by='RANGE ("Timestamp")',
+    )
+    for idx in src.indexes:
+        Index(idx.name, *[table.c[c.name] for c in idx.columns], **idx.dialect_kwargs)
+    return table
+
+
+class PartitionManager:
+    """
+    Správa schémy measurements pre PostgresRepository aj AsyncpgRepository.
+    - setup(): ak sa uložený fingerprint schémy (schema_version) zhoduje
+      s modelmi, nerobí nič okrem jedného dotazu. Inak create_all + chýbajúce
+      stĺpce a indexy; pri MEASUREMENTS_PARTITION daily/weekly vytvorí
+      partíciovanú tabuľku alebo do nej zmigruje existujúcu (v jednej
+      transakcii, tabuľka je počas kopírovania zamknutá) a uloží fingerprint.
+      Chýbajúce indexy existujúcej nepartíciovanej tabuľky sa stavajú
+      CONCURRENTLY mimo transakcie (inserty bežia ďalej), nahradené sa zmažú.
+    - maintain(): pripraví partície dopredu a odpojí + zmaže tie, ktoré
+      celé vypadli z retenčného okna. Beží periodicky po start().
+    """
+
+    def __init__(self, engine: AsyncEngine,
+                 interval: str = PARTITION_INTERVAL,
+                 premake: int = PARTITION_PREMAKE,
+                 retention_days: int = PARTITION_RETENTION_DAYS,
+                 every_s: float = PARTITION_MAINTENANCE_S) -> None:
+        if interval not in ("none", *_STEPS):
+            raise ValueError(f"MEASUREMENTS_PARTITION must be none/daily/weekly, got {interval!r}")
+        self.engine = engine
+        self.interval = interval
+        self.premake = premake
+        self.retention_days = retention_days
+        self.every_s = every_s
+        self.partitioned = False
+        self.fingerprint = schema_fingerprint(interval)
+        self._task: Optional[asyncio.Task] = None
+        # pri rýchlom štarte sa údržba spraví hneď v prvom kroku slučky
+        self._maintain_first = False
+
+    async def setup(self, force: bool = False) -> bool:
+        """
+        Pripraví schému; vráti True ak je measurements partíciovaná.
+        force=True ignoruje uložený fingerprint (create_db.py).
+        """
+        if not force:
+            async with self.engine.connect() as conn:
+                if await _stored_fingerprint(conn) == self.fingerprint:
+                    self.partitioned = await _table_state(conn) == "partitioned"
+                    self._maintain_first = self.partitioned and self.interval != "none"
+                    log.info("Schema fingerprint %s matches; skipping DDL", self.fingerprint)
+                    return self.partitioned
+
+        async with self.engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+            state = await _table_state(conn)
+            if self.interval != "none" and state is None:
+                log.info("Creating partitioned %s (%s)", TABLE, self.interval)
+                await conn.run_sync(lambda c: _partitioned_table(MetaData()).create(c))
+                await self._create_default(conn)
+            elif self.interval != "none" and state == "plain":
+                await self._migrate(conn)
+            elif self.interval == "none" and state == "partitioned":
+                log.warning("%s is partitioned but MEASUREMENTS_PARTITION=none; "
+                            "keeping partitions, maintenance disabled", TABLE)
+
+            await conn.run_sync(Base.metadata.create_all)
+            # create_all nepridá stĺpce ani indexy do už existujúcej tabuľky
+            await conn.run_sync(_add_missing_columns)
+            self.partitioned = await _table_state(conn) == "partitioned"
+            if self.partitioned:
+                # partíciovaná tabuľka nepodporuje CONCURRENTLY; indexy vznikajú s ňou
+                await conn.run_sync(
+                    lambda c: [i.create(c, checkfirst=True) for i in Measurement.__table__.indexes])
+                for name in _SUPERSEDED_INDEXES:
+                    await conn.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+
+        if not self.partitioned:
+            await self._build_indexes()
+        # fingerprint až po indexoch: prerušená stavba sa pri ďalšom štarte zopakuje
+        async with self.engine.begin() as conn:
+            await conn.execute(_SAVE_FINGERPRINT, {"fp": self.fingerprint})
+        log.info("Schema applied (fingerprint %s)", self.fingerprint)
+
+        if self.partitioned and self.interval != "none":
+            await self.maintain()
+        return self.partitioned
+
+    async def _build_indexes(self) -> None:
+        """
+        CREATE INDEX CONCURRENTLY pre indexy measurements, ktoré chýbajú alebo
+        ostali nedokončené (invalid) po prerušenej stavbe; potom DROP INDEX
+        CONCURRENTLY nahradených. Beží v autocommit spojení mimo transakcie.
+        """
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _INDEX_LOCK_KEY})
+            try:
+                for idx in Measurement.__table__.indexes:
+                    valid = await _index_valid(conn, idx.name)
+                    if valid:
+                        continue
+                    if valid is False:
+                        log.warning("Index %s is invalid (interrupted build); rebuilding", idx.name)
+                        await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{idx.name}"'))
+                    log.info("Building index %s concurrently", idx.name)
+                    ddl = str(CreateIndex(idx).compile(dialect=conn.dialect))
+                    await conn.execute(text(
+                        ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+                for name in _SUPERSEDED_INDEXES:
+                    if await _index_valid(conn, name) is not None:
+                        log.info("Dropping superseded index %s", name)
+                        await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+            finally:
+                await conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _INDEX_LOCK_KEY})
+
+    def start(self) -> None:
+        if self.partitioned and self.interval != "none" and self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="partition-maintenance")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            if self._maintain_first:
+                self._maintain_first = False
+            else:
+                await asyncio.sleep(self.every_s)
+            try:
+                await self.maintain()
+            except Exception:
+                log.exception("Partition maintenance failed")
+
+    async def maintain(self, now_ms: Optional[int] = None) -> Tuple[List[str], List[str]]:
+        """Vytvorí partície [aktuálna .. +premake] a zmaže expirované. Vráti (created, dropped)."""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        step, _ = _STEPS[self.interval]
+        first = bucket_start(now_ms, self.interval)
+        created: List[str] = []
+        dropped: List[str] = []
+        async with self.engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+            existing = await _partitions(conn)
+            for k in range(self.premake + 1):
+                start = first + k * step
+                if await self._create_partition(conn, start, start + step, existing):
+                    created.append(partition_name(start))
+
+            if self.retention_days > 0:
+                cutoff = now_ms - self.retention_days * _DAY_MS
+                for name, lo, hi in existing:
+                    if hi <= cutoff:
+                        await conn.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION "{name}"'))
+                        await conn.execute(text(f'DROP TABLE "{name}"'))
+                        dropped.append(name)
+        if created or dropped:
+            log.info("Partitions created=%s dropped=%s", created, dropped)
+        return created, dropped
+
+    async def _create_partition(self, conn: AsyncConnection, start: int, end: int,
+                                existing: List[Tuple[str, int, int]]) -> bool:
+        if any(lo < end and start < hi for _, lo, hi in existing):
+            return False
+        name = partition_name(start)
+        try:
+            # savepoint: prekryv s ručne vytvorenou partíciou alebo riadky
+            # v default partícii nesmú zhodiť celú údržbu
+            async with conn.begin_nested():
+                await conn.execute(text(
+                    f'CREATE TABLE "{name}" PARTITION OF {TABLE} '
+                    f"FOR VALUES FROM ({int(start)}) TO ({int(end)})"))
+        except Exception as e:
+            log.warning("Cannot create partition %s: %s", name, e)
+            return False
+        existing.append((name, start, end))
+        return True
+
+    async def _create_default(self, conn: AsyncConnection) -> None:
+        await conn.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF {TABLE} DEFAULT'))
+
+    async def _migrate(self, conn: AsyncConnection) -> None:
+        """Presunie dáta z nepartíciovanej measurements do novej partíciovanej."""
+        log.info("Migrating %s to %s partitions", TABLE, self.interval)
+        await conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {_LEGACY}"))
+        # názvy indexov sú v rámci schémy unikátne -> uvoľniť ich pre novú tabuľku
+        idx = await conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() "
+            "AND tablename = :t"), {"t": _LEGACY})
+        for (name,) in idx.all():
+            await conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "{("old_" + name)[:63]}"'))
+
+        await conn.run_sync(lambda c: _partitioned_table(MetaData()).create(c))
+        await self._create_default(conn)
+
+        step, offset = _STEPS[self.interval]
+        res = await conn.execute(text(
+            f'SELECT DISTINCT ("Timestamp" - :o) / :s FROM {_LEGACY} '
+            f'WHERE "Timestamp" >= :o ORDER BY 1 DESC LIMIT :n'),
+            {"o": offset, "s": step, "n": _MIGRATE_MAX_PARTITIONS})
+        existing: List[Tuple[str, int, int]] = []
+        for (b,) in res.all():
+            start = int(b) * step + offset
+            await self._create_partition(conn, start, start + step, existing)
+
+        cols = ", ".join(f'"{c.name}"' for c in Measurement.__table__.columns)
+        sel = ", ".join('COALESCE("Timestamp", 0)' if c.name == "Timestamp" else f'"{c.name}"'
+                        for c in Measurement.__table__.columns)
+        res = await conn.execute(text(
+            f"INSERT INTO {TABLE} ({cols}) SELECT {sel} FROM {_LEGACY} ON CONFLICT DO NOTHING"))
+        await conn.execute(text(f"DROP TABLE {_LEGACY}"))
+        log.info("Migrated %d rows into %d partitions", res.rowcount, len(existing))
+
+
+def _add_missing_columns(conn) -> None:
+    """ALTER TABLE ... ADD COLUMN pre stĺpce modelov, ktoré v DB ešte nie sú."""
+    insp = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in have:
+                ddl = CreateColumn(col).compile(dialect=conn.dialect)
+                log.info("Adding column %s.%s", table.name, col.name)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ddl}"))
+
+
+_SAVE_FINGERPRINT = text(
+    f"INSERT INTO {SchemaVersion.__tablename__} (id, fingerprint, applied_at) "
+    "VALUES (1, :fp, now()) "
+    "ON CONFLICT (id) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, applied_at = now()"
+)
+
+
+async def _stored_fingerprint(conn: AsyncConnection) -> Optional[str]:
+    """Uložený fingerprint alebo None (tabuľka schema_version ešte neexistuje)."""
+    if (await conn.execute(text("SELECT to_regclass(:t)"),
+                           {"t": SchemaVersion.__tablename__})).scalar() is None:
+        return None
+    res = await conn.execute(text(
+        f"SELECT fingerprint FROM {SchemaVersion.__tablename__} WHERE id = 1"))
+    return res.scalar()
+
+
+async def _index_valid(conn: AsyncConnection, name: str) -> Optional[bool]:
+    """None (index neexistuje), inak pg_index.indisvalid."""
+    res = await conn.execute(text(
+        "SELECT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = current_schema() AND c.relname = :n"), {"n": name})
+    return res.scalar()
+
+
+async def _table_state(conn: AsyncConnection) -> Optional[str]:
+    """None (neexistuje), 'plain' alebo 'partitioned'."""
+    res = await conn.execute(text(
+        "SELECT c.relkind::text FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = current_schema() AND c.relname = :t"), {"t": TABLE})
+    kind = res.scalar()
+    if kind is None:
+        return None
+    return "partitioned" if kind == "p" else "plain"
+
+
+async def _partitions(conn: AsyncConnection) -> List[Tuple[str, int, int]]:
+    """Range partície measurements ako (názov, od, do); default sa vynechá."""
+    res = await conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:t AS regclass)"), {"t": TABLE})
+    out: List[Tuple[str, int, int]] = []
+    for name, bound in res.all():
+        m = _BOUND_RE.search(bound or "")
+        if m:
+            out.append((name, int(m.group(1)), int(m.group(2))))
+    return out
@@ -0,0 +1,341 @@
+# pgwriter.py
+from __future__ import annotations
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from dbhandler import (
+    ASYNC_DSN, DB_PREWARM_CONNECTIONS, _SKETCH_MERGE, _extract_fields, _dedupe_rows, _i,
+    _notify, _s, _warmup_rows, get_engine, redact_dsn, wait_for_db,
+)
+from logger import get_logger, get_hot_logger, setup_logging
+from models import Measurement
+from partitions import PartitionManager, conflict_keys, fill_partition_key
+from rollups import RTT_QUANTILES, rtt_quantiles
+import tiles
+
+setup_logging()
+log = get_logger("pgwriter")
+hot_log = get_hot_logger("pgwriter")
+
+_COLUMNS: List[str] = [c.name for c in Measurement.__table__.columns]
+_COLS_SQL = ", ".join(f'"{c}"' for c in _COLUMNS)
+_PARAMS_SQL = ", ".join(f"${n}" for n in range(1, len(_COLUMNS) + 1))
+
+
+def _on_conflict(keys: tuple) -> tuple:
+    """
+    (DO NOTHING, DO UPDATE RTT) klauzuly pre daný unikátny kľúč. Na kolízii sa
+    nemení nič okrem chýbajúceho RTT_ms (sémantika apply_rtt).
+    """
+    target = "ON CONFLICT (" + ", ".join(f'"{k}"' for k in keys) + ") "
+    return (
+        target + "DO NOTHING",
+        target + 'DO UPDATE SET "RTT_ms" = EXCLUDED."RTT_ms" '
+        'WHERE measurements."RTT_ms" IS NULL AND EXCLUDED."RTT_ms" IS NOT NULL',
+    )
+
+
+_INSERT_ONE = f"INSERT INTO measurements ({_COLS_SQL}) VALUES ({_PARAMS_SQL}) "
+# ktoré riadky boli naozaj vložené (xmax = 0) a ktoré len dostali RTT
+_RETURNING_INSERTED = ' RETURNING "Id", (xmax = 0), "SessionId", "RTT_ms"'
+
+# Staging tabuľka je TEMP (per spojenie, mimo WAL) a ON COMMIT DELETE ROWS,
+# takže po každej dávke je prázdna bez DELETE/VACUUM.
+_STAGE = "measurements_stage"
+_CREATE_STAGE = (
+    f"CREATE TEMP TABLE IF NOT EXISTS {_STAGE} "
+    "(LIKE measurements INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+)
+_MERGE_STAGE = f"INSERT INTO measurements ({_COLS_SQL}) SELECT {_COLS_SQL} FROM {_STAGE} "
+
+_APPLY_RTT = (
+    'UPDATE measurements SET "RTT_ms" = $2 '
+    'WHERE "Id" = $1 AND "RTT_ms" IS NULL '
+    'RETURNING "SessionId", "RTT_ms"'
+)
+_APPLY_RTT_MANY = (
+    'UPDATE measurements m SET "RTT_ms" = v.rtt '
+    "FROM unnest($1::text[], $2::float8[]) AS v(id, rtt) "
+    'WHERE m."Id" = v.id AND m."RTT_ms" IS NULL '
+    'RETURNING m."SessionId", m."RTT_ms"'
+)
+
+_RECENT_IDS = (
+    'SELECT "Id", "RTT_ms" IS NOT NULL FROM measurements '
+    'WHERE "Timestamp" >= $1 LIMIT $2'
+)
+
+_UPSERT_SESSION = (
+    "INSERT INTO session_stats (session_id, started_at_ms, ended_at_ms, "
+    "reconnect_count, total_downtime_ms, client_reported, updated_at) "
+    "VALUES ($1, $2, $3, $4, $5, true, now()) "
+    "ON CONFLICT (session_id) DO UPDATE SET "
+    "started_at_ms = LEAST(session_stats.started_at_ms, EXCLUDED.started_at_ms), "
+    "ended_at_ms = GREATEST(session_stats.ended_at_ms, EXCLUDED.ended_at_ms), "
+    "reconnect_count = EXCLUDED.reconnect_count, "
+    "total_downtime_ms = EXCLUDED.total_downtime_ms, "
+    "client_reported = true, "
+    "updated_at = now()"
+)
+
+_ROLLUP_COLS = ("session_id", "started_at_ms", "ended_at_ms", "msg_count", "first_ts_ms",
+                "last_ts_ms", "rtt_count", "rtt_sum_ms", "rtt_sketch", "outage_count",
+                "outage_ms", "outage_max_ms", "cell_changes")
+_UPSERT_ROLLUP = (
+    f"INSERT INTO session_stats ({', '.join(_ROLLUP_COLS)}, "
+    "reconnect_count, total_downtime_ms, updated_at) "
+    f"VALUES ({', '.join(f'${i}' for i in range(1, len(_ROLLUP_COLS) + 1))}, 0, 0, now()) "
+    "ON CONFLICT (session_id) DO UPDATE SET "
+    + ", ".join(f"{c} = session_stats.{c} + EXCLUDED.{c}" for c in (
+        "msg_count", "rtt_count", "rtt_sum_ms", "outage_count", "outage_ms", "cell_changes"))
+    + ", first_ts_ms = LEAST(session_stats.first_ts_ms, EXCLUDED.first_ts_ms)"
+    ", last_ts_ms = GREATEST(session_stats.last_ts_ms, EXCLUDED.last_ts_ms)"
+    ", started_at_ms = LEAST(session_stats.started_at_ms, EXCLUDED.started_at_ms)"
+    ", ended_at_ms = GREATEST(session_stats.ended_at_ms, EXCLUDED.ended_at_ms)"
+    ", outage_max_ms = GREATEST(session_stats.outage_max_ms, EXCLUDED.outage_max_ms)"
+    f", rtt_sketch = {_SKETCH_MERGE}, updated_at = now()"
+)
+_RTT_SKETCHES = "SELECT session_id, rtt_sketch FROM session_stats WHERE session_id = ANY($1::text[])"
+_SET_RTT_QUANTILES = (
+    "UPDATE session_stats SET rtt_p50_ms = v.p50, rtt_p90_ms = v.p90, rtt_p99_ms = v.p99 "
+    "FROM unnest($1::text[], $2::float8[], $3::float8[], $4::float8[]) AS v(sid, p50, p90, p99) "
+    "WHERE session_stats.session_id = v.sid"
+)
+
+
+def _plain_dsn(dsn: str) -> str:
+    """asyncpg nepozná SQLAlchemy prefix postgresql+asyncpg://."""
+    if dsn.startswith("postgresql+asyncpg://"):
+        return "postgresql://" + dsn[len("postgresql+asyncpg://"):]
+    return dsn
+
+
+def _record(row: Dict[str, Any]) -> tuple:
+    return tuple(row.get(c) for c in _COLUMNS)
+
+
+async def _after_insert(conn: asyncpg.Connection, rows: List[Dict[str, Any]],
+                        res: List[asyncpg.Record]) -> tuple:
+    """
+    Z výsledku RETURNING rozlíši nové riadky a RTT doplnené k existujúcim;
+    z nových upsertne agregáty dlaždíc. Vráti (vložené, nové, doplnené RTT, agregáty).
+    """
+    new_ids = {r[0] for r in res if r[1]}
+    fills = [(r[2], r[3]) for r in res if not r[1]]
+    new_rows = [r for r in rows if r["Id"] in new_ids] if new_ids else []
+    aggs = tiles.aggregate(new_rows) if tiles.TILES_ENABLED and new_rows else []
+    if aggs:
+        await conn.execute(tiles.UPSERT_SQL, *tiles.upsert_args(aggs))
+    return len(new_rows), new_rows, fills, aggs
+
+
+class AsyncpgRepository:
+    """
+    Drop-in náhrada PostgresRepository nad čistým asyncpg.
+    - Single-row cesty: fixné SQL s parametrami (asyncpg ich drží ako
+      prepared statements v statement cache každého spojenia).
+    - Dávky meraní: COPY do temp staging tabuľky + jeden idempotentný
+      INSERT ... SELECT ... ON CONFLICT do measurements.
+    - Idempotencia rovnaká ako v PostgresRepository.
+    """
+
+    def __init__(self, min_size: int = 2, max_size: int = 10) -> None:
+        self._min_size = min_size
+        self._max_size = max_size
+        self._pool: Optional[asyncpg.Pool] = None
+        # PartitionManager (a s ním SQLAlchemy engine) vznikne až v start()
+        self._partitions: Optional[PartitionManager] = None
+        # rovnaký kontrakt ako PostgresRepository.write_listeners
+        self.write_listeners: List[Callable] = []
+        self.conflict_key = conflict_keys(False)
+        self._on_conflict_nothing, self._on_conflict_rtt = _on_conflict(self.conflict_key)
+
+    async def start(self) -> None:
+        log.info("Starting AsyncpgRepository (%s)", redact_dsn(ASYNC_DSN))
+        # schéma zostáva definovaná cez SQLAlchemy modely
+        engine = get_engine()
+        self._partitions = PartitionManager(engine)
+        await wait_for_db(engine)
+        partitioned = await self._partitions.setup()
+        self.conflict_key = conflict_keys(partitioned)
+        self._on_conflict_nothing, self._on_conflict_rtt = _on_conflict(self.conflict_key)
+        # údržba partícií si engine otvorí znova, len raz za čas
+        await engine.dispose()
+        self._partitions.start()
+        self._pool = await asyncpg.create_pool(
+            _plain_dsn(ASYNC_DSN),
+            min_size=self._min_size,
+            max_size=self._max_size,
+            init=self._init_connection,
+        )
+
+    async def warm_up(self, connections: int = DB_PREWARM_CONNECTIONS) -> int:
+        """
+        Rovnaké ako PostgresRepository.warm_up: spojenia poolu sa otvoria naraz
+        a ingest SQL sa na každom raz vykoná (rollback), takže sú v statement
+        cache spojenia ako prepared statements.
+        """
+        n = min(max(0, connections), self._max_size)
+        if n == 0:
+            return 0
+        barrier = asyncio.Barrier(n)
+
+        async def warm(k: int) -> None:
+            rows = _warmup_rows(self._partitions.partitioned, k)
+            async with self._pool.acquire() as conn:
+                tr = conn.transaction()
+                await tr.start()
+                try:
+                    for sql, r in zip((self._on_conflict_nothing, self._on_conflict_rtt), rows):
+                        await conn.fetch(_INSERT_ONE + sql + _RETURNING_INSERTED, *_record(r))
+                        await conn.fetch(_MERGE_STAGE + sql + _RETURNING_INSERTED)
+                    await conn.fetch(_APPLY_RTT, rows[0]["Id"], 0.0)
+                    await conn.fetch(_APPLY_RTT_MANY, [rows[0]["Id"]], [0.0])
+                    await barrier.wait()
+                except BaseException:
+                    barrier.abort()
+                    raise
+                finally:
+                    await tr.rollback()
+
+        await asyncio.gather(*(warm(k) for k in range(n)))
+        return n
+
+    async def stop(self) -> None:
+        log.info("Stopping AsyncpgRepository")
+        if self._partitions is not None:
+            await self._partitions.stop()
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def ping(self, timeout: float = 1.0) -> bool:
+        """True ak DB odpovie na SELECT 1 do timeout sekúnd."""
+        if self._pool is None:
+            return False
+        try:
+            async with asyncio.timeout(timeout):
+                await self._pool.fetchval("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def pool_status(self) -> Dict[str, int]:
+        if self._pool is None:
+            return {"checked_out": 0, "overflow": 0, "size": 0}
+        size = self._pool.get_size()
+        return {
+            "checked_out": size - self._pool.get_idle_size(),
+            "overflow": 0,
+            "size": size,
+        }
+
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection) -> None:
+        await conn.execute(_CREATE_STAGE)
+
+    async def insert_measurement_flat(self, payload: Dict[str, Any],
+                                      rtt_ms: Optional[float] = None) -> int:
+        """Rovnaké správanie ako PostgresRepository.insert_measurement_flat."""
+        hot_log.info("Inserting measurement")
+        m = _extract_fields(payload)
+        m["RTT_ms"] = float(rtt_ms) if rtt_ms is not None else None
+        if self._partitions.partitioned:
+            fill_partition_key([m])
+        sql = _INSERT_ONE + (self._on_conflict_nothing if rtt_ms is None else self._on_conflict_rtt)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                res = await conn.fetch(sql + _RETURNING_INSERTED, *_record(m))
+                written, new_rows, fills, aggs = await _after_insert(conn, [m], res)
+        tiles.TILE_CACHE.invalidate(aggs)
+        _notify(self.write_listeners, new_rows, fills)
+        return written
+
+    async def insert_measurements_flat(self, payloads: List[Dict[str, Any]],
+                                       rtts: Optional[Dict[str, float]] = None) -> int:
+        """COPY celej dávky do staging tabuľky a merge v jednej transakcii."""
+        if not payloads:
+            return 0
+        hot_log.info("Inserting batch of %d measurements (COPY)", len(payloads))
+        rows = _dedupe_rows([_extract_fields(p) for p in payloads])
+        rtts = rtts or {}
+        for r in rows:
+            rtt = rtts.get(r["Id"])
+            r["RTT_ms"] = float(rtt) if rtt is not None else None
+        if self._partitions.partitioned:
+            fill_partition_key(rows)
+        merge = _MERGE_STAGE + (self._on_conflict_rtt if rtts else self._on_conflict_nothing)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.copy_records_to_table(
+                    _STAGE, records=[_record(r) for r in rows], columns=_COLUMNS)
+                res = await conn.fetch(merge + _RETURNING_INSERTED)
+                written, new_rows, fills, aggs = await _after_insert(conn, rows, res)
+        tiles.TILE_CACHE.invalidate(aggs)
+        _notify(self.write_listeners, new_rows, fills)
+        return written
+
+    async def apply_rtt(self, meas_id: str, rtt_ms: float) -> int:
+        """Doplní RTT iba ak ešte nie je vyplnené (idempotentné)."""
+        hot_log.info("Applying RTT for measurement %s: %s ms", meas_id, rtt_ms)
+        async with self._pool.acquire() as conn:
+            res = await conn.fetch(_APPLY_RTT, str(meas_id), float(rtt_ms))
+        _notify(self.write_listeners, [], [tuple(r) for r in res])
+        return len(res)
+
+    async def apply_rtt_many(self, rtts: Dict[str, float]) -> int:
+        """Jeden UPDATE ... FROM unnest(...) pre celú dávku RTT."""
+        if not rtts:
+            return 0
+        hot_log.info("Applying %d RTT updates", len(rtts))
+        ids = [str(k) for k in rtts]
+        vals = [float(v) for v in rtts.values()]
+        async with self._pool.acquire() as conn:
+            res = await conn.fetch(_APPLY_RTT_MANY, ids, vals)
+        _notify(self.write_listeners, [], [tuple(r) for r in res])
+        return len(res)
+
+    async def recent_ids(self, since_ms: int, limit: int) -> List[Tuple[str, bool]]:
+        """Rovnaké správanie ako PostgresRepository.recent_ids."""
+        async with self._pool.acquire() as conn:
+            res = await conn.fetch(_RECENT_IDS, since_ms, limit)
+        return [tuple(r) for r in res]
+
+    async def upsert_session_stats(self, payload: Dict[str, Any]) -> None:
+        """Rovnaké správanie ako PostgresRepository.upsert_session_stats."""
+        sid = _s(payload.get("session_id"))
+        if not sid:
+            log.info("upsert_session_stats: missing session_id")
+            return
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                _UPSERT_SESSION,
+                sid,
+                _i(payload.get("started_at_ms")),
+                _i(payload.get("ended_at_ms")),
+                _i(payload.get("reconnect_count")) or 0,
+                _i(payload.get("total_downtime_ms")) or 0,
+            )
+
+    async def upsert_session_rollups(self, rows: List[Dict[str, Any]]) -> None:
+        """Rovnaké správanie ako PostgresRepository.upsert_session_rollups."""
+        if not rows:
+            return
+        now_ms = int(time.time() * 1000)
+        args = [
+            tuple(dict(r, started_at_ms=r["first_ts_ms"] or now_ms,
+                       ended_at_ms=r["last_ts_ms"])[c] for c in _ROLLUP_COLS)
+            for r in rows
+        ]
+        sids = [r["session_id"] for r in rows if r["rtt_count"]]
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(_UPSERT_ROLLUP, args)
+                if sids:
+                    q = [(sid, rtt_quantiles(sketch))
+                         for sid, sketch in await conn.fetch(_RTT_SKETCHES, sids)]
+                    await conn.execute(_SET_RTT_QUANTILES, [sid for sid, _ in q],
+                                       *([v[col] for _, v in q] for col, _ in RTT_QUANTILES))
@@ -0,0 +1,239 @@
+# records.py
+from __future__ import annotations
+import sys
+from array import array
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from dbhandler import ROW_KEY, _extract_fields, _s
+from models import Measurement
+
+# Poradie hodnôt v MeasurementRecord.values = ploché stĺpce z _extract_fields
+# (všetky stĺpce Measurement okrem RTT_ms, ktoré dopĺňa worker).
+ROW_COLUMNS: Tuple[str, ...] = tuple(
+    c.name for c in Measurement.__table__.columns if c.name != "RTT_ms")
+_ID = ROW_COLUMNS.index("Id")
+_SESSION = ROW_COLUMNS.index("SessionId")
+
+# Polia session_summary, ktoré používa upsert_session_stats.
+_SUMMARY_KEYS = ("session_id", "started_at_ms", "ended_at_ms",
+                 "reconnect_count", "total_downtime_ms")
+
+_EMPTY_IDS: Tuple[str, ...] = ()
+_EMPTY_RTTS = array("d")
+
+_sizeof = sys.getsizeof
+
+
+class MeasurementRecord:
+    """
+    Meranie vo fronte workera: iba hodnoty stĺpcov (tuple v poradí ROW_COLUMNS)
+    a platné RTT updaty (id + array('d')). device, v2x, ďalší susedia a celé
+    rtt_updates dicty sa nedržia. raw je pôvodný dict len ak sa stĺpce nedali
+    vytiahnuť (chyba sa prejaví až pri inserte, ako doteraz).
+    """
+
+    __slots__ = ("values", "rtt_ids", "rtt_ms", "raw", "nbytes")
+
+    def __init__(self, values: Optional[tuple], rtt_ids: Tuple[str, ...],
+                 rtt_ms: array, raw: Optional[Dict[str, Any]] = None) -> None:
+        self.values = values
+        self.rtt_ids = rtt_ids
+        self.rtt_ms = rtt_ms
+        self.raw = raw
+        self.nbytes = _record_size(self)
+
+    @property
+    def id(self) -> Optional[str]:
+        if self.values is None:
+            return _s(self.raw.get("id"))
+        return self.values[_ID]
+
+    @property
+    def session_id(self) -> Optional[str]:
+        if self.values is None:
+            return _s(self.raw.get("session_id"))
+        return self.values[_SESSION]
+
+    def payload(self) -> Dict[str, Any]:
+        """Dict pre repo.insert_measurement(s)_flat (_extract_fields vezme ROW_KEY)."""
+        if self.values is None:
+            return self.raw
+        return {"type": "measurement", "id": self.values[_ID],
+                "session_id": self.values[_SESSION],
+                ROW_KEY: dict(zip(ROW_COLUMNS, self.values))}
+
+
+class RttRecord:
+    """Samostatný rtt_updates rámec: len platné (id, rtt_ms) páry."""
+
+    __slots__ = ("rtt_ids", "rtt_ms", "nbytes")
+
+    def __init__(self, rtt_ids: Tuple[str, ...], rtt_ms: array) -> None:
+        self.rtt_ids = rtt_ids
+        self.rtt_ms = rtt_ms
+        self.nbytes = _record_size(self)
+
+
+class SummaryRecord:
+    """session_summary: len polia, ktoré ukladá upsert_session_stats."""
+
+    __slots__ = ("payload", "nbytes")
+
+    def __init__(self, payload: Dict[str, Any]) -> None:
+        self.payload = payload
+        self.nbytes = _record_size(self)
+
+
+class BatchRecord:
+    """measurement_batch: merania dávky ako jedna položka fronty."""
+
+    __slots__ = ("items", "nbytes")
+
+    def __init__(self, items: Tuple[MeasurementRecord, ...]) -> None:
+        self.items = items
+        self.nbytes = _sizeof(self) + _sizeof(items) + sum(r.nbytes for r in items)
+
+
+class IgnoredRecord:
+    """Iný typ správy – worker ho len zaloguje a preskočí."""
+
+    __slots__ = ("msg_type", "nbytes")
+
+    def __init__(self, msg_type: Any) -> None:
+        self.msg_type = msg_type
+        self.nbytes = _sizeof(self)
+
+
+Record = Union[MeasurementRecord, RttRecord, SummaryRecord, BatchRecord, IgnoredRecord]
+
+
+def compact(data: Dict[str, Any]) -> Record:
+    """Rozparsovaná správa z decode_frame -> kompaktný záznam pre frontu workera."""
+    msg_type = data.get("type")
+    if msg_type == "measurement":
+        return _measurement(data)
+    if msg_type == "measurement_batch":
+        items = data.get("items")
+        return BatchRecord(tuple(_measurement(it) for it in items if isinstance(it, dict))
+                           if isinstance(items, list) else ())
+    if msg_type == "rtt_updates":
+        return RttRecord(*_rtt_pairs(data.get("items")))
+    if msg_type == "session_summary":
+        return SummaryRecord({k: data.get(k) for k in _SUMMARY_KEYS})
+    return IgnoredRecord(msg_type)
+
+
+def _measurement(data: Dict[str, Any]) -> MeasurementRecord:
+    ids, rtts = _rtt_pairs(data.get("rtt_updates"))
+    try:
+        row = _extract_fields(data)
+    except Exception:
+        return MeasurementRecord(None, ids, rtts, raw=data)
+    return MeasurementRecord(tuple(row.get(c) for c in ROW_COLUMNS), ids, rtts)
+
+
+def strip_rtts(rec: Record) -> Tuple[Record, int]:
+    """
+    Záznam bez RTT updatov vložených v meraniach (shed politika rtt_first);
+    vráti (nový záznam, počet zahodených). Samostatné RttRecord nerieši.
+    """
+    if type(rec) is MeasurementRecord:
+        if not rec.rtt_ids:
+            return rec, 0
+        raw = rec.raw
+        if raw is not None:
+            raw = dict(raw, rtt_updates=None)
+        return MeasurementRecord(rec.values, _EMPTY_IDS, _EMPTY_RTTS, raw=raw), len(rec.rtt_ids)
+    if type(rec) is BatchRecord:
+        dropped = 0
+        items = []
+        for it in rec.items:
+            it, n = strip_rtts(it)
+            items.append(it)
+            dropped += n
+        return (BatchRecord(tuple(items)) if dropped else rec), dropped
+    return rec, 0
+
+
+# ---- prenos záznamov medzi procesmi (gateway -> writer, MessagePack) ----
+
+def to_wire(rec: Record) -> tuple:
+    """Záznam -> tuple z primitívnych typov (RTT hodnoty ako bajty array('d'))."""
+    kind = type(rec)
+    if kind is MeasurementRecord:
+        return ("m", rec.values, rec.rtt_ids, rec.rtt_ms.tobytes(), rec.raw)
+    if kind is BatchRecord:
+        return ("b", [to_wire(it) for it in rec.items])
+    if kind is RttRecord:
+        return ("r", rec.rtt_ids, rec.rtt_ms.tobytes())
+    if kind is SummaryRecord:
+        return ("s", rec.payload)
+    return ("i", rec.msg_type)
+
+
+def from_wire(obj: Any) -> Record:
+    """Opak to_wire (MessagePack vráti tuple ako list)."""
+    tag = obj[0]
+    if tag == "m":
+        values = obj[1]
+        return MeasurementRecord(tuple(values) if values is not None else None,
+                                 tuple(obj[2]), array("d", obj[3]), raw=obj[4])
+    if tag == "b":
+        return BatchRecord(tuple(from_wire(it) for it in obj[1]))
+    if tag == "r":
+        return RttRecord(tuple(obj[1]), array("d", obj[2]))
+    if tag == "s":
+        return SummaryRecord(obj[1])
+    return IgnoredRecord(obj[1])
+
+
+def _rtt_pairs(updates: Any) -> Tuple[Tuple[str, ...], array]:
+    """Platné (id, rtt_ms) z rtt_updates zoznamu (rovnaké pravidlá ako worker._collect_rtts)."""
+    if not isinstance(updates, list) or not updates:
+        return _EMPTY_IDS, _EMPTY_RTTS
+    ids: List[str] = []
+    vals = array("d")
+    for upd in updates:
+        if not isinstance(upd, dict):
+            continue
+        uid = upd.get("id")
+        rtt = upd.get("rtt_ms")
+        if uid is None or rtt is None:
+            continue
+        try:
+            vals.append(float(rtt))
+        except (TypeError, ValueError):
+            continue
+        ids.append(str(uid))
+    if not ids:
+        return _EMPTY_IDS, _EMPTY_RTTS
+    return tuple(ids), vals
+
+
+def _record_size(rec: Any) -> int:
+    """
+    Približná veľkosť záznamu v bajtoch (objekt + tuple/array + hodnoty).
+    Malé inty a None sú zdieľané objekty, ale rátajú sa tiež – odhad je
+    radšej vyšší. Používa sa na bajtový limit fronty.
+    """
+    n = _sizeof(rec)
+    values = getattr(rec, "values", None)
+    if values is not None:
+        n += _sizeof(values) + sum(_sizeof(v) for v in values if v is not None)
+    elif getattr(rec, "raw", None) is not None:
+        n += _deep_sizeof(rec.raw)
+    ids = getattr(rec, "rtt_ids", None)
+    if ids:
+        n += _sizeof(ids) + sum(_sizeof(i) for i in ids) + _sizeof(rec.rtt_ms)
+    payload = getattr(rec, "payload", None)
+    if isinstance(payload, dict):
+        n += _deep_sizeof(payload)
+    return n
+
+
+def _deep_sizeof(obj: Any) -> int:
+    if isinstance(obj, dict):
+        return _sizeof(obj) + sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return _sizeof(obj) + sum(_deep_sizeof(v) for v in obj)
+    return _sizeof(obj)
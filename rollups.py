@@ -0,0 +1,296 @@
+# rollups.py
+from __future__ import annotations
+import asyncio
+import math
+import os
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from logger import get_logger, get_hot_logger, setup_logging
+
+setup_logging()
+log = get_logger("rollups")
+hot_log = get_hot_logger("rollups")
+
+# Ako často sa zmenené rollupy zapíšu do session_stats (s).
+ROLLUP_FLUSH_S = float(os.getenv("ROLLUP_FLUSH_S", "10"))
+# Session bez nového merania dlhšie ako toto sa flushne a vyradí z pamäte.
+ROLLUP_IDLE_S = float(os.getenv("ROLLUP_IDLE_S", "300"))
+# Max. počet sessions v pamäti; nad limit sa vyraďujú najdlhšie neaktívne.
+ROLLUP_MAX_SESSIONS = int(os.getenv("ROLLUP_MAX_SESSIONS", "10000"))
+
+
+class RttSketch:
+    """
+    Log-bucket histogram RTT (DDSketch-like) s pevnou veľkosťou: relatívna
+    chyba kvantilov ~5 % v rozsahu 0.1 ms .. ~2 min. Sketche sa dajú sčítať
+    po prvkoch (tak ich zlučuje aj DB pri flushi).
+    """
+
+    GAMMA = 1.1
+    MIN_MS = 0.1
+    SIZE = 148
+
+    __slots__ = ("counts",)
+
+    _LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self, counts: Optional[Iterable[int]] = None) -> None:
+        self.counts = array("q", counts if counts is not None else bytes(8 * self.SIZE))
+
+    def add(self, rtt_ms: float) -> None:
+        if rtt_ms <= self.MIN_MS:
+            i = 0
+        else:
+            i = min(self.SIZE - 1, 1 + int(math.log(rtt_ms / self.MIN_MS) / self._LOG_GAMMA))
+        self.counts[i] += 1
+
+    def merge(self, other: "RttSketch") -> None:
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+
+    def total(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> Optional[float]:
+        n = self.total()
+        if n == 0:
+            return None
+        rank = q * (n - 1)
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen > rank:
+                if i == 0:
+                    return self.MIN_MS
+                # stred bucketu [MIN*γ^(i-1), MIN*γ^i)
+                return self.MIN_MS * self.GAMMA ** (i - 1) * 2 * self.GAMMA / (1 + self.GAMMA)
+        return None
+
+    def to_list(self) -> List[int]:
+        return list(self.counts)
+
+
+# stĺpce session_stats s kvantilmi RTT (repo ich prepočíta zo zlúčeného sketchu)
+RTT_QUANTILES = (("rtt_p50_ms", 0.50), ("rtt_p90_ms", 0.90), ("rtt_p99_ms", 0.99))
+
+
+def rtt_quantiles(counts: Optional[Iterable[int]]) -> Dict[str, Optional[float]]:
+    """Hodnoty stĺpcov RTT_QUANTILES pre session_stats.rtt_sketch (None bez RTT)."""
+    sketch = RttSketch(counts) if counts else RttSketch()
+    out: Dict[str, Optional[float]] = {}
+    for col, q in RTT_QUANTILES:
+        v = sketch.quantile(q)
+        out[col] = None if v is None else round(v, 3)
+    return out
+
+
+class SessionRollup:
+    """
+    Kompaktný stav jednej aktívnej session. Aditívne polia (count, rtt_*,
+    outage_count/ms, cell_changes, sketch) sú delty od posledného flushu –
+    DB ich pripočíta, takže vyradenie a návrat session nič nestratí.
+    """
+
+    __slots__ = (
+        "session_id", "count", "first_ts", "last_ts",
+        "rtt_count", "rtt_sum", "sketch",
+        "outage_count", "outage_ms", "outage_max_ms", "outage_since",
+        "cell_changes", "last_cell", "last_seen", "dirty", "finished",
+    )
+
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+        self.count = 0
+        self.first_ts: Optional[int] = None
+        self.last_ts: Optional[int] = None
+        self.rtt_count = 0
+        self.rtt_sum = 0.0
+        self.sketch = RttSketch()
+        self.outage_count = 0
+        self.outage_ms = 0
+        self.outage_max_ms = 0
+        # Timestamp začiatku práve prebiehajúceho výpadku
+        self.outage_since: Optional[int] = None
+        self.cell_changes = 0
+        self.last_cell: Optional[int] = None
+        self.last_seen = time.monotonic()
+        self.dirty = False
+        self.finished = False
+
+    def add_measurement(self, row: Dict[str, Any]) -> None:
+        self.count += 1
+        self.dirty = True
+        ts = row.get("Timestamp")
+        if ts:
+            self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+            self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+
+        outage = row.get("Outage")
+        if outage and self.outage_since is None and ts:
+            self.outage_since = ts
+            self.outage_count += 1
+        elif outage is False and self.outage_since is not None:
+            self._close_outage(ts)
+
+        cell = row.get("CellID")
+        if cell is not None:
+            if self.last_cell is not None and cell != self.last_cell:
+                self.cell_changes += 1
+            self.last_cell = cell
+
+        rtt = row.get("RTT_ms")
+        if rtt is not None:
+            self.add_rtt(rtt)
+
+    def add_rtt(self, rtt_ms: float) -> None:
+        self.rtt_count += 1
+        self.rtt_sum += rtt_ms
+        self.sketch.add(rtt_ms)
+        self.dirty = True
+
+    def _close_outage(self, ts: Optional[int]) -> None:
+        if ts and ts > self.outage_since:
+            dur = ts - self.outage_since
+            self.outage_ms += dur
+            self.outage_max_ms = max(self.outage_max_ms, dur)
+        self.outage_since = None
+        self.dirty = True
+
+    def take_delta(self, final: bool = False) -> Dict[str, Any]:
+        """Vráti riadok pre repo.upsert_session_rollups a vynuluje delty."""
+        if final and self.outage_since is not None:
+            # výpadok trval aspoň do posledného merania session
+            self._close_outage(self.last_ts)
+        d = {
+            "session_id": self.session_id,
+            "msg_count": self.count,
+            "first_ts_ms": self.first_ts,
+            "last_ts_ms": self.last_ts,
+            "rtt_count": self.rtt_count,
+            "rtt_sum_ms": self.rtt_sum,
+            "rtt_sketch": self.sketch.to_list(),
+            "outage_count": self.outage_count,
+            "outage_ms": self.outage_ms,
+            "outage_max_ms": self.outage_max_ms,
+            "cell_changes": self.cell_changes,
+        }
+        self.count = self.rtt_count = self.outage_count = self.outage_ms = self.cell_changes = 0
+        self.rtt_sum = 0.0
+        self.sketch = RttSketch()
+        self.dirty = False
+        return d
+
+    def restore(self, d: Dict[str, Any]) -> None:
+        """Vráti deltu späť po neúspešnom flushi (pripočíta k novším zmenám)."""
+        self.count += d["msg_count"]
+        self.rtt_count += d["rtt_count"]
+        self.rtt_sum += d["rtt_sum_ms"]
+        self.sketch.merge(RttSketch(d["rtt_sketch"]))
+        self.outage_count += d["outage_count"]
+        self.outage_ms += d["outage_ms"]
+        self.cell_changes += d["cell_changes"]
+        self.dirty = True
+
+
+class SessionRollups:
+    """
+    Priebežné agregáty per session počítané na serveri z naozaj zapísaných
+    riadkov (repo ich hlási cez write_listeners, takže replaye a opakované
+    RTT okná sa nezapočítajú dvakrát). Flush do session_stats beží
+    periodicky, pri nečinnosti session a pri stop(); klientsky
+    session_summary sa s nimi zlučuje v DB (pozri upsert_session_stats).
+    """
+
+    def __init__(self, repo: Any, flush_s: float = ROLLUP_FLUSH_S,
+                 idle_s: float = ROLLUP_IDLE_S, max_sessions: int = ROLLUP_MAX_SESSIONS) -> None:
+        self.repo = repo
+        self.flush_s = flush_s
+        self.idle_s = idle_s
+        self.max_sessions = max_sessions
+        # LRU podľa poslednej aktivity (najstaršie vpredu)
+        self.sessions: "OrderedDict[str, SessionRollup]" = OrderedDict()
+        self._evicted: List[SessionRollup] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def _get(self, sid: str) -> SessionRollup:
+        r = self.sessions.get(sid)
+        if r is None:
+            r = self.sessions[sid] = SessionRollup(sid)
+            while len(self.sessions) > self.max_sessions:
+                _, old = self.sessions.popitem(last=False)
+                self._evicted.append(old)
+        else:
+            self.sessions.move_to_end(sid)
+        r.last_seen = time.monotonic()
+        return r
+
+    def observe(self, inserted: List[Dict[str, Any]],
+                rtt_fills: List[Tuple[Optional[str], float]]) -> None:
+        """write listener: nové riadky meraní a RTT doplnené k starším riadkom."""
+        for row in inserted:
+            sid = row.get("SessionId")
+            if sid:
+                self._get(sid).add_measurement(row)
+        for sid, rtt in rtt_fills:
+            if sid and rtt is not None:
+                self._get(sid).add_rtt(rtt)
+
+    def finish(self, session_id: Optional[str]) -> None:
+        """Klient session ukončil (session_summary) -> flush a vyradenie pri ďalšom ticku."""
+        r = self.sessions.get(session_id) if session_id else None
+        if r is not None:
+            r.finished = True
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="session-rollups")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(evict_all=True)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_s)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Session rollup flush failed")
+
+    async def flush(self, evict_all: bool = False) -> int:
+        """Zapíše zmenené rollupy; nečinné/ukončené vyradí. Vráti počet zapísaných."""
+        now = time.monotonic()
+        done = self._evicted
+        self._evicted = []
+        for sid, r in list(self.sessions.items()):
+            if evict_all or r.finished or now - r.last_seen > self.idle_s:
+                del self.sessions[sid]
+                done.append(r)
+
+        rows = [r.take_delta(final=True) for r in done]
+        pending = [r for r in self.sessions.values() if r.dirty]
+        rows += [r.take_delta() for r in pending]
+        if not rows:
+            return 0
+        try:
+            await self.repo.upsert_session_rollups(rows)
+        except Exception:
+            # delty sa vrátia; vyradené sessions sa vrátia do pamäte
+            for r, d in zip(done + pending, rows):
+                self.sessions.setdefault(r.session_id, r).restore(d)
+            raise
+        hot_log.info("Flushed %d session rollups (%d evicted)", len(rows), len(done))
+        return len(rows)
@@ -0,0 +1,438 @@
+# spool.py
+from __future__ import annotations
+import asyncio
+import fcntl
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+from typing import Any, Callable, List, Optional, Tuple
+
+import msgspec
+
+from logger import get_logger, setup_logging
+from records import Record, from_wire, to_wire
+
+setup_logging()
+log = get_logger("spool")
+
+# Lokálny write-ahead spool medzi ACK a DB; prázdny = vypnutý (ACK po
+# zaradení do fronty v RAM ako doteraz).
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+# Veľkosť segmentu; po jeho naplnení sa začne nový, úplne spracované sa mažú.
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# Celkový diskový rozpočet (delí sa medzi shardy); nad ním sa rámce odmietajú.
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+# Group commit: ako dlho sa po prvom zápise zbierajú ďalšie pred spoločným fsync (ms).
+SPOOL_FSYNC_MS = float(os.getenv("SPOOL_FSYNC_MS", "2"))
+# Pri zastavení: ako dlho ešte zapisovať spool do DB (s); zvyšok sa prehrá po štarte.
+SPOOL_DRAIN_S = float(os.getenv("SPOOL_DRAIN_S", "10"))
+# Interval overovania DB počas výpadku, keď worker drží dávku zo spoolu (s).
+SPOOL_RETRY_S = float(os.getenv("SPOOL_RETRY_S", "1"))
+
+# rámec = dĺžka payloadu + crc32 payloadu (little-endian) + MessagePack
+# (routing kľúč, cena v kreditoch, records.to_wire)
+_HEADER = struct.Struct("<II")
+_SEGMENT_SUFFIX = ".seg"
+_OFFSET_FILE = "offset"
+
+_encode = msgspec.msgpack.Encoder().encode
+_decode = msgspec.msgpack.Decoder().decode
+
+
+def encode_frame(rkey: str, cost: int, rec: Record) -> bytes:
+    payload = _encode((rkey, cost, to_wire(rec)))
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_frame(payload: bytes) -> Tuple[str, int, Record]:
+    rkey, cost, wire = _decode(payload)
+    return rkey, cost, from_wire(wire)
+
+
+class SegmentLog:
+    """
+    Append-only log jedného shardu: súbory <base offset>.seg v adresári,
+    kde base offset je logická pozícia prvého bajtu segmentu v celom logu.
+    - append() zapisuje na koniec posledného segmentu a robí fsync
+      (volá sa z vlákna, pozri Spool._flush);
+    - read() číta rámce cez mmap segmentu, do ktorého offset patrí;
+    - commit() uloží offset spracovaných rámcov a zmaže segmenty pred ním
+      (tiež z vlákna, pozri Spool.commit).
+    Offset súbor sa nefsyncuje: po páde sa zopakuje najviac pár posledných
+    dávok a zápis meraní / RTT / session_stats je idempotentný.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = SPOOL_SEGMENT_BYTES) -> None:
+        self.path = path
+        self.segment_bytes = max(_HEADER.size + 1, int(segment_bytes))
+        self.bases: List[int] = []
+        self.end = 0
+        self.committed = 0
+        self._file = None
+        self._lock = threading.Lock()
+        # mmap segmentu, z ktorého sa práve číta: (base, mmap)
+        self._map: Optional[Tuple[int, mmap.mmap]] = None
+
+    def open(self) -> int:
+        """
+        Načíta segmenty a offset, odreže neúplný rámec na konci; vráti počet
+        nespracovaných rámcov (preskočený poškodený úsek sa počíta ako jeden).
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.bases = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                            if name.endswith(_SEGMENT_SUFFIX))
+        try:
+            with open(os.path.join(self.path, _OFFSET_FILE)) as f:
+                self.committed = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            self.committed = 0
+        if not self.bases:
+            self.bases = [self.committed]
+            open(self._segment_path(self.committed), "ab").close()
+            _fsync_dir(self.path)
+        last = self.bases[-1]
+        self.end = last + self._repair(last)
+        self.committed = min(max(self.committed, self.bases[0]), self.end)
+        self._file = open(self._segment_path(last), "ab")
+        return sum(1 for _ in self.scan(self.committed))
+
+    def close(self) -> None:
+        self._unmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, frames: List[bytes]) -> int:
+        """Zapíše rámce, fsync; vráti nový koniec logu. Pri chybe log ostane na pôvodnom konci."""
+        f = self._file
+        start = self.end
+        try:
+            for frame in frames:
+                if self.end > self.bases[-1] and self.end - self.bases[-1] + len(frame) > self.segment_bytes:
+                    f = self._roll()
+                f.write(frame)
+                self.end += len(frame)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            self._rollback(start)
+            raise
+        return self.end
+
+    def read(self, offset: int, max_records: int,
+             end: Optional[int] = None) -> List[Tuple[bytes, int]]:
+        """
+        Až max_records rámcov od offsetu po `end` (koniec po poslednom fsync,
+        default self.end): [(payload, offset za rámcom)]. Poškodený rámec
+        preskočí zvyšok segmentu (zaloguje sa, ostatné segmenty sa čítajú ďalej).
+        """
+        out: List[Tuple[bytes, int]] = []
+        end = self.end if end is None else end
+        while offset < end and len(out) < max_records:
+            base, seg_end, mm = self._mapped(offset, end)
+            pos = offset - base
+            length, crc = _HEADER.unpack_from(mm, pos)
+            payload = mm[pos + _HEADER.size:pos + _HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                log.error("Spool %s: corrupt frame at %d, skipping %d bytes",
+                          self.path, offset, seg_end - offset)
+                offset = seg_end
+                out.append((b"", offset))
+                continue
+            offset += _HEADER.size + length
+            out.append((payload, offset))
+        return out
+
+    def scan(self, offset: int):
+        """Prejde všetky rámce od offsetu (replay, prenos medzi layoutmi)."""
+        while True:
+            chunk = self.read(offset, 1000)
+            if not chunk:
+                return
+            yield from chunk
+            offset = chunk[-1][1]
+
+    def commit(self, offset: int) -> None:
+        """Rámce pred offsetom sú v DB: ulož offset a zmaž úplne spracované segmenty."""
+        self.committed = offset
+        tmp = os.path.join(self.path, _OFFSET_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, os.path.join(self.path, _OFFSET_FILE))
+        with self._lock:
+            while len(self.bases) > 1 and self.bases[1] <= offset:
+                base = self.bases.pop(0)
+                if self._map is not None and self._map[0] == base:
+                    self._unmap()
+                os.unlink(self._segment_path(base))
+
+    def _segment_path(self, base: int) -> str:
+        return os.path.join(self.path, f"{base:020d}{_SEGMENT_SUFFIX}")
+
+    def _roll(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        with self._lock:
+            self.bases.append(self.end)
+        self._file = open(self._segment_path(self.end), "ab")
+        _fsync_dir(self.path)
+        return self._file
+
+    def _rollback(self, end: int) -> None:
+        """Zahodí čiastočne zapísané rámce (napr. ENOSPC) – tie sa ani neACKli."""
+        with self._lock:
+            while len(self.bases) > 1 and self.bases[-1] > end:
+                base = self.bases.pop()
+                try:
+                    os.unlink(self._segment_path(base))
+                except FileNotFoundError:
+                    pass
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        base = self.bases[-1]
+        with open(self._segment_path(base), "r+b") as f:
+            f.truncate(end - base)
+        self.end = end
+        self._file = open(self._segment_path(base), "ab")
+
+    def _repair(self, base: int) -> int:
+        """Dĺžka platných rámcov posledného segmentu; zvyšok (pád počas zápisu) sa odreže."""
+        path = self._segment_path(base)
+        size = os.path.getsize(path)
+        pos = 0
+        with open(path, "rb") as f:
+            while pos + _HEADER.size <= size:
+                f.seek(pos)
+                length, crc = _HEADER.unpack(f.read(_HEADER.size))
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                pos += _HEADER.size + length
+        if pos < size:
+            log.warning("Spool %s: dropping %d bytes of a torn write", path, size - pos)
+            with open(path, "r+b") as f:
+                f.truncate(pos)
+                f.flush()
+                os.fsync(f.fileno())
+        return pos
+
+    def _mapped(self, offset: int, end: int) -> Tuple[int, int, mmap.mmap]:
+        """(base, koniec, mmap) segmentu s offsetom; aktívny segment sa premapuje, keď narástol."""
+        # pod zámkom aj výmena mmap: commit() z vlákna odmapúva mazané segmenty
+        with self._lock:
+            i = max(i for i, b in enumerate(self.bases) if b <= offset)
+            base = self.bases[i]
+            seg_end = self.bases[i + 1] if i + 1 < len(self.bases) else end
+            cur = self._map
+            if cur is not None and cur[0] == base and len(cur[1]) == seg_end - base:
+                return base, seg_end, cur[1]
+            self._unmap()
+            with open(self._segment_path(base), "rb") as f:
+                mm = mmap.mmap(f.fileno(), seg_end - base, access=mmap.ACCESS_READ)
+            self._map = (base, mm)
+        return base, seg_end, mm
+
+    def _unmap(self) -> None:
+        if self._map is not None:
+            self._map[1].close()
+            self._map = None
+
+
+class Spool:
+    """
+    Write-ahead spool pre MessageProcessor: jeden SegmentLog na shard
+    v <root>/<shards>-shards/<shard>.
+    - append() zaradí rámec hneď (poradie v sharde = poradie admission)
+      a vráti future, ktorá sa splní po spoločnom fsync (group commit);
+      až potom smie ísť klientovi ACK;
+    - read() vracia len rámce, ktoré už prešli fsync;
+    - commit() posúva offset po zápise dávky do DB.
+    Pri zmene počtu shardov sa nespracované rámce starého layoutu pri
+    open() prerozdelia podľa routing kľúča a starý layout sa zmaže.
+    """
+
+    def __init__(self, root: str, shards: int, shard_for: Callable[[str], int],
+                 segment_bytes: int = SPOOL_SEGMENT_BYTES, max_bytes: int = SPOOL_MAX_BYTES,
+                 fsync_ms: float = SPOOL_FSYNC_MS) -> None:
+        self.root = root
+        self.shards = shards
+        self.shard_for = shard_for
+        self.shard_max_bytes = max(1, int(max_bytes) // shards)
+        self.fsync_s = max(0.0, float(fsync_ms)) / 1000.0
+        self.logs = [SegmentLog(os.path.join(root, f"{shards}-shards", str(i)), segment_bytes)
+                     for i in range(shards)]
+        # rámce čakajúce na fsync: per shard [(bytes, future)]
+        self._pending: List[List[Tuple[bytes, asyncio.Future]]] = [[] for _ in range(shards)]
+        self._pending_bytes = [0] * shards
+        # koniec logu po poslednom fsync a offset, po ktorý už číta feeder
+        self._durable = [0] * shards
+        self._read_at = [0] * shards
+        # počty nespracovaných rámcov (na disku + čakajúce na fsync)
+        self._records = [0] * shards
+        self._readable = [asyncio.Event() for _ in range(shards)]
+        self._kick = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+        self._lock_fd: Optional[int] = None
+        self.stats = {"appended": 0, "fsyncs": 0, "replayed": 0, "errors": 0}
+
+    async def open(self) -> None:
+        await asyncio.to_thread(self._open)
+        self._closing = False
+        self._flusher = asyncio.create_task(self._flush_loop(), name="spool-flusher")
+
+    def _open(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        # jeden proces na spool (napr. uvicorn --workers N bez gateway režimu)
+        fd = os.open(os.path.join(self.root, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(f"spool {self.root} is used by another process")
+        self._lock_fd = fd
+        for i, slog in enumerate(self.logs):
+            self._records[i] = slog.open()
+            self._durable[i] = slog.end
+            self._read_at[i] = slog.committed
+        self._migrate()
+        self.stats["replayed"] = sum(self._records)
+        if self.stats["replayed"]:
+            log.info("Spool %s: replaying %d records not yet in the database",
+                     self.root, self.stats["replayed"])
+
+    def _migrate(self) -> None:
+        """Nespracované rámce layoutu s iným počtom shardov -> aktuálne shardy."""
+        current = f"{self.shards}-shards"
+        for name in sorted(os.listdir(self.root)):
+            if name == current or not name.endswith("-shards"):
+                continue
+            old_dir = os.path.join(self.root, name)
+            moved = [[] for _ in range(self.shards)]
+            for sub in sorted(os.listdir(old_dir), key=lambda s: (len(s), s)):
+                old = SegmentLog(os.path.join(old_dir, sub))
+                old.open()
+                for payload, _ in old.scan(old.committed):
+                    if not payload:
+                        continue
+                    rkey = _decode(payload)[0]
+                    moved[self.shard_for(rkey)].append(
+                        _HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                old.close()
+            n = 0
+            for i, frames in enumerate(moved):
+                if frames:
+                    self._durable[i] = self.logs[i].append(frames)
+                    self._records[i] += len(frames)
+                    n += len(frames)
+            log.warning("Spool %s: moved %d records from layout %s", self.root, n, name)
+            shutil.rmtree(old_dir)
+
+    async def close(self) -> None:
+        """Dopíše čakajúce rámce a zavrie segmenty (nespracované ostanú na disku)."""
+        if self._flusher is not None:
+            # bez cancel: rozbehnutý zápis vo vlákne musí dobehnúť a splniť futures
+            # skôr, než sa segmenty zavrú
+            self._closing = True
+            self._kick.set()
+            try:
+                await self._flusher
+            except Exception:
+                log.exception("Spool flusher failed")
+            self._flusher = None
+        await self._flush()
+        for slog in self.logs:
+            slog.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def append(self, shard: int, frame: bytes) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[shard].append((frame, fut))
+        self._pending_bytes[shard] += len(frame)
+        self._records[shard] += 1
+        self._kick.set()
+        return fut
+
+    def backlog_bytes(self, shard: int) -> int:
+        """Bajty ešte nezapísané do DB (na disku aj čakajúce na fsync)."""
+        return self._durable[shard] - self.logs[shard].committed + self._pending_bytes[shard]
+
+    def backlog_records(self, shard: int) -> int:
+        return self._records[shard]
+
+    async def read(self, shard: int, max_records: int) -> List[Tuple[str, int, Record, int]]:
+        """Počká na zapísané rámce a vráti [(rkey, cost, record, offset za rámcom)]."""
+        slog = self.logs[shard]
+        while self._read_at[shard] >= self._durable[shard]:
+            self._readable[shard].clear()
+            await self._readable[shard].wait()
+        chunk = slog.read(self._read_at[shard], max_records, self._durable[shard])
+        self._read_at[shard] = chunk[-1][1]
+        # prázdny payload = preskočený poškodený úsek; offset sa aj tak commitne
+        return [(*decode_frame(payload), end) if payload else ("", 0, None, end)
+                for payload, end in chunk]
+
+    async def commit(self, shard: int, offset: int, records: int) -> None:
+        """Posunie offset shardu; súbory (offset, mazanie segmentov) mimo event loopu."""
+        self._records[shard] -= records
+        await asyncio.to_thread(self.logs[shard].commit, offset)
+
+    async def _flush_loop(self) -> None:
+        while not self._closing:
+            await self._kick.wait()
+            if self.fsync_s:
+                await asyncio.sleep(self.fsync_s)
+            self._kick.clear()
+            await self._flush()
+
+    async def _flush(self) -> None:
+        work = []
+        for shard in range(self.shards):
+            if self._pending[shard]:
+                work.append((shard, self._pending[shard]))
+                self._pending[shard] = []
+                self._pending_bytes[shard] = 0
+        if not work:
+            return
+        results = await asyncio.to_thread(self._write, work)
+        self.stats["fsyncs"] += 1
+        for (shard, items), res in zip(work, results):
+            if isinstance(res, BaseException):
+                self.stats["errors"] += 1
+                self._records[shard] -= len(items)
+                log.error("Spool write failed (shard %d, %d records): %r", shard, len(items), res)
+                for _, fut in items:
+                    if not fut.done():
+                        fut.set_result(False)
+                continue
+            self._durable[shard] = res
+            self.stats["appended"] += len(items)
+            self._readable[shard].set()
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_result(True)
+
+    def _write(self, work) -> List[Any]:
+        out: List[Any] = []
+        for shard, items in work:
+            try:
+                out.append(self.logs[shard].append([frame for frame, _ in items]))
+            except Exception as e:
+                out.append(e)
+        return out
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,58 +1,133 @@
 # ws_client.py
+import argparse
 import asyncio
 import json
 import time
 import uuid
 from collections import deque
+import msgspec
 import websockets
 import secrets
 import time
 
 URL = "ws://127.0.0.1:8000/ws"
+SUBPROTOCOL_MSGPACK = "drivetest.msgpack"
 MAX_RTT_UPDATES = 20
+SESSION_ID = "TEST_" + uuid.uuid4().hex[:12]
 
 
-def make_measurement(mid: str, rtt_updates):
+def make_measurement(mid: str, rtt_updates, window: int = MAX_RTT_UPDATES):
     return {
         "type": "measurement",
         "id": mid,
+        "session_id": SESSION_ID,
         "timestamp_sent": int(time.time() * 1000),
         "radio": {"rsrp": -900, "rsrq": -10, "sinr": 20, "cell_id": 123456, "network_type": "5G"},
         "position": {"lat": 48.456, "lon": 17.065, "speed_kmh": 95.2},
         "device": {"operator": "O2", "device_id": "TEST_" + uuid.uuid4().hex[:8]},
         "v2x": {"kind": "BSM", "payload": {"speed_kmh": 95.2, "heading_deg": 182.4}},
-        "rtt_updates": list(rtt_updates)[-MAX_RTT_UPDATES:]
+        "rtt_updates": list(rtt_updates)[-window:] if window > 0 else []
     }
 
 
+def make_batch(measurements):
+    return {"type": "measurement_batch", "session_id": SESSION_ID, "items": measurements}
+
+
 def make_id():
     ms = int(time.time() * 1000)
     suf = secrets.token_hex(4)
     return f"{ms}-{suf}"
 
 
+def parse_args():
+    ap = argparse.ArgumentParser(description="Testovací WS klient")
+    ap.add_argument("--url", default=URL)
+    ap.add_argument("--count", type=int, default=5, help="počet meraní")
+    ap.add_argument("--interval", type=float, default=0.4,
+                    help="pauza medzi rámcami v sekundách")
+    ap.add_argument("--batch", type=int, default=0,
+                    help="posielať measurement_batch po N meraniach (0 = po jednom)")
+    ap.add_argument("--encoding", choices=["json", "msgpack"], default="json",
+                    help="msgpack = binárne rámce cez subprotocol " + SUBPROTOCOL_MSGPACK)
+    ap.add_argument("--compress", action="store_true",
+                    help="ponúknuť permessage-deflate")
+    return ap.parse_args()
+
+
 async def main():
+    args = parse_args()
 
-    async with websockets.connect(URL, compression=None) as ws:
+    msgpack = args.encoding == "msgpack"
+    async with websockets.connect(
+        args.url,
+        compression="deflate" if args.compress else None,
+        subprotocols=[SUBPROTOCOL_MSGPACK] if msgpack else None,
+    ) as ws:
+        print(f"subprotocol={ws.subprotocol} "
+              f"extensions={ws.response_headers.get('Sec-WebSocket-Extensions', '-')}")
+        if msgpack and ws.subprotocol != SUBPROTOCOL_MSGPACK:
+            raise SystemExit("server neakceptoval " + SUBPROTOCOL_MSGPACK)
+        sent_bytes = 0
+        retries = 0
         rtt_outbox = deque()
-        for i in range(5):
-            mid = make_id()
-            payload = make_measurement(mid, rtt_outbox)
+        t_start = time.monotonic_ns()
+        sent = 0
+        while sent < args.count:
+            n = min(args.batch, args.count - sent) if args.batch > 0 else 1
+            mids = [make_id() for _ in range(n)]
+            if args.batch > 0:
+                # RTT okno stačí poslať raz za dávku (na prvej položke)
+                window = max(MAX_RTT_UPDATES, n)
+                items = [make_measurement(mid, rtt_outbox, window if i == 0 else 0)
+                         for i, mid in enumerate(mids)]
+            else:
+                items = [make_measurement(mids[0], rtt_outbox)]
+            payload = make_batch(items) if args.batch > 0 else items[0]
 
             t0 = time.monotonic_ns()
-            await ws.send(json.dumps(payload, separators=(',', ':')))
-            raw = await ws.recv()
+            frame = (msgspec.msgpack.encode(payload) if msgpack
+                     else json.dumps(payload, separators=(',', ':')))
+            while True:
+                sent_bytes += len(frame)
+                await ws.send(frame)
+                reply = await recv_reply(ws)
+                if reply.get("type") != "retry_after":
+                    break
+                # server rámec neprijal (neACKol) -> počkať a poslať znova
+                retries += 1
+                await asyncio.sleep(reply.get("retry_after_ms", 1000) / 1000)
+            raw = reply if msgpack else json.dumps(reply, separators=(',', ':'))
             t1 = time.monotonic_ns()
 
             rtt_ms = (t1 - t0) / 1e6
-            print(raw, f"RTT≈{rtt_ms:.2f} ms")
+            print(raw if args.batch <= 0 else f"batch ack ({n} ids)", f"RTT≈{rtt_ms:.2f} ms")
 
-            rtt_outbox.append({"id": mid, "rtt_ms": rtt_ms})
+            for mid in mids:
+                rtt_outbox.append({"id": mid, "rtt_ms": rtt_ms})
 
-            while len(rtt_outbox) > 100:
+            while len(rtt_outbox) > max(100, 2 * n):
                 rtt_outbox.popleft()
 
-            await asyncio.sleep(0.4)
+            sent += n
+            if args.interval > 0:
+                await asyncio.sleep(args.interval)
+
+        elapsed = (time.monotonic_ns() - t_start) / 1e9
+        print(f"sent {sent} measurements in {elapsed:.2f} s ({sent / elapsed:.0f} msg/s), "
+              f"{sent_bytes / sent:.0f} B/measurement before compression, {retries} retries")
+
+
+async def recv_reply(ws):
+    """Prečíta odpoveď na odoslaný rámec; slow_down rámce rešpektuje a preskočí."""
+    while True:
+        raw = await ws.recv()
+        msg = msgspec.msgpack.decode(raw) if isinstance(raw, bytes) else json.loads(raw)
+        if msg.get("type") == "slow_down":
+            print("slow_down", msg)
+            await asyncio.sleep(msg.get("retry_after_ms", 1000) / 1000)
+            continue
+        return msg
 
 if __name__ == "__main__":
     asyncio.run(main())
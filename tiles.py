@@ -0,0 +1,297 @@
+# tiles.py
+from __future__ import annotations
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import func, literal_column, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from logger import get_logger, setup_logging
+from models import CoverageTile
+
+setup_logging()
+log = get_logger("tiles")
+
+# Agregáty pokrytia sa počítajú pri každom inserte dávky (false = vypnuté).
+TILES_ENABLED = os.getenv("TILES_ENABLED", "true").lower() in ("1", "true", "yes")
+# Zoom úrovne (slippy map), na ktorých sa agregáty ukladajú.
+TILE_ZOOMS = tuple(sorted({int(z) for z in os.getenv("TILE_ZOOMS", "12,14,16").split(",") if z.strip()}))
+# /tiles/{z}/{x}/{y} vráti mriežku buniek zoomu z + TILE_DETAIL (4 -> 16×16).
+TILE_DETAIL = int(os.getenv("TILE_DETAIL", "4"))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "1024"))
+TILE_CACHE_TTL_S = float(os.getenv("TILE_CACHE_TTL_S", "60"))
+
+# stĺpec Measurement -> prefix agregátu v CoverageTile
+METRICS = (("Level", "level"), ("Qual", "qual"), ("SNR", "snr"))
+KEY_COLUMNS = ("zoom", "x", "y", "network_tech", "band", "cell_id")
+AGG_COLUMNS = ("n",) + tuple(f"{p}_{s}" for _, p in METRICS
+                             for s in ("n", "sum", "sumsq", "min", "max"))
+
+_MAX_LAT = 85.05112878
+
+# Príznak "riadok bol naozaj vložený" (nie RTT update existujúceho) z RETURNING.
+INSERTED = literal_column("(xmax = 0)").label("inserted")
+
+TileKey = Tuple[int, int, int, str, str, int]
+
+
+def tile_xy(lat: float, lon: float, zoom: int) -> Tuple[int, int]:
+    """Web Mercator dlaždica (x, y) pre bod; rovnaký vzorec ako v _REBUILD_SQL."""
+    lat = max(-_MAX_LAT, min(_MAX_LAT, lat))
+    n = 1 << zoom
+    x = int(math.floor((lon + 180.0) / 360.0 * n))
+    r = math.radians(lat)
+    y = int(math.floor((1.0 - math.log(math.tan(r) + 1.0 / math.cos(r)) / math.pi) / 2.0 * n))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def aggregate(rows: Iterable[Dict[str, Any]], zooms: Iterable[int] = TILE_ZOOMS) -> List[Dict[str, Any]]:
+    """
+    Zlúči ploché riadky Measurement do agregátov CoverageTile (jeden dict na
+    kľúč). Výstup je zoradený podľa kľúča, aby súbežné upserty zamykali
+    riadky v rovnakom poradí (bez deadlockov medzi workermi).
+    """
+    zooms = tuple(zooms)
+    acc: Dict[TileKey, List[Any]] = {}
+    for r in rows:
+        lat, lon = r.get("Latitude"), r.get("Longitude")
+        if lat is None or lon is None:
+            continue
+        vals = [r.get(c) for c, _ in METRICS]
+        dims = (r.get("NetworkTech") or "", r.get("BAND") or "",
+                r.get("CellID") if r.get("CellID") is not None else -1)
+        for z in zooms:
+            x, y = tile_xy(lat, lon, z)
+            key = (z, x, y) + dims
+            a = acc.get(key)
+            if a is None:
+                a = acc[key] = [0] + [0, 0.0, 0.0, None, None] * len(METRICS)
+            a[0] += 1
+            for i, v in enumerate(vals):
+                if v is None:
+                    continue
+                o = 1 + 5 * i
+                a[o] += 1
+                a[o + 1] += v
+                a[o + 2] += v * v
+                a[o + 3] = v if a[o + 3] is None else min(a[o + 3], v)
+                a[o + 4] = v if a[o + 4] is None else max(a[o + 4], v)
+    return [dict(zip(KEY_COLUMNS + AGG_COLUMNS, k + tuple(a))) for k, a in sorted(acc.items())]
+
+
+def upsert_statement(aggs: List[Dict[str, Any]]):
+    """INSERT ... ON CONFLICT, ktorý pripočíta agregáty k existujúcim."""
+    stmt = insert(CoverageTile).values(aggs)
+    t, ex = CoverageTile.__table__.c, stmt.excluded
+    set_: Dict[str, Any] = {"n": t.n + ex.n, "updated_at": func.now()}
+    for _, p in METRICS:
+        for s in ("n", "sum", "sumsq"):
+            set_[f"{p}_{s}"] = t[f"{p}_{s}"] + ex[f"{p}_{s}"]
+        set_[f"{p}_min"] = literal_column(f"LEAST(coverage_tiles.{p}_min, excluded.{p}_min)")
+        set_[f"{p}_max"] = literal_column(f"GREATEST(coverage_tiles.{p}_max, excluded.{p}_max)")
+    return stmt.on_conflict_do_update(index_elements=list(KEY_COLUMNS), set_=set_)
+
+
+# Rovnaký upsert pre asyncpg: celé pole agregátov ako stĺpcové polia cez unnest.
+_PG_TYPES = {"zoom": "int2", "x": "int4", "y": "int4", "network_tech": "text",
+             "band": "text", "cell_id": "int8", "n": "int8"}
+for _, _p in METRICS:
+    _PG_TYPES.update({f"{_p}_n": "int8", f"{_p}_sum": "float8", f"{_p}_sumsq": "float8",
+                      f"{_p}_min": "int4", f"{_p}_max": "int4"})
+_ALL = KEY_COLUMNS + AGG_COLUMNS
+UPSERT_SQL = (
+    f"INSERT INTO coverage_tiles ({', '.join(_ALL)}) "
+    f"SELECT * FROM unnest({', '.join(f'${i}::{_PG_TYPES[c]}[]' for i, c in enumerate(_ALL, 1))}) "
+    f"ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET n = coverage_tiles.n + EXCLUDED.n, "
+    + ", ".join(
+        f"{p}_{s} = coverage_tiles.{p}_{s} + EXCLUDED.{p}_{s}"
+        for _, p in METRICS for s in ("n", "sum", "sumsq"))
+    + ", "
+    + ", ".join(
+        f"{p}_min = LEAST(coverage_tiles.{p}_min, EXCLUDED.{p}_min), "
+        f"{p}_max = GREATEST(coverage_tiles.{p}_max, EXCLUDED.{p}_max)"
+        for _, p in METRICS)
+    + ", updated_at = now()"
+)
+
+
+def upsert_args(aggs: List[Dict[str, Any]]) -> List[List[Any]]:
+    return [[a[c] for a in aggs] for c in _ALL]
+
+
+def _sql_tile(col: str, z: str) -> str:
+    # SQL ekvivalent tile_xy (z je SQL výraz so zoomom)
+    if col == "x":
+        return (f'LEAST(GREATEST(floor(("Longitude" + 180.0) / 360.0 * (1 << {z}))::int, 0), '
+                f"(1 << {z}) - 1)")
+    lat = f'radians(LEAST(GREATEST("Latitude", -{_MAX_LAT}), {_MAX_LAT}))'
+    return (f"LEAST(GREATEST(floor((1.0 - ln(tan({lat}) + 1.0 / cos({lat})) / pi()) / 2.0 "
+            f"* (1 << {z}))::int, 0), (1 << {z}) - 1)")
+
+
+def _rebuild_sql(zooms: Iterable[int]) -> str:
+    aggs = ['count(*)']
+    for col, _ in METRICS:
+        c = f'"{col}"'
+        aggs += [f"count({c})", f"COALESCE(sum({c}), 0)", f"COALESCE(sum({c}::float8 * {c}), 0)",
+                 f"min({c})", f"max({c})"]
+    return (
+        f"INSERT INTO coverage_tiles ({', '.join(_ALL)}) "
+        f"SELECT z, {_sql_tile('x', 'z')}, {_sql_tile('y', 'z')}, "
+        f'COALESCE("NetworkTech", \'\'), COALESCE("BAND", \'\'), COALESCE("CellID", -1), '
+        f"{', '.join(aggs)} "
+        f"FROM measurements CROSS JOIN unnest(ARRAY[{', '.join(str(int(z)) for z in zooms)}]::int[]) AS z "
+        f'WHERE "Latitude" IS NOT NULL AND "Longitude" IS NOT NULL '
+        f"GROUP BY 1, 2, 3, 4, 5, 6"
+    )
+
+
+async def rebuild(engine: AsyncEngine, zooms: Iterable[int] = TILE_ZOOMS) -> int:
+    """
+    Prepočíta coverage_tiles z celej histórie jedným set-based príkazom
+    (GROUP BY v DB, bez prechodu riadkov cez Python). Prebieha v jednej
+    transakcii; súbežné inserty agregátov počkajú na jej koniec.
+    """
+    zooms = tuple(zooms)
+    async with engine.begin() as conn:
+        await conn.execute(text("LOCK TABLE coverage_tiles IN EXCLUSIVE MODE"))
+        await conn.execute(text("TRUNCATE coverage_tiles"))
+        res = await conn.execute(text(_rebuild_sql(zooms)))
+    TILE_CACHE.clear()
+    log.info("Rebuilt %d coverage tiles (zooms %s)", res.rowcount, zooms)
+    return res.rowcount
+
+
+class TileCache:
+    """
+    LRU cache odpovedí /tiles. Záznam sa zneplatní, keď sa zmení niektorý
+    agregát v jeho dlaždici (invalidate po commite dávky), najneskôr po TTL.
+    """
+
+    def __init__(self, maxsize: int = TILE_CACHE_SIZE, ttl_s: float = TILE_CACHE_TTL_S) -> None:
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+        # (bin_zoom, z, x, y) -> kľúče cache pre danú dlaždicu
+        self._by_tile: Dict[Tuple[int, int, int, int], Set[tuple]] = {}
+        self._details: Set[int] = set()
+        # odberatelia zmenených agregátov (writer ich posiela gateway procesom)
+        self.listeners: List[Callable[[List[Dict[str, Any]]], None]] = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _tile_of(key: tuple) -> Tuple[int, int, int, int]:
+        z, x, y, detail = key[:4]
+        return (z + detail, z, x, y)
+
+    def get(self, key: tuple) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None or time.monotonic() - item[0] > self.ttl_s:
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: tuple, value: Any) -> None:
+        """key = (z, x, y, detail, *filtre)."""
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        self._by_tile.setdefault(self._tile_of(key), set()).add(key)
+        self._details.add(key[3])
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)))
+
+    def invalidate(self, aggs: Iterable[Dict[str, Any]]) -> None:
+        if self.listeners:
+            aggs = list(aggs)
+            for fn in self.listeners:
+                fn(aggs)
+        if not self._data:
+            return
+        for a in aggs:
+            bz, bx, by = a["zoom"], a["x"], a["y"]
+            for d in self._details:
+                keys = self._by_tile.pop((bz, bz - d, bx >> d, by >> d), None)
+                for k in keys or ():
+                    self._data.pop(k, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._by_tile.clear()
+
+    def _remove(self, key: tuple) -> None:
+        self._data.pop(key, None)
+        keys = self._by_tile.get(self._tile_of(key))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_tile[self._tile_of(key)]
+
+
+TILE_CACHE = TileCache()
+
+
+class TileReader:
+    """Číta agregáty dlaždice (cez cache) pre endpoint /tiles/{z}/{x}/{y}."""
+
+    def __init__(self, engine: AsyncEngine, cache: TileCache = TILE_CACHE) -> None:
+        self.engine = engine
+        self.cache = cache
+
+    async def get(self, z: int, x: int, y: int, detail: int = TILE_DETAIL,
+                  network_tech: Optional[str] = None, band: Optional[str] = None,
+                  cell_id: Optional[int] = None) -> Dict[str, Any]:
+        key = (z, x, y, detail, network_tech, band, cell_id)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        bz = z + detail
+        t = CoverageTile.__table__.c
+        stmt = select(CoverageTile.__table__).where(
+            t.zoom == bz,
+            t.x.between(x << detail, ((x + 1) << detail) - 1),
+            t.y.between(y << detail, ((y + 1) << detail) - 1),
+        )
+        if network_tech is not None:
+            stmt = stmt.where(t.network_tech == network_tech)
+        if band is not None:
+            stmt = stmt.where(t.band == band)
+        if cell_id is not None:
+            stmt = stmt.where(t.cell_id == cell_id)
+        async with self.engine.connect() as conn:
+            rows = (await conn.execute(stmt)).mappings().all()
+
+        out = {"z": z, "x": x, "y": y, "bin_zoom": bz,
+               "cells": [_cell(r) for r in rows]}
+        self.cache.put(key, out)
+        return out
+
+
+def _cell(r: Any) -> Dict[str, Any]:
+    cell: Dict[str, Any] = {
+        "x": r["x"], "y": r["y"],
+        "network_tech": r["network_tech"] or None, "band": r["band"] or None,
+        "cell_id": r["cell_id"] if r["cell_id"] != -1 else None,
+        "n": r["n"],
+    }
+    for _, p in METRICS:
+        n = r[f"{p}_n"]
+        if not n:
+            cell[p] = None
+            continue
+        mean = r[f"{p}_sum"] / n
+        var = max(0.0, r[f"{p}_sumsq"] / n - mean * mean)
+        cell[p] = {"n": n, "mean": round(mean, 3), "std": round(math.sqrt(var), 3),
+                   "min": r[f"{p}_min"], "max": r[f"{p}_max"]}
+    return cell
@@ -1,14 +1,28 @@
 # websocket.py
+import asyncio
 import json
+import os
+import time
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from logger import get_logger, setup_logging
-from worker import MessageProcessor
+from starlette.websockets import WebSocketState
+from logger import get_logger, get_hot_logger, setup_logging
+from worker import Admission, CreditWindow, MessageProcessor
+import metrics
+from dbhandler import ROW_KEY
+from metrics import METRICS_ENABLED
+from decoding import JSON, MSGPACK, decode_frame, encode_message
 
 setup_logging()
 log = get_logger("websocket")
+hot_log = get_hot_logger("websocket")
 
 router = APIRouter()
 
+# WebSocket subprotocol, ktorým klient žiada binárne MessagePack rámce.
+SUBPROTOCOL_MSGPACK = "drivetest.msgpack"
+# Max. počet prijatých, ešte nespracovaných meraní na jedno spojenie.
+WS_CREDIT_WINDOW = int(os.getenv("WS_CREDIT_WINDOW", "1000"))
+
 
 def _preview(obj, maxlen=2000):
     try:
@@ -18,36 +32,187 @@ def _preview(obj, maxlen=2000):
     return (s[:maxlen] + "…") if len(s) > maxlen else s
 
 
+class _Preview:
+    """Lenivý náhľad payloadu – json.dumps sa spraví až keď sa riadok naozaj loguje."""
+
+    __slots__ = ("obj", "maxlen")
+
+    def __init__(self, obj, maxlen=2000):
+        self.obj = obj
+        self.maxlen = maxlen
+
+    def __str__(self):
+        return _preview(self.obj, self.maxlen)
+
+
 class WsController:
     def __init__(self, processor: MessageProcessor):
         self.processor = processor
 
     async def handle(self, ws: WebSocket):
-        await ws.accept()
+        # binárny MessagePack len ak ho klient ponúkne ako subprotocol
+        offered = ws.scope.get("subprotocols") or []
+        subprotocol = SUBPROTOCOL_MSGPACK if SUBPROTOCOL_MSGPACK in offered else None
+        await ws.accept(subprotocol=subprotocol)
         peer = ws.client
         ua = ws.headers.get("user-agent", "-")
-        log.info("WS connected from %s:%s ua=%s", getattr(
-            peer, "host", "?"), getattr(peer, "port", "?"), ua)
+        log.info("WS connected from %s:%s ua=%s subprotocol=%s extensions=%s", getattr(
+            peer, "host", "?"), getattr(peer, "port", "?"), ua, subprotocol,
+            ws.headers.get("sec-websocket-extensions", "-"))
+        binary_fmt = MSGPACK if subprotocol == SUBPROTOCOL_MSGPACK else JSON
+        # routing kľúč pre rámce bez session_id (napr. rtt_updates flush):
+        # posledná session_id videná na tomto spojení
+        session_key = "conn:%s:%s" % (getattr(peer, "host", "?"), getattr(peer, "port", "?"))
+        # kreditné okno spojenia (posiela sa klientovi v každom ACK ako "credits")
+        window = CreditWindow(WS_CREDIT_WINDOW)
+        conn = _Conn(ws, window)
         try:
             while True:
-                raw = await ws.receive_text()
-                try:
-                    data = json.loads(raw)
-                except Exception:
-
-                    log.info("Invalid JSON (ignored)")
+                msg = await ws.receive()
+                t_rx = time.perf_counter()
+                if msg["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(msg.get("code", 1000))
+                raw = msg.get("text")
+                if raw is not None:
+                    fmt = JSON
+                else:
+                    raw = msg.get("bytes") or b""
+                    fmt = binary_fmt
+                data = decode_frame(raw, fmt)
+                if data is None:
+                    hot_log.info("Invalid %s frame (ignored)", fmt)
                     continue
 
-                log.info("RX payload: %s", _preview(data, maxlen=1200))
+                hot_log.info("RX payload: %s", _Preview(data, maxlen=1200))
+
+                is_batch = data.get("type") == "measurement_batch"
+                if is_batch:
+                    ids = [it["id"] for it in data["items"] if it.get("id")]
+                    sid = data.get("session_id")
+                    if sid is None and data["items"]:
+                        sid = data["items"][0].get("session_id")
+                else:
+                    mid = data.get("id")
+                    sid = data.get("session_id")
+                if sid is not None:
+                    session_key = str(sid)
+                if METRICS_ENABLED:
+                    _observe_received(data, is_batch)
+
+                frame = (data.get("type"), ids, None, fmt, t_rx) if is_batch \
+                    else (data.get("type"), None, mid, fmt, t_rx)
 
-                mid = data.get("id")
-                if mid:
-                    # fast-ACK hneď
-                    await ws.send_text(json.dumps({"type": "measurement_ack", "id": mid}))
-                    log.info("ACK sent id=%s", mid)
+                # admission ešte pred ACK: čo sa neprijme, to sa ani neACKne
+                if self.processor.shed_policy == "block":
+                    if self.processor.durable:
+                        # spool: ACK až po zápise na disk
+                        await self.processor.enqueue(data, session_key)
+                    await self._ack(conn, frame)
+                    if not self.processor.durable:
+                        # politika block: pôvodné správanie, čakanie na miesto vo fronte
+                        hot_log.info("Enqueuing data")
+                        await self.processor.enqueue(data, session_key)
+                    continue
 
-                # spracovanie mimo ACK cesty
-                log.info("Enqueuing data")
-                await self.processor.enqueue(data)
+                adm = self.processor.offer(data, session_key, window)
+                if type(adm) is Admission:
+                    await self._respond(conn, adm, frame)
+                    continue
+                # spool (ACK po fsync) / gateway (rozhoduje writer): výsledok
+                # dobehne v úlohe a spojenie medzitým číta ďalšie rámce, takže
+                # aj rámce jedného klienta idú do spoločného fsync / RPC okna;
+                # zaradenie aj ACK ostávajú v poradí rámcov
+                task = asyncio.create_task(self._respond_later(conn, adm, frame))
+                conn.pending.add(task)
+                task.add_done_callback(conn.pending.discard)
         except WebSocketDisconnect:
             pass
+        finally:
+            self.processor.close_window(window)
+
+    async def _respond(self, conn: "_Conn", adm: Admission, frame: tuple) -> None:
+        """ACK / retry_after / slow_down podľa výsledku admission."""
+        frame_type, ids, mid, fmt, _ = frame
+        if not adm.accepted:
+            if not adm.shed:
+                ref = {"ids": ids} if ids is not None else {"id": mid}
+                await _send(conn.ws, {"type": "retry_after", "frame_type": frame_type, **ref,
+                                      "retry_after_ms": adm.retry_after_ms}, fmt)
+            hot_log.info("Frame not admitted (%s)", frame_type)
+            return
+        await self._ack(conn, frame)
+        if adm.congested:
+            now = time.monotonic()
+            if now >= conn.slow_down_until:
+                conn.slow_down_until = now + adm.retry_after_ms / 1000.0
+                self.processor.flow_stats["slow_down_sent"] += 1
+                await _send(conn.ws, {"type": "slow_down",
+                                      "retry_after_ms": adm.retry_after_ms,
+                                      "credits": conn.window.available}, fmt)
+
+    async def _respond_later(self, conn: "_Conn", pending, frame: tuple) -> None:
+        try:
+            adm = await pending
+            if conn.ws.client_state == WebSocketState.CONNECTED:
+                await self._respond(conn, adm, frame)
+        except (WebSocketDisconnect, RuntimeError):
+            # spojenie sa medzitým zavrelo; neACKnuté rámce klient pošle znova
+            pass
+        except Exception:
+            # napr. timeout RPC na writer: spojenie sa zavrie bez ACK
+            log.exception("Admission failed; closing connection")
+            try:
+                await conn.ws.close(code=1011)
+            except Exception:
+                pass
+
+    async def _ack(self, conn: "_Conn", frame: tuple) -> None:
+        _, ids, mid, fmt, t_rx = frame
+        if ids is not None:
+            # jeden ACK pre celú dávku so zoznamom prijatých id
+            await _send(conn.ws, {"type": "measurement_batch_ack", "ids": ids,
+                                  "credits": conn.window.available}, fmt)
+            metrics.ACKED.inc(len(ids))
+            metrics.RECEIVE_TO_ACK.observe(time.perf_counter() - t_rx)
+            hot_log.info("Batch ACK sent (%d ids)", len(ids))
+        elif mid:
+            # fast-ACK hneď
+            await _send(conn.ws, {"type": "measurement_ack", "id": mid,
+                                  "credits": conn.window.available}, fmt)
+            metrics.ACKED.inc()
+            metrics.RECEIVE_TO_ACK.observe(time.perf_counter() - t_rx)
+            hot_log.info("ACK sent id=%s", mid)
+
+
+class _Conn:
+    """Stav jedného WS spojenia zdieľaný s úlohami, ktoré posielajú odložené ACK."""
+
+    __slots__ = ("ws", "window", "slow_down_until", "pending")
+
+    def __init__(self, ws: WebSocket, window: CreditWindow) -> None:
+        self.ws = ws
+        self.window = window
+        self.slow_down_until = 0.0
+        # úlohy čakajúce na výsledok admission (referencia, aby ich nezobral GC)
+        self.pending: set = set()
+
+
+def _observe_received(data, is_batch: bool) -> None:
+    """Počty prijatých meraní + oneskorenie zariadenia (teraz - timestamp_sent)."""
+    items = data["items"] if is_batch else [data]
+    metrics.RECEIVED.inc(len(items))
+    now_ms = time.time() * 1000.0
+    for it in items:
+        row = it.get(ROW_KEY)
+        ts = row.get("Timestamp") if row else None
+        if ts is not None:
+            metrics.DEVICE_LAG.observe(max(0.0, now_ms - ts) / 1000.0)
+
+
+async def _send(ws: WebSocket, obj, fmt: str) -> None:
+    """Odpoveď v rovnakom kódovaní ako požiadavka: JSON text / MessagePack binary."""
+    payload = encode_message(obj, fmt)
+    if fmt == JSON:
+        await ws.send_text(payload.decode())
+    else:
+        await ws.send_bytes(payload)
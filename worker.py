@@ -1,12 +1,67 @@
 # worker.py
 import asyncio
-from logger import get_logger, setup_logging
-from typing import Optional, Dict, Any, List
+import os
+import time
+import zlib
+from collections import Counter
+from logger import get_logger, get_hot_logger, setup_logging
+from typing import Optional, Dict, Any, List, NamedTuple
 
+import metrics
 from dbhandler import PostgresRepository
+from idcache import IDCACHE_SIZE, create_cache
+from records import (
+    BatchRecord, MeasurementRecord, Record, RttRecord, SummaryRecord, compact, strip_rtts,
+)
+from rollups import SessionRollups
+from spool import SPOOL_DIR, SPOOL_DRAIN_S, SPOOL_RETRY_S, Spool, encode_frame
 
 setup_logging()
 log = get_logger("worker")
+hot_log = get_hot_logger("worker")
+
+# Micro-batching: koľko správ max. v jednej dávke a koľko ms čakať na ďalšie.
+BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "500"))
+BATCH_LINGER_MS = float(os.getenv("WORKER_BATCH_LINGER_MS", "20"))
+# Celková kapacita front (delí sa medzi shardy): počet položiek a bajty
+# (odhad veľkosti kompaktných záznamov, pozri records.py).
+QUEUE_MAXSIZE = int(os.getenv("WORKER_QUEUE_MAXSIZE", "10000"))
+QUEUE_MAX_BYTES = int(os.getenv("WORKER_QUEUE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Počet paralelných konzumentov (shardov podľa session_id).
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "4"))
+# Admission control: od akej zaplnenosti shard fronty sa brzdí / sheduje,
+# politika pri saturácii (rtt_first | reject | block) a odporúčaný odklad.
+QUEUE_HIGH_WATER = float(os.getenv("QUEUE_HIGH_WATER", "0.8"))
+SHED_POLICY = os.getenv("SHED_POLICY", "rtt_first").lower()
+RETRY_AFTER_MS = int(os.getenv("RETRY_AFTER_MS", "1000"))
+
+
+class CreditWindow:
+    """
+    Kreditné okno jedného WS spojenia: koľko jeho správ môže byť naraz
+    prijatých a ešte nespracovaných workerom. Kredit sa vráti po spracovaní
+    (so spoolom už po fsync – ďalej záznam drží disk, nie RAM).
+    """
+
+    __slots__ = ("size", "used")
+
+    def __init__(self, size: int) -> None:
+        self.size = max(1, int(size))
+        self.used = 0
+
+    @property
+    def available(self) -> int:
+        return max(0, self.size - self.used)
+
+
+class Admission(NamedTuple):
+    accepted: bool
+    # shard fronta je nad high-water mark -> klient by mal spomaliť
+    congested: bool
+    # odporúčaný odklad pre klienta (pri odmietnutí alebo zahltení), inak 0
+    retry_after_ms: int = 0
+    # zámerne zahodené podľa shed politiky (klientovi sa neoznamuje)
+    shed: bool = False
 
 
 class MessageProcessor:
@@ -15,100 +70,575 @@ class MessageProcessor:
     - Fast-ACK zostáva vo websocket handleri.
     - Sem príde už rozparsovaný JSON (dict).
     - Ukladá ploché stĺpce + idempotentne dopĺňa RTT.
+    - Vo fronte drží kompaktné záznamy (records.compact) – len hodnoty
+      stĺpcov a RTT páry; kapacita je v položkách aj v bajtoch.
+    - Priebežne počíta rollupy sessions (self.rollups) do session_stats.
+    - Merania a RTT, o ktorých idempotency cache (self.ids) vie, že už sú
+      v DB, preskočí bez DB round-tripu (len keď je kľúčom samotné Id;
+      pri partíciovanej tabuľke je cache vypnutá).
+    - Správy spracúva v dávkach: max. batch_size kusov alebo batch_linger_ms
+      od prvej správy (čo nastane skôr); batch_size=1 = po jednej.
+    - Beží `workers` konzumentov, každý s vlastnou ohraničenou frontou;
+      správy sa delia podľa hashu session_id, takže poradie v rámci session
+      (meranie -> neskoršie RTT -> session_summary) ostáva zachované.
+    - So spoolom (spool_dir) sa prijatý záznam najprv zapíše na disk
+      (spool.Spool, group fsync) a až potom ide ACK; fronta v RAM je len
+      read-ahead zo spoolu, offset sa posunie po zápise dávky do DB. Limity
+      admission sú vtedy diskové (SPOOL_MAX_BYTES) a pri nedostupnej DB
+      worker dávku drží a opakuje, namiesto zahodenia.
     """
 
-    def __init__(self, repo: PostgresRepository, queue_maxsize: int = 10000) -> None:
+    def __init__(
+        self,
+        repo: PostgresRepository,
+        queue_maxsize: int = QUEUE_MAXSIZE,
+        queue_max_bytes: int = QUEUE_MAX_BYTES,
+        batch_size: int = BATCH_SIZE,
+        batch_linger_ms: float = BATCH_LINGER_MS,
+        workers: int = WORKER_COUNT,
+        high_water: float = QUEUE_HIGH_WATER,
+        shed_policy: str = SHED_POLICY,
+        retry_after_ms: int = RETRY_AFTER_MS,
+        idcache_size: int = IDCACHE_SIZE,
+        spool_dir: str = SPOOL_DIR,
+    ) -> None:
         self.repo = repo
-        self.queue: asyncio.Queue[Dict[str, Any]
-                                  ] = asyncio.Queue(maxsize=queue_maxsize)
-        self._task: Optional[asyncio.Task] = None
+        self.workers = max(1, int(workers))
+        # queue_maxsize je celkový rozpočet, rozdelí sa rovnomerne medzi shardy
+        shard_maxsize = max(1, queue_maxsize // self.workers)
+        self.queues: List[asyncio.Queue[tuple]] = [
+            asyncio.Queue(maxsize=shard_maxsize) for _ in range(self.workers)
+        ]
+        # bajtový rozpočet per shard a aktuálne obsadené bajty (odhad records)
+        self.shard_max_bytes = max(1, queue_max_bytes // self.workers)
+        self._bytes: List[int] = [0] * self.workers
+        # nastaví sa po uvoľnení bajtov (čakajúci enqueue pri politike block)
+        self._space: List[asyncio.Event] = [asyncio.Event() for _ in range(self.workers)]
+        # nevybavené správy per shard a routing kľúč (na zviditeľnenie hot sessions)
+        self._pending: List[Counter] = [Counter() for _ in range(self.workers)]
+        self.high_water = max(1, int(shard_maxsize * high_water))
+        self.high_water_bytes = max(1, int(self.shard_max_bytes * high_water))
+        self.shed_policy = shed_policy
+        self.retry_after_ms = int(retry_after_ms)
+        # počty shed / odmietnutých / brzdených správ (pre monitoring)
+        self.flow_stats: Counter = Counter()
+        self.batch_size = max(1, int(batch_size))
+        self.batch_linger_ms = max(0.0, float(batch_linger_ms))
+        self._tasks: List[asyncio.Task] = []
         self._stopping = asyncio.Event()
+        # serverové agregáty per session z naozaj zapísaných riadkov
+        self.rollups = SessionRollups(repo)
+        repo.write_listeners.append(self.rollups.observe)
+        # RTT_APPLIED: každé RTT doplnené k existujúcemu riadku (UPDATE aj merge v inserte)
+        repo.write_listeners.append(_count_rtt_fills)
+        # nedávno uložené id meraní / id s vyplneným RTT (None = vypnuté)
+        self.ids = create_cache(idcache_size)
+        # write-ahead spool (None = vypnutý); admission potom stráži bajty
+        # nespracované na disku a limit počtu položiek neplatí (high_water 0)
+        self.spool: Optional[Spool] = None
+        if spool_dir:
+            self.spool = Spool(spool_dir, self.workers, self.shard_for)
+            self.high_water = 0
+            self.high_water_bytes = max(1, int(self.spool.shard_max_bytes * high_water))
+
+    @property
+    def durable(self) -> bool:
+        """ACK až po zápise na disk (spool) – aj pre politiku block."""
+        return self.spool is not None
 
     async def start(self) -> None:
-        if self._task is not None:
+        if self._tasks:
             return
-        self._task = asyncio.create_task(
-            self._run(), name="measurement-worker")
+        if self.ids is not None and tuple(self.repo.conflict_key) != ("Id",):
+            # cache je podľa Id; pri partíciách DB prijme rovnaké Id s iným
+            # Timestamp, takže by zahadzovala riadky, ktoré by DB uložila
+            log.info("Idempotency cache disabled: conflict key is %s",
+                     ", ".join(self.repo.conflict_key))
+            self.ids = None
+        if self.ids is not None:
+            try:
+                await self.ids.warm_up(self.repo)
+            except Exception:
+                log.exception("Idempotency cache warm-up failed; starting cold")
+        if self.spool is not None:
+            await self.spool.open()
+        self.rollups.start()
+        self._tasks = [
+            asyncio.create_task(self._run(shard),
+                                name=f"measurement-worker-{shard}")
+            for shard in range(self.workers)
+        ]
+        if self.spool is not None:
+            self._tasks += [
+                asyncio.create_task(self._feed(shard), name=f"spool-feeder-{shard}")
+                for shard in range(self.workers)
+            ]
 
     async def stop(self, drain: bool = True) -> None:
         # signal na zastavenie
         self._stopping.set()
-        if drain:
-            await self.queue.join()
-        if self._task:
-            self._task.cancel()
+        if self.spool is not None:
+            if drain:
+                await self._drain_spool(SPOOL_DRAIN_S)
+        elif drain:
+            await self.join()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
             try:
-                await self._task
+                await task
             except asyncio.CancelledError:
                 pass
-            self._task = None
+        self._tasks = []
+        if self.spool is not None:
+            await self.spool.close()
+        try:
+            await self.rollups.stop()
+        except Exception:
+            log.exception("final session rollup flush failed")
+
+    async def join(self) -> None:
+        """Počká, kým workery spracujú všetko doteraz zaradené (bez spoolu)."""
+        await asyncio.gather(*(q.join() for q in self.queues))
+
+    def shard_for(self, key: Optional[str]) -> int:
+        """Stabilný (medzi procesmi rovnaký) shard pre routing kľúč."""
+        if self.workers == 1 or not key:
+            return 0
+        return zlib.crc32(key.encode("utf-8", "replace")) % self.workers
+
+    async def enqueue(self, data: Dict[str, Any], key: Optional[str] = None) -> None:
+        """
+        Pridaj rozparsovanú správu do fronty jej shardu. Ak je plná, čakaj (backpressure).
+        Routing podľa data["session_id"]; `key` je fallback pre rámce bez
+        session_id (napr. rtt_updates flush), typicky session daného spojenia.
+        """
+        await self.put(_routing_key(data, key), compact(data), _message_cost(data))
 
-    async def enqueue(self, data: Dict[str, Any]) -> None:
-        """Pridaj rozparsovanú správu do fronty. Ak je plná, čakaj (backpressure)."""
+    async def put(self, rkey: str, rec: Record, cost: int = 1) -> None:
+        """enqueue pre už kompaktný záznam (aj z gateway procesu, pozri gateway.py)."""
+        shard = self.shard_for(rkey)
+        if self.spool is not None:
+            await self._spool_put(shard, rkey, rec, cost)
+        else:
+            await self._put_shard(shard, rkey, rec)
+        metrics.ENQUEUED.inc(cost)
+
+    async def _put_shard(self, shard: int, rkey: str, rec: Record,
+                         offset: Optional[int] = None) -> None:
+        """Do fronty shardu s čakaním na miesto (položky aj bajty)."""
+        q = self.queues[shard]
+        while self._bytes[shard] > 0 and self._bytes[shard] + rec.nbytes > self.shard_max_bytes:
+            hot_log.info("worker queue %d over byte budget; waiting to enqueue", shard)
+            self._space[shard].clear()
+            await self._space[shard].wait()
+        pending = self._pending[shard]
+        pending[rkey] += 1
+        self._bytes[shard] += rec.nbytes
         try:
-            self.queue.put_nowait(data)
+            q.put_nowait((rkey, rec, None, 0, time.perf_counter(), offset))
         except asyncio.QueueFull:
-            log.info("worker queue full; waiting to enqueue")
-            await self.queue.put(data)
+            hot_log.info("worker queue %d full; waiting to enqueue", shard)
+            try:
+                await q.put((rkey, rec, None, 0, time.perf_counter(), offset))
+            except BaseException:
+                _release(pending, rkey)
+                self._free(shard, rec.nbytes)
+                raise
+
+    async def _spool_put(self, shard: int, rkey: str, rec: Record, cost: int) -> None:
+        """put so spoolom: čaká na miesto v diskovom rozpočte a na fsync."""
+        spool = self.spool
+        frame = encode_frame(rkey, cost, rec)
+        while (spool.backlog_bytes(shard) > 0
+               and spool.backlog_bytes(shard) + len(frame) > spool.shard_max_bytes):
+            hot_log.info("spool shard %d over byte budget; waiting to enqueue", shard)
+            self._space[shard].clear()
+            await self._space[shard].wait()
+        if not await spool.append(shard, frame):
+            raise OSError(f"spool write failed (shard {shard})")
+
+    def offer(self, data: Dict[str, Any], key: Optional[str] = None,
+              window: Optional[CreditWindow] = None) -> Admission:
+        """
+        Neblokujúci admission control pre WS handler (volá sa pred ACK).
+        - nad high-water mark: pri politike rtt_first sa zahodia samostatné
+          rtt_updates rámce a z meraní sa odstránia vložené rtt_updates
+          (klient ich posiela opakovane v klznom okne);
+        - plná shard fronta (položky alebo bajty) alebo vyčerpané kredity
+          spojenia: správa sa odmietne (neACKne) s retry_after_ms;
+        - politika block: správanie ako enqueue, rozhoduje volajúci (await).
+        """
+        return self.admit(_routing_key(data, key), compact(data), _message_cost(data), window)
+
+    def admit(self, rkey: str, rec: Record, cost: int = 1,
+              window: Optional[CreditWindow] = None) -> Admission:
+        """offer pre už kompaktný záznam (aj z gateway procesu, pozri gateway.py)."""
+        shard = self.shard_for(rkey)
+        q = self.queues[shard]
+        spool = self.spool
+        if spool is None:
+            used = self._bytes[shard]
+            congested = q.qsize() >= self.high_water or used >= self.high_water_bytes
+        else:
+            used = spool.backlog_bytes(shard)
+            congested = used >= self.high_water_bytes
+
+        if congested and self.shed_policy == "rtt_first":
+            if type(rec) is RttRecord:
+                self.flow_stats["shed_rtt_frames"] += 1
+                return Admission(False, True, self.retry_after_ms, shed=True)
+            rec, stripped = strip_rtts(rec)
+            self.flow_stats["stripped_rtt_updates"] += stripped
+
+        if window is not None and window.used + cost > window.size and window.used > 0:
+            self.flow_stats["rejected_credits"] += 1
+            return Admission(False, congested, self.retry_after_ms)
+
+        if spool is not None:
+            return self._spool_admit(shard, rkey, rec, cost, window, used, congested)
+
+        if used > 0 and used + rec.nbytes > self.shard_max_bytes:
+            self.flow_stats["rejected_bytes"] += 1
+            return Admission(False, True, self.retry_after_ms)
+
+        try:
+            q.put_nowait((rkey, rec, window, cost, time.perf_counter(), None))
+        except asyncio.QueueFull:
+            self.flow_stats["rejected_full"] += 1
+            return Admission(False, True, self.retry_after_ms)
+
+        self._bytes[shard] += rec.nbytes
+        self._pending[shard][rkey] += 1
+        if window is not None:
+            window.used += cost
+        self.flow_stats["admitted"] += 1
+        metrics.ENQUEUED.inc(cost)
+        return Admission(True, congested, self.retry_after_ms if congested else 0)
+
+    def _spool_admit(self, shard: int, rkey: str, rec: Record, cost: int,
+                     window: Optional[CreditWindow], used: int, congested: bool):
+        """
+        admit so spoolom: rámec sa zaradí do spoolu hneď (poradie), výsledok
+        je awaitable s Admission až po fsync – ACK ide až potom.
+        """
+        spool = self.spool
+        frame = encode_frame(rkey, cost, rec)
+        if used > 0 and used + len(frame) > spool.shard_max_bytes:
+            self.flow_stats["rejected_spool"] += 1
+            return Admission(False, True, self.retry_after_ms)
+        fut = spool.append(shard, frame)
+        if window is not None:
+            window.used += cost
+        return self._await_durable(fut, window, cost, congested)
+
+    async def _await_durable(self, fut: asyncio.Future, window: Optional[CreditWindow],
+                             cost: int, congested: bool) -> Admission:
+        try:
+            ok = await fut
+        finally:
+            if window is not None:
+                window.used -= cost
+        if not ok:
+            self.flow_stats["rejected_spool_error"] += 1
+            return Admission(False, True, self.retry_after_ms)
+        self.flow_stats["admitted"] += 1
+        metrics.ENQUEUED.inc(cost)
+        return Admission(True, congested, self.retry_after_ms if congested else 0)
+
+    def close_window(self, window: CreditWindow) -> None:
+        """Spojenie skončilo; okno lokálne nič nedrží (kredity vracia worker)."""
+
+    def qsize(self) -> int:
+        return sum(self.queue_depths())
+
+    def queue_depths(self) -> List[int]:
+        if self.spool is not None:
+            return [self.spool.backlog_records(i) for i in range(self.workers)]
+        return [q.qsize() for q in self.queues]
+
+    def queue_bytes(self) -> int:
+        """Odhad pamäte záznamov práve čakajúcich vo frontách (so spoolom bajty na disku)."""
+        if self.spool is not None:
+            return sum(self.spool.backlog_bytes(i) for i in range(self.workers))
+        return sum(self._bytes)
+
+    def shard_stats(self, top: int = 3) -> List[Dict[str, Any]]:
+        """
+        Hĺbka a bajty každej shard fronty + najviac zaťažené sessions v nej.
+        So spoolom depth/bytes = nespracované v spoole (maxsize 0 = bez limitu
+        počtu) a buffered = read-ahead v RAM.
+        """
+        spool = self.spool
+        out = []
+        for i, q in enumerate(self.queues):
+            st = {
+                "shard": i,
+                "depth": q.qsize(),
+                "maxsize": q.maxsize,
+                "bytes": self._bytes[i],
+                "max_bytes": self.shard_max_bytes,
+                "hot_sessions": self._pending[i].most_common(top),
+            }
+            if spool is not None:
+                st.update(depth=spool.backlog_records(i), maxsize=0,
+                          bytes=spool.backlog_bytes(i), max_bytes=spool.shard_max_bytes,
+                          buffered=q.qsize(), buffered_bytes=self._bytes[i])
+            out.append(st)
+        return out
+
+    def _free(self, shard: int, nbytes: int) -> None:
+        self._bytes[shard] -= nbytes
+        self._space[shard].set()
+
+    async def _next_batch(self, q: asyncio.Queue) -> List[tuple]:
+        """Počká na prvú správu, potom dočerpá frontu do batch_size / linger."""
+        batch = [await q.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_linger_ms / 1000.0
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(q.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(q.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
 
-    async def _run(self) -> None:
+    async def _run(self, shard: int) -> None:
+        q = self.queues[shard]
+        pending = self._pending[shard]
         while True:
-            log.info("worker waiting for data")
-            data = await self.queue.get()
+            hot_log.info("worker %d waiting for data", shard)
+            batch = await self._next_batch(q)
+            t_deq = time.perf_counter()
+            for item in batch:
+                metrics.ENQUEUE_TO_DEQUEUE.observe(t_deq - item[4])
             try:
-                msg_type = data.get("type")
+                recs = [item[1] for item in batch]
+                failed = await self._process_batch(recs)
+                if self.spool is not None:
+                    await self._retry_on_outage(recs, failed)
+                    await self.spool.commit(shard, batch[-1][5], len(batch))
+                    self._space[shard].set()
+                elif failed:
+                    # bez spoolu sa neopakuje – zápisy sú stratené
+                    self.flow_stats["failed_writes"] += failed
+            except Exception:
+                log.info("worker %d failed on unexpected error", shard)
+            finally:
+                metrics.DEQUEUE_TO_COMMIT.observe(time.perf_counter() - t_deq)
+                hot_log.info("worker %d batch done (%d messages)", shard, len(batch))
+                for rkey, rec, window, cost, _, _ in batch:
+                    _release(pending, rkey)
+                    self._free(shard, rec.nbytes)
+                    if window is not None:
+                        window.used -= cost
+                    q.task_done()
+
+    async def _feed(self, shard: int) -> None:
+        """Spool -> fronta shardu (read-ahead ohraničený queue_maxsize a bajtmi)."""
+        while True:
+            for rkey, _, rec, offset in await self.spool.read(shard, self.batch_size):
+                if rec is not None:
+                    await self._put_shard(shard, rkey, rec, offset)
+                else:
+                    # preskočený poškodený úsek: commitne sa až po zápise všetkého
+                    # pred ním (commity shardu idú v poradí) a uberie sa z backlogu
+                    await self.queues[shard].join()
+                    await self.spool.commit(shard, offset, 1)
+
+    async def _retry_on_outage(self, batch: List[Record], failed: int) -> None:
+        """
+        So spoolom: ak zlyhania dávky spôsobila nedostupná DB, offset sa
+        neposunie – dávka sa po obnovení DB zopakuje (zápis je idempotentný).
+        Chyby pri dostupnej DB (zlé dáta) sa neopakujú, ako bez spoolu.
+        """
+        while failed and not await self.repo.ping():
+            self.flow_stats["db_outage_waits"] += 1
+            hot_log.info("database unreachable; holding spooled batch of %d", len(batch))
+            await asyncio.sleep(SPOOL_RETRY_S)
+            if await self.repo.ping():
+                failed = await self._process_batch(batch)
+
+    async def _drain_spool(self, timeout: float) -> None:
+        """Pri zastavení počká, kým workery zapíšu spool do DB (max. timeout)."""
+        deadline = time.monotonic() + timeout
+        while self.qsize() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.qsize():
+            log.warning("Stopping with %d spooled records; they will be replayed on start",
+                        self.qsize())
+
+    async def _process_batch(self, batch: List[Record]) -> int:
+        """Zapíše dávku do DB; vráti počet zlyhaných zápisov (meraní, RTT, summary)."""
+        failed = 0
+        measurements: List[MeasurementRecord] = []
+        # id -> rtt_ms; deduplikované, prvý výskyt vyhráva (ako RTT_ms IS NULL v DB)
+        rtts: Dict[str, float] = {}
+        summaries: List[Dict[str, Any]] = []
+
+        for rec in _iter_records(batch):
+            kind = type(rec)
+
+            # 0) session_summary
+            if kind is SummaryRecord:
+                summaries.append(rec.payload)
+                continue
+
+            # 0b) samostatný rámec s rtt_updates (flush)
+            if kind is RttRecord:
+                _collect_rtts(rtts, rec)
+                continue
+
+            # 1) measurement
+            if kind is not MeasurementRecord:
+                hot_log.info("ignoring message type=%s", rec.msg_type)
+                continue
 
-                # 0) session_summary
-                if msg_type == "session_summary":
-                    await self.repo.upsert_session_stats(data)
-                    log.info("session_summary stored for session_id=%s",
+            if not rec.id:
+                hot_log.info("measurement without id, skipping")
+                continue
+
+            measurements.append(rec)
+            # 2) RTT updaty v rámci payloadu
+            _collect_rtts(rtts, rec)
+
+        if self.ids is not None:
+            measurements, rtts = self._skip_known(measurements, rtts)
+
+        # RTT pre merania z tejto dávky sa zlúčia priamo do insertu; keďže fronta
+        # je FIFO, meranie staršie než dávka už je v DB a ide cez set-based UPDATE.
+        batch_ids = {m.id for m in measurements}
+        merged = {k: v for k, v in rtts.items() if k in batch_ids}
+        rest = {k: v for k, v in rtts.items() if k not in batch_ids}
+
+        if measurements:
+            failed += await self._insert_measurements(measurements, merged)
+
+        if rest:
+            failed += await self._apply_rtts(rest)
+
+        for data in summaries:
+            try:
+                await self.repo.upsert_session_stats(data)
+                self.rollups.finish(data.get("session_id"))
+                hot_log.info("session_summary stored for session_id=%s",
                              data.get("session_id"))
-                    continue
-
-                # 0b) samostatný rámec s rtt_updates (flush)
-                if msg_type == "rtt_updates":
-                    updates: List[Dict[str, Any]] = data.get("items") or []
-                    for upd in updates:
-                        uid = upd.get("id")
-                        rtt = upd.get("rtt_ms")
-                        if uid is None or rtt is None:
-                            continue
-                        try:
-                            await self.repo.apply_rtt(str(uid), float(rtt))
-                        except Exception:
-                            log.info("apply_rtt failed for id=%s (flush)", uid)
-                    continue
-
-                # 1) measurement
-                if msg_type != "measurement":
-                    log.info("ignoring message type=%s", msg_type)
-                    continue
-
-                mid = data.get("id")
-                if not mid:
-                    log.info("measurement without id, skipping")
-                    continue
-
-                try:
-                    await self.repo.insert_measurement_flat(data)
-                except Exception:
-                    log.info("insert_measurement_flat failed for id=%s", mid)
-
-                # 2) RTT updaty v rámci payloadu
-                updates: List[Dict[str, Any]] = (data.get("rtt_updates") or [])
-                for upd in updates:
-                    uid = upd.get("id")
-                    rtt = upd.get("rtt_ms")
-                    if uid is None or rtt is None:
-                        continue
-                    try:
-                        await self.repo.apply_rtt(str(uid), float(rtt))
-                    except Exception:
-                        log.info(
-                            "apply_rtt failed for id=%s (from carrier=%s)", uid, mid)
+            except Exception:
+                failed += 1
+                metrics.FAILED.inc()
+                log.info("upsert_session_stats failed for session_id=%s",
+                         data.get("session_id"))
+        return failed
+
+    def _skip_known(self, measurements: List[MeasurementRecord],
+                    rtts: Dict[str, float]) -> tuple:
+        """Odfiltruje merania a RTT, ktoré podľa idempotency cache už sú v DB."""
+        ids = self.ids
+        fresh = [m for m in measurements if not ids.known_measurement(m.id)]
+        if len(fresh) < len(measurements):
+            metrics.DUPLICATE.inc(len(measurements) - len(fresh))
+        return fresh, {k: v for k, v in rtts.items() if not ids.known_rtt(k)}
+
+    async def _insert_measurements(self, measurements: List[MeasurementRecord],
+                                   rtts: Dict[str, float]) -> int:
+        """Jedna transakcia pre celú dávku; pri chybe fallback po jednom riadku. Vráti počet zlyhaných."""
+        try:
+            inserted = await self.repo.insert_measurements_flat(
+                [m.payload() for m in measurements], rtts)
+            metrics.INSERTED.inc(inserted)
+            metrics.DUPLICATE.inc(len(measurements) - inserted)
+            if self.ids is not None:
+                self.ids.stored((m.id for m in measurements), rtts)
+            return 0
+        except Exception:
+            log.info("batch insert of %d measurements failed; retrying one by one",
+                     len(measurements))
 
+        failed = 0
+        for m in measurements:
+            mid = m.id
+            try:
+                inserted = await self.repo.insert_measurement_flat(m.payload(), rtts.get(mid))
+                metrics.INSERTED.inc(inserted)
+                metrics.DUPLICATE.inc(1 - inserted)
+                if self.ids is not None:
+                    self.ids.stored((mid,), (mid,) if mid in rtts else ())
             except Exception:
-                log.info("worker failed on unexpected error")
-            finally:
-                log.info("worker task done")
-                self.queue.task_done()
+                failed += 1
+                metrics.FAILED.inc()
+                log.info("insert_measurement_flat failed for id=%s", mid)
+        return failed
+
+    async def _apply_rtts(self, rtts: Dict[str, float]) -> int:
+        """Jeden set-based UPDATE; pri chybe fallback po jednom id. Vráti počet zlyhaných."""
+        try:
+            await self.repo.apply_rtt_many(rtts)
+            if self.ids is not None:
+                self.ids.applied(rtts)
+            return 0
+        except Exception:
+            log.info("batch apply of %d RTT updates failed; retrying one by one",
+                     len(rtts))
+
+        failed = 0
+        for uid, rtt in rtts.items():
+            try:
+                await self.repo.apply_rtt(uid, rtt)
+                if self.ids is not None:
+                    self.ids.applied((uid,))
+            except Exception:
+                failed += 1
+                metrics.FAILED.inc()
+                log.info("apply_rtt failed for id=%s", uid)
+        return failed
+
+
+def _iter_records(batch: List[Record]):
+    """Rozbalí measurement_batch záznamy na jednotlivé merania (v poradí)."""
+    for rec in batch:
+        if type(rec) is BatchRecord:
+            yield from rec.items
+            continue
+        yield rec
+
+
+def _collect_rtts(out: Dict[str, float], rec: Any) -> None:
+    """Pridá (id, rtt_ms) páry záznamu (už validované v compact); existujúce id neprepisuje."""
+    for uid, rtt in zip(rec.rtt_ids, rec.rtt_ms):
+        if uid not in out:
+            out[uid] = rtt
+
+
+def _count_rtt_fills(new_rows: List[Dict[str, Any]],
+                     fills: List[tuple]) -> None:
+    metrics.RTT_APPLIED.inc(len(fills))
+
+
+def _routing_key(data: Dict[str, Any], fallback: Optional[str]) -> str:
+    sid = data.get("session_id")
+    if sid is not None:
+        return str(sid)
+    return fallback or ""
+
+
+def _release(pending: Counter, rkey: str) -> None:
+    pending[rkey] -= 1
+    if pending[rkey] <= 0:
+        del pending[rkey]
+
+
+def _message_cost(data: Dict[str, Any]) -> int:
+    """Koľko kreditov stojí rámec: dávka podľa počtu položiek, inak 1."""
+    if data.get("type") == "measurement_batch":
+        items = data.get("items")
+        return max(1, len(items)) if isinstance(items, list) else 1
+    return 1
+
@@ -0,0 +1,68 @@
+# writer.py
+"""
+DB writer pre multi-process režim: vlastní DB pool, MessageProcessor (fronty,
+rollupy, idempotency cache) a archiváciu sessions. Gateway procesy
+(uvicorn --workers N s INGEST_MODE=gateway) mu posielajú kompaktné záznamy
+cez WRITER_SOCKET; spúšťa ho docker/entrypoint.sh pri GATEWAY_WORKERS > 1.
+
+    python writer.py
+"""
+import asyncio
+import os
+import signal
+import time
+
+import metrics
+from archive import create_archiver
+from dbhandler import DB_BACKEND, create_repository
+from gateway import WriterServer
+from logger import get_logger, setup_logging
+from worker import MessageProcessor
+
+setup_logging()
+log = get_logger("writer")
+
+# Port pre /metrics writera (ingest, DB pool, fronty); 0 = bez HTTP servera.
+WRITER_METRICS_PORT = int(os.getenv("WRITER_METRICS_PORT", "9101"))
+
+
+async def main() -> None:
+    t0 = time.perf_counter()
+    repo = create_repository(DB_BACKEND)
+    processor = MessageProcessor(repo)
+    archiver = create_archiver() if DB_BACKEND != "memory" else None
+    server = WriterServer(processor, repo)
+    metrics.bind(processor, repo, None, archiver)
+
+    await repo.start()
+    try:
+        warmed = await repo.warm_up()
+    except Exception:
+        warmed = 0
+        log.exception("Connection pre-warm failed; continuing cold")
+    await processor.start()
+    if archiver is not None:
+        archiver.start()
+    await server.start()
+    if WRITER_METRICS_PORT:
+        metrics.serve(WRITER_METRICS_PORT)
+    log.info("Writer ready in %.3fs (pre-warm on %d connections, backend %s)",
+             time.perf_counter() - t0, warmed, DB_BACKEND)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # gateway procesy sa zastavujú skôr (entrypoint.sh); fronty sa dočerpajú
+    log.info("Writer shutdown")
+    await server.stop()
+    if archiver is not None:
+        await archiver.stop()
+    await processor.stop()
+    await repo.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())